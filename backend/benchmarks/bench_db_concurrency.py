@@ -0,0 +1,118 @@
+"""SQLite接続設定の同時実行ベンチマーク
+
+従来の設定（StaticPoolの単一接続・ロールバックジャーナル）と、
+productionプロファイル（WAL・synchronous=NORMAL・接続プール）で、
+読み込み中心の混合ワークロードのスループットを比較する。
+
+    uv run python benchmarks/bench_db_concurrency.py
+    uv run python benchmarks/bench_db_concurrency.py --workers 32 --ops 200
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from backend.database import build_engine
+from backend.models import Base, Conversation, Message
+
+CONVERSATIONS = 20
+MESSAGES_PER_CONVERSATION = 50
+
+
+def legacy_engine(database_url: str):
+    """従来のdatabase.pyと同じ設定（SQL出力のみ無効化）"""
+    return create_async_engine(
+        database_url,
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool
+    )
+
+
+async def seed(session_factory):
+    async with session_factory() as db:
+        for c in range(CONVERSATIONS):
+            conversation = Conversation(title=f"bench-{c}")
+            db.add(conversation)
+            await db.flush()
+            parent_id = None
+            for i in range(MESSAGES_PER_CONVERSATION):
+                message = Message(
+                    conversation_id=conversation.id,
+                    parent_id=parent_id,
+                    role="user" if i % 2 == 0 else "assistant",
+                    content=f"message {i} " * 30
+                )
+                db.add(message)
+                await db.flush()
+                parent_id = message.id
+        await db.commit()
+
+
+async def worker(session_factory, ops: int, write_ratio: float, stats: dict):
+    for _ in range(ops):
+        conversation_id = random.randint(1, CONVERSATIONS)
+        start = time.perf_counter()
+        try:
+            async with session_factory() as db:
+                if random.random() < write_ratio:
+                    db.add(Message(conversation_id=conversation_id, role="user", content="new message"))
+                    await db.commit()
+                else:
+                    # サイドバー・ツリー表示相当の軽い読み込み
+                    query = (
+                        select(Message)
+                        .where(Message.conversation_id == conversation_id)
+                        .order_by(Message.created_at.desc())
+                        .limit(20)
+                    )
+                    result = await db.execute(query)
+                    result.scalars().all()
+            stats["ok"] += 1
+            stats["latencies"].append(time.perf_counter() - start)
+        except Exception:
+            stats["errors"] += 1
+
+
+async def run(name: str, engine, workers: int, ops: int, write_ratio: float):
+    session_factory = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    await seed(session_factory)
+
+    stats = {"ok": 0, "errors": 0, "latencies": []}
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(session_factory, ops, write_ratio, stats) for _ in range(workers)])
+    elapsed = time.perf_counter() - start
+    await engine.dispose()
+
+    latencies = sorted(stats["latencies"])
+    p95 = latencies[int(len(latencies) * 0.95)] * 1000 if latencies else float("nan")
+    # 失敗した操作はスループットに含めない
+    print(f"{name:<12} {stats['ok'] / elapsed:>10.1f} ok ops/s {p95:>10.1f} ms p95 {stats['errors']:>8} errors")
+
+
+async def main(workers: int, ops: int, write_ratio: float):
+    print(f"{workers} workers x {ops} ops, write ratio {write_ratio:.0%}")
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f"sqlite+aiosqlite:///{os.path.join(tmp, 'legacy.db')}"
+        await run("legacy", legacy_engine(url), workers, ops, write_ratio)
+
+        url = f"sqlite+aiosqlite:///{os.path.join(tmp, 'production.db')}"
+        await run("production", build_engine(url, profile="production", echo=False), workers, ops, write_ratio)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--ops", type=int, default=100)
+    parser.add_argument("--write-ratio", type=float, default=0.2)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.workers, args.ops, args.write_ratio))
@@ -0,0 +1,115 @@
+"""Ollamaクライアントの接続再利用ベンチマーク
+
+ローカルのスタブサーバー（/api/generate を即座に返す）に対して、
+従来の実装（呼び出しごとに httpx.AsyncClient を作成）と、
+OllamaAdapterの共有接続プールで1リクエストあたりのオーバーヘッドを比較する。
+
+    uv run python benchmarks/bench_ollama_client.py
+    uv run python benchmarks/bench_ollama_client.py --requests 2000 --concurrency 16
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+from backend.provider_adapters import OllamaAdapter
+
+RESPONSE_BODY = json.dumps({"model": "stub", "response": "pong", "done": True}).encode()
+
+
+async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, stats: dict):
+    """keep-aliveに対応した最小限のHTTP/1.1サーバー"""
+    stats["connections"] += 1
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+
+            content_length = 0
+            keep_alive = True
+            while True:
+                header = await reader.readline()
+                if header in (b"\r\n", b""):
+                    break
+                name, _, value = header.decode().partition(":")
+                if name.lower() == "content-length":
+                    content_length = int(value)
+                elif name.lower() == "connection" and value.strip().lower() == "close":
+                    keep_alive = False
+            await reader.readexactly(content_length)
+
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                + f"Content-Length: {len(RESPONSE_BODY)}\r\n\r\n".encode()
+                + RESPONSE_BODY
+            )
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def legacy_generate(base_url: str) -> str:
+    """従来の _generate_ollama_response と同じ呼び出し方（毎回新しいクライアント）"""
+    async with httpx.AsyncClient() as client:
+        response = await client.post(
+            f"{base_url}/api/generate",
+            json={"model": "stub", "prompt": "ping", "stream": False},
+            timeout=60.0
+        )
+        response.raise_for_status()
+        return response.json()["response"]
+
+
+async def run(label: str, call, requests: int, concurrency: int, stats: dict):
+    stats["connections"] = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            await call()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    elapsed = time.perf_counter() - start
+
+    print(
+        f"{label:<8} {requests / elapsed:>10.0f} req/s  "
+        f"{elapsed / requests * 1e6:>8.0f} us/req  {stats['connections']:>6} TCP connections"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    stats = {"connections": 0}
+    server = await asyncio.start_server(lambda r, w: handle_connection(r, w, stats), "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    base_url = f"http://127.0.0.1:{port}"
+
+    adapter = OllamaAdapter(None, base_url)
+
+    async def pooled_generate():
+        return await adapter.generate("stub", [{"role": "user", "content": "ping"}], 10, 0.7)
+
+    for concurrency in (1, args.concurrency):
+        print(f"{args.requests} requests, concurrency {concurrency}")
+        await run("legacy", lambda: legacy_generate(base_url), args.requests, concurrency, stats)
+        await run("pooled", pooled_generate, args.requests, concurrency, stats)
+
+    await adapter.aclose()
+    server.close()
+    await server.wait_closed()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,98 @@
+"""起動時間（import backend.main）のベンチマーク
+
+`python -X importtime` で新しいプロセスの import を計測し、所要時間の中央値と
+時間のかかっているモジュールを表示する。中央値が予算を超えた場合や、
+遅延importにしているモジュール（LLMのSDK・同期DBドライバー）が起動時に
+読み込まれた場合は終了コード1で失敗する。
+
+    uv run python benchmarks/bench_startup.py
+    uv run python benchmarks/bench_startup.py --runs 10 --max-ms 1500
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+# 起動時に読み込まれてはいけないモジュール（使用時に初めてimportする）
+LAZY_MODULES = (
+    "openai",
+    "anthropic",
+    "google.generativeai",
+    "google.ai.generativelanguage",
+    "tiktoken",
+    "psycopg2",
+    "alembic",
+)
+
+DEFAULT_BUDGET_MS = float(os.getenv("STARTUP_BUDGET_MS", "2000"))
+
+
+def trace_import(module: str) -> List[Tuple[int, int, int, str]]:
+    """新しいプロセスでmoduleをimportし、(自身の時間us, 累積us, 深さ, モジュール名)の一覧を返す"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+        env=os.environ.copy(),
+    )
+
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        entries.append((int(self_us), int(cumulative_us), depth, name.strip()))
+    return entries
+
+
+def summarize(entries: List[Tuple[int, int, int, str]], module: str) -> Dict[str, object]:
+    total_us = next(cumulative for _, cumulative, _, name in entries if name == module)
+    loaded = {name for _, _, _, name in entries}
+    lazy_loaded = sorted(
+        name for name in loaded
+        if any(name == lazy or name.startswith(lazy + ".") for lazy in LAZY_MODULES)
+    )
+    # backend.main直下で読み込まれたモジュールを累積時間順に
+    children = sorted(
+        ((cumulative, name) for _, cumulative, depth, name in entries if depth == 1),
+        reverse=True
+    )
+    return {"total_ms": total_us / 1000, "lazy_loaded": lazy_loaded, "children": children}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="backend.main")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-ms", type=float, default=DEFAULT_BUDGET_MS)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    # 1回目は .pyc の生成を含むため計測から除く
+    trace_import(args.module)
+    runs = [summarize(trace_import(args.module), args.module) for _ in range(args.runs)]
+    median_ms = statistics.median(run["total_ms"] for run in runs)
+
+    print(f"import {args.module}: median {median_ms:.0f} ms over {args.runs} runs (budget {args.max_ms:.0f} ms)")
+    print("slowest direct imports:")
+    for cumulative_us, name in runs[-1]["children"][:args.top]:
+        print(f"  {cumulative_us / 1000:>8.1f} ms  {name}")
+
+    failed = False
+    lazy_loaded = runs[-1]["lazy_loaded"]
+    if lazy_loaded:
+        print(f"FAIL: lazily imported modules were loaded at startup: {', '.join(lazy_loaded)}")
+        failed = True
+    if median_ms > args.max_ms:
+        print(f"FAIL: startup took {median_ms:.0f} ms, over the {args.max_ms:.0f} ms budget")
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+import os
+import sys
+import threading
+
+from dotenv import load_dotenv
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from .models import Conversation, Message
+
+load_dotenv()
+
+# キャッシュエントリの種類
+HISTORY = "history"      # 祖先チェーン（メッセージの追加では変化しない）
+TREE = "tree"            # ツリー構造（メッセージの追加で変化する）
+SKELETON = "skeleton"    # 本文なしのツリー構造
+SUMMARY = "summary"      # 祖先チェーンの要約（根から指定ノードまで）
+STRUCTURE_KINDS = (TREE, SKELETON)
+ALL_KINDS = (HISTORY, TREE, SKELETON, SUMMARY)
+
+# 1エントリあたりの固定オーバーヘッド（オブジェクトヘッダ等の概算）
+_ENTRY_OVERHEAD = 256
+_MESSAGE_OVERHEAD = 200
+
+
+class LRUCache:
+    """エントリ数とバイト数で上限を設けたLRUキャッシュ
+
+    キーは (種類, conversation_id, ...) のタプルで、会話単位での無効化ができる。
+    会話ごとの世代番号を持ち、読み込み開始後に無効化された値は格納しない。
+    """
+
+    def __init__(self, max_entries: int = 2048, max_bytes: int = 64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Tuple, Tuple[Any, int]]" = OrderedDict()
+        self._keys_by_conversation: Dict[int, Set[Tuple]] = {}
+        self._generations: Dict[Tuple[int, str], int] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def generation(self, conversation_id: int, kind: str) -> int:
+        """会話・種類ごとの世代番号（無効化のたびに増える）"""
+        return self._generations.get((conversation_id, kind), 0)
+
+    def get(self, key: Tuple) -> Optional[Any]:
+        """値を取得（ヒット/ミスを記録）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def peek(self, key: Tuple) -> Optional[Any]:
+        """統計やLRU順序を変えずに値を確認"""
+        entry = self._entries.get(key)
+        return entry[0] if entry is not None else None
+
+    def set(self, key: Tuple, value: Any, size: int, generation: Optional[int] = None):
+        """値を格納（generationが現在の世代と異なる場合は格納しない）"""
+        kind, conversation_id = key[0], key[1]
+        size += _ENTRY_OVERHEAD
+
+        with self._lock:
+            if generation is not None and generation != self.generation(conversation_id, kind):
+                return
+            if size > self.max_bytes:
+                return
+
+            self._remove(key)
+            self._entries[key] = (value, size)
+            self._keys_by_conversation.setdefault(conversation_id, set()).add(key)
+            self._bytes += size
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, conversation_id: int, kinds: Iterable[str] = ALL_KINDS):
+        """会話に関するエントリを無効化"""
+        kinds = set(kinds)
+
+        with self._lock:
+            for kind in kinds:
+                self._generations[(conversation_id, kind)] = self.generation(conversation_id, kind) + 1
+            for key in list(self._keys_by_conversation.get(conversation_id, ())):
+                if key[0] in kinds:
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        """全エントリを削除"""
+        with self._lock:
+            for key in self._entries:
+                self._generations[(key[1], key[0])] = self.generation(key[1], key[0]) + 1
+            self._entries.clear()
+            self._keys_by_conversation.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """キャッシュの統計情報"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+    def _remove(self, key: Tuple):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+
+        self._bytes -= entry[1]
+        keys = self._keys_by_conversation.get(key[1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_conversation[key[1]]
+
+
+def estimate_messages_size(messages: Iterable[Any]) -> int:
+    """メッセージ（MessageResponse / MessageSkeleton）のリストのおおよそのメモリ量"""
+    total = 0
+    for message in messages:
+        text = getattr(message, "content", None) or getattr(message, "preview", "")
+        total += sys.getsizeof(text) + _MESSAGE_OVERHEAD
+    return total
+
+
+def estimate_tree_size(roots: Iterable[Any]) -> int:
+    """MessageTreeNodeのツリーのおおよそのメモリ量"""
+    total = 0
+    stack = list(roots)
+    while stack:
+        node = stack.pop()
+        total += sys.getsizeof(node.content) + _MESSAGE_OVERHEAD
+        stack.extend(node.children)
+    return total
+
+
+history_cache = LRUCache(
+    max_entries=int(os.getenv("HISTORY_CACHE_MAX_ENTRIES", "2048")),
+    max_bytes=int(os.getenv("HISTORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+)
+
+
+def _collect_invalidations(session: Session) -> Dict[int, Set[str]]:
+    """flush対象のオブジェクトから無効化が必要な会話と種類を収集"""
+    invalidations: Dict[int, Set[str]] = {}
+
+    def mark(conversation_id: Optional[int], kinds: Iterable[str]):
+        if conversation_id is not None:
+            invalidations.setdefault(conversation_id, set()).update(kinds)
+
+    def conversation_of(message: Message) -> Optional[int]:
+        if message.conversation_id is not None:
+            return message.conversation_id
+        return message.conversation.id if message.conversation is not None else None
+
+    for obj in session.new:
+        if isinstance(obj, Message):
+            # 追加は既存の祖先チェーンを変えないため、ツリーのみ無効化
+            mark(conversation_of(obj), STRUCTURE_KINDS)
+
+    for obj in session.dirty:
+        if isinstance(obj, Message) and session.is_modified(obj):
+            # 再生成などで本文が変わった場合はそのノードを含む履歴も無効化
+            mark(conversation_of(obj), ALL_KINDS)
+        elif isinstance(obj, Conversation) and session.is_modified(obj):
+            mark(obj.id, STRUCTURE_KINDS)
+
+    for obj in session.deleted:
+        if isinstance(obj, Message):
+            mark(conversation_of(obj), ALL_KINDS)
+        elif isinstance(obj, Conversation):
+            mark(obj.id, ALL_KINDS)
+
+    return invalidations
+
+
+@event.listens_for(Session, "before_flush")
+def _record_invalidations(session, flush_context, instances):
+    pending = session.info.setdefault("history_cache_invalidations", {})
+    for conversation_id, kinds in _collect_invalidations(session).items():
+        pending.setdefault(conversation_id, set()).update(kinds)
+        # 書き込み中の読み込み結果がキャッシュされないよう、flush時点でも無効化する
+        history_cache.invalidate(conversation_id, kinds)
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_invalidations(session):
+    pending = session.info.pop("history_cache_invalidations", {})
+    for conversation_id, kinds in pending.items():
+        history_cache.invalidate(conversation_id, kinds)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_invalidations(session, previous_transaction):
+    session.info.pop("history_cache_invalidations", None)
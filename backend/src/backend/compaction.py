@@ -0,0 +1,157 @@
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, List, Optional
+import os
+
+from dotenv import load_dotenv
+
+from .cache import SUMMARY, history_cache, estimate_messages_size
+from .llm_service import llm_service
+from .models import LLMProvider
+from .schemas import MessageResponse
+from .tokenizer import DEFAULT_TOKENIZER
+
+load_dotenv()
+
+# 予算を超えた履歴を要約で圧縮するか（要約のためにLLMを追加で呼び出すため既定では無効、無効なら切り詰めのみ）
+HISTORY_COMPACTION = os.getenv("HISTORY_COMPACTION", "false").lower() == "true"
+# 圧縮時に要約せずそのまま残す直近メッセージの割合（予算に対する比率）
+COMPACTION_KEEP_RATIO = 0.5
+# 要約の最大トークン数
+SUMMARY_MAX_TOKENS = 500
+
+SUMMARY_PREFIX = "これまでの会話の要約:\n"
+
+SUMMARY_INSTRUCTION = (
+    "以下の会話を、後続の会話の文脈として使えるように簡潔に要約してください。"
+    "固有名詞・決定事項・未解決の質問は残してください。要約のみを出力してください。"
+)
+
+Summarizer = Callable[[LLMProvider, Optional[str], List[MessageResponse]], Awaitable[str]]
+
+
+async def summarize_messages(
+    provider: LLMProvider,
+    previous_summary: Optional[str],
+    messages: List[MessageResponse]
+) -> str:
+    """LLMで会話を要約（previous_summaryがあればその続きとして要約し直す）"""
+    transcript = "\n".join(f"{message.role}: {message.content}" for message in messages)
+    if previous_summary:
+        transcript = f"これまでの要約:\n{previous_summary}\n\n続きの会話:\n{transcript}"
+
+    now = datetime.now(timezone.utc)
+    prompt = [
+        MessageResponse(id=0, conversation_id=0, parent_id=None, role="system", content=SUMMARY_INSTRUCTION, created_at=now),
+        MessageResponse(id=0, conversation_id=0, parent_id=None, role="user", content=transcript, created_at=now),
+    ]
+    return await llm_service.generate_response(provider, prompt, max_tokens=SUMMARY_MAX_TOKENS, raise_errors=True)
+
+
+def _summary_message(anchor: MessageResponse, summary: str) -> MessageResponse:
+    """要約を履歴の先頭に置くsystemメッセージに変換（IDは要約の終端ノード）"""
+    return MessageResponse(
+        id=anchor.id,
+        conversation_id=anchor.conversation_id,
+        parent_id=None,
+        role="system",
+        content=SUMMARY_PREFIX + summary,
+        created_at=anchor.created_at
+    )
+
+
+def _token_counts(messages: List[MessageResponse], provider: Optional[LLMProvider]) -> List[int]:
+    tokenizer = llm_service.get_tokenizer(provider)
+    if tokenizer.name == DEFAULT_TOKENIZER.name:
+        return [
+            message.token_count if message.token_count is not None else tokenizer.count_message(message.content)
+            for message in messages
+        ]
+    return [tokenizer.count_message(message.content) for message in messages]
+
+
+def _fits_without_compaction(history: List[MessageResponse], provider: Optional[LLMProvider], budget: int) -> bool:
+    first, last = history[0], history[-1]
+    tokenizer = llm_service.get_tokenizer(provider)
+    if (
+        tokenizer.name == DEFAULT_TOKENIZER.name
+        and first.context_tokens is not None and first.token_count is not None
+        and last.context_tokens is not None
+    ):
+        # 保存された累積トークン数の差だけで判定できる
+        return last.context_tokens - (first.context_tokens - first.token_count) <= budget
+    return sum(_token_counts(history, provider)) <= budget
+
+
+async def compact_history(
+    history: List[MessageResponse],
+    provider: Optional[LLMProvider],
+    budget: Optional[int] = None,
+    summarizer: Optional[Summarizer] = None
+) -> List[MessageResponse]:
+    """予算を超える祖先チェーンの古い部分を要約ノード1つに置き換える
+
+    要約は「根から終端ノードまで」を表し、終端ノードのIDごとにキャッシュする。
+    同じ祖先を共有する兄弟ブランチは、共有部分にある最も深い要約を再利用し、
+    それより後ろのメッセージだけを追加で要約する。要約に失敗した場合は
+    履歴をそのまま返す（後段の切り詰めで予算内に収まる）。
+    """
+    if not HISTORY_COMPACTION or provider is None or len(history) < 2:
+        return history
+
+    if budget is None:
+        budget = llm_service.get_context_budget(provider)
+    if _fits_without_compaction(history, provider, budget):
+        return history
+
+    summarizer = summarizer or summarize_messages
+    conversation_id = history[-1].conversation_id
+    counts = _token_counts(history, provider)
+
+    # 直近のメッセージは予算の一定割合までそのまま残す（最新のメッセージは必ず残す）
+    keep_budget = int(budget * COMPACTION_KEEP_RATIO)
+    keep_start = len(history) - 1
+    kept_tokens = counts[-1]
+    while keep_start > 0 and kept_tokens + counts[keep_start - 1] <= keep_budget:
+        keep_start -= 1
+        kept_tokens += counts[keep_start]
+    if keep_start == 0:
+        return history
+
+    # 共有部分の要約を探す（要約対象の範囲内で最も深いもの）
+    summary: Optional[str] = None
+    position = 0
+    for index in range(keep_start - 1, -1, -1):
+        cached = history_cache.get((SUMMARY, conversation_id, history[index].id))
+        if cached is not None:
+            summary = cached
+            position = index + 1
+            break
+
+    summary_tokens = DEFAULT_TOKENIZER.count_message(summary) if summary else 0
+    if summary is not None and summary_tokens + sum(counts[position:]) <= budget:
+        return [_summary_message(history[position - 1], summary), *history[position:]]
+
+    generation = history_cache.generation(conversation_id, SUMMARY)
+    try:
+        # 要約の入力自体も予算を超えないよう、区切りごとに前の要約へ積み上げる
+        while position < keep_start:
+            end = position + 1
+            chunk_tokens = summary_tokens + counts[position]
+            while end < keep_start and chunk_tokens + counts[end] <= budget:
+                chunk_tokens += counts[end]
+                end += 1
+
+            summary = await summarizer(provider, summary, history[position:end])
+            summary_tokens = DEFAULT_TOKENIZER.count_message(summary)
+            history_cache.set(
+                (SUMMARY, conversation_id, history[end - 1].id),
+                summary,
+                estimate_messages_size([_summary_message(history[end - 1], summary)]),
+                generation
+            )
+            position = end
+    except Exception as e:
+        print(f"Error summarizing history: {str(e)}")
+        return history
+
+    return [_summary_message(history[keep_start - 1], summary), *history[keep_start:]]
@@ -1,8 +1,9 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import StaticPool
 import os
+from typing import Optional
 from dotenv import load_dotenv
 
 from .models import Base
@@ -12,23 +13,111 @@ load_dotenv()
 # データベースURL設定
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./chat.db")
 
+# 接続プロファイル（development / production）
+DB_PROFILE = os.getenv("DB_PROFILE", "development")
+
+# プロファイルごとのSQLite設定（Noneの項目はSQLiteのデフォルトのまま）
+SQLITE_PROFILES = {
+    "development": {
+        "journal_mode": None,
+        "synchronous": None,
+        "busy_timeout": 5000,
+        "mmap_size": None,
+        "cache_size": None,
+        "pool_size": 5,
+        "max_overflow": 5,
+    },
+    "production": {
+        # WALにより書き込み中でも他の接続から読み込める
+        "journal_mode": "WAL",
+        # WALではNORMALでもクラッシュ時に破損せず、コミット毎のfsyncを省ける
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,  # 負の値はKiB単位（64MiB）
+        "pool_size": 10,
+        "max_overflow": 10,
+    },
+}
+
+
+def sqlite_settings(profile: str) -> dict:
+    """プロファイルの設定に環境変数（SQLITE_*, DB_POOL_*）の上書きを適用"""
+    if profile not in SQLITE_PROFILES:
+        raise ValueError(f"Unknown DB_PROFILE: {profile} (expected one of {', '.join(SQLITE_PROFILES)})")
+
+    settings = dict(SQLITE_PROFILES[profile])
+    for key in ("journal_mode", "synchronous"):
+        settings[key] = os.getenv(f"SQLITE_{key.upper()}", settings[key])
+    for key in ("busy_timeout", "mmap_size", "cache_size"):
+        value = os.getenv(f"SQLITE_{key.upper()}")
+        if value is not None:
+            settings[key] = int(value)
+    for key in ("pool_size", "max_overflow"):
+        value = os.getenv(f"DB_{key.upper()}")
+        if value is not None:
+            settings[key] = int(value)
+    return settings
+
+
+def _is_memory_database(database_url: str) -> bool:
+    return ":memory:" in database_url or database_url.rstrip("/").endswith(":")
+
+
+def build_engine(database_url: str, profile: str = DB_PROFILE, echo: Optional[bool] = None):
+    """プロファイルに応じた非同期エンジンを作成"""
+    if echo is None:
+        # SQLの出力は明示的に有効化した場合のみ
+        echo = os.getenv("SQL_ECHO", "false").lower() in ("1", "true", "yes")
+
+    if not database_url.startswith("sqlite"):
+        # PostgreSQL用の設定
+        return create_async_engine(
+            database_url,
+            pool_size=int(os.getenv("DB_POOL_SIZE", "10")),
+            max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "10")),
+            pool_pre_ping=True,
+            echo=echo
+        )
+
+    settings = sqlite_settings(profile)
+
+    if _is_memory_database(database_url):
+        # インメモリDBは接続ごとに別のDBになるため、単一接続を共有する
+        engine = create_async_engine(
+            database_url,
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+            echo=echo
+        )
+    else:
+        # ファイルDBは接続プールを使い、読み込みを書き込みと並行して実行できるようにする
+        engine = create_async_engine(
+            database_url,
+            connect_args={"check_same_thread": False},
+            pool_size=settings["pool_size"],
+            max_overflow=settings["max_overflow"],
+            echo=echo
+        )
+
+    pragmas = [
+        f"PRAGMA {name} = {settings[name]}"
+        for name in ("journal_mode", "synchronous", "busy_timeout", "mmap_size", "cache_size")
+        if settings[name] is not None
+    ]
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def apply_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    return engine
+
+
 # 非同期エンジンの作成
-if DATABASE_URL.startswith("sqlite"):
-    # SQLite用の設定
-    engine = create_async_engine(
-        DATABASE_URL,
-        connect_args={
-            "check_same_thread": False,
-        },
-        poolclass=StaticPool,
-        echo=True  # 開発時のSQL出力
-    )
-else:
-    # PostgreSQL用の設定
-    engine = create_async_engine(
-        DATABASE_URL,
-        echo=True  # 開発時のSQL出力
-    )
+engine = build_engine(DATABASE_URL)
 
 # セッションファクトリーの作成
 AsyncSessionLocal = sessionmaker(
@@ -36,10 +125,27 @@ AsyncSessionLocal = sessionmaker(
 )
 
 
+def run_migrations(connection):
+    """Alembicのマイグレーションを最新まで適用"""
+    from alembic import command
+    from alembic.config import Config
+
+    config = Config()
+    config.set_main_option("script_location", "backend:migrations")
+    config.attributes["connection"] = connection
+
+    tables = inspect(connection).get_table_names()
+    if "conversations" in tables and "alembic_version" not in tables:
+        # create_allで作成された既存DBはベースラインから適用済みとして扱う
+        command.stamp(config, "0001")
+
+    command.upgrade(config, "head")
+
+
 async def init_db():
-    """データベースの初期化"""
+    """データベースの初期化（マイグレーションの適用）"""
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(run_migrations)
 
 
 async def get_db():
@@ -53,4 +159,12 @@ async def get_db():
 
 # 同期版（Alembicマイグレーション用）
 SYNC_DATABASE_URL = DATABASE_URL.replace("+aiosqlite", "").replace("postgresql+asyncpg", "postgresql")
-sync_engine = create_engine(SYNC_DATABASE_URL)
+_sync_engine = None
+
+
+def get_sync_engine():
+    """同期エンジンを取得（DBドライバーの読み込みを避けるため、alembicのCLIから必要になった時点で作成）"""
+    global _sync_engine
+    if _sync_engine is None:
+        _sync_engine = create_engine(SYNC_DATABASE_URL)
+    return _sync_engine
@@ -0,0 +1,191 @@
+from contextlib import aclosing
+from typing import Awaitable, Callable, List, Optional, Sequence, Tuple
+import asyncio
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .compaction import compact_history
+from .llm_service import llm_service
+from .models import LLMProvider, Message
+from .provider_registry import snapshot_provider
+from .resilience import GenerationInfo
+from .schemas import MessageResponse
+from .unit_of_work import ChatUnitOfWork
+
+# 1回の再生成で作る別の応答の数の上限
+MAX_ALTERNATIVES = 8
+
+GENERATION_ERROR_MESSAGE = "申し訳ございません。応答の生成中にエラーが発生しました。しばらく時間をおいて再度お試しください。"
+
+# (プロバイダー, チャンク) を受け取るコールバック
+ChunkCallback = Callable[[LLMProvider, str], Awaitable[None]]
+# (プロバイダー, 保存したアシスタントメッセージ) を受け取るコールバック
+CompleteCallback = Callable[[LLMProvider, Message], Awaitable[None]]
+# 別の応答の生成で (候補番号, チャンク) / (候補番号, 保存したアシスタントメッセージ) を受け取るコールバック
+AlternativeChunkCallback = Callable[[int, str], Awaitable[None]]
+AlternativeCompleteCallback = Callable[[int, Message], Awaitable[None]]
+
+
+async def load_providers(db: AsyncSession, provider_ids: Sequence[int]) -> List[LLMProvider]:
+    """指定IDのプロバイダーを指定順に取得（存在しないIDがあればLookupError）"""
+    result = await db.execute(select(LLMProvider).where(LLMProvider.id.in_(set(provider_ids))))
+    providers = {provider.id: snapshot_provider(provider) for provider in result.scalars()}
+
+    missing = [provider_id for provider_id in provider_ids if provider_id not in providers]
+    if missing:
+        raise LookupError(f"Provider not found: {', '.join(map(str, missing))}")
+    return [providers[provider_id] for provider_id in provider_ids]
+
+
+async def _prepare_history(history: List[MessageResponse], provider: LLMProvider) -> List[MessageResponse]:
+    """プロバイダーのコンテキストウィンドウに合わせて履歴を圧縮・切り詰め"""
+    history = await compact_history(history, provider)
+    return llm_service.truncate_messages_for_context(history, provider=provider)
+
+
+async def _generate(
+    provider: LLMProvider,
+    history: List[MessageResponse],
+    use_cache: bool,
+    on_chunk: Optional[Callable[[str], Awaitable[None]]],
+    failover: bool = True
+) -> Tuple[str, Optional[LLMProvider]]:
+    """1つの応答を生成し、(応答, 応答したプロバイダー)を返す
+
+    on_chunkがあればストリーミングで生成する。失敗時はエラーメッセージとNoneを返す。
+    """
+    info = GenerationInfo()
+    try:
+        if on_chunk is None:
+            content = await llm_service.generate_response(
+                provider, history, raise_errors=True, use_cache=use_cache, failover=failover, info=info
+            )
+            return content, info.provider
+
+        chunks = []
+        # キャンセル時はプロバイダーからの受信もすぐに止める
+        async with aclosing(llm_service.generate_streaming_response(
+            provider, history, use_cache=use_cache, failover=failover, info=info
+        )) as stream:
+            async for chunk in stream:
+                chunks.append(chunk)
+                await on_chunk(chunk)
+        return "".join(chunks), info.provider
+    except Exception as e:
+        print(f"Error generating response from {provider.name}: {str(e)}")
+        return GENERATION_ERROR_MESSAGE, None
+
+
+async def fan_out(
+    uow: ChatUnitOfWork,
+    parent_id: int,
+    history: List[MessageResponse],
+    providers: Sequence[LLMProvider],
+    use_cache: bool = True,
+    on_chunk: Optional[ChunkCallback] = None,
+    on_complete: Optional[CompleteCallback] = None
+) -> List[Tuple[LLMProvider, Message]]:
+    """複数のプロバイダーで並行して応答を生成し、それぞれparent_idの子（兄弟ノード）として保存
+
+    生成は同時に行うため、全体の所要時間は最も遅いプロバイダーの時間になる。
+    on_chunkを渡した場合はストリーミングで生成する。1つのプロバイダーの失敗は
+    他に影響せず、エラーメッセージを応答として保存する。モデルの比較が目的のため
+    代替プロバイダーへの切り替えは行わない。結果はprovidersの順。
+    """
+    # セッションは並行して使えないため、保存だけは1つずつ行う
+    save_lock = asyncio.Lock()
+
+    async def generate(provider: LLMProvider) -> Tuple[LLMProvider, Message]:
+        chunk_callback = None
+        if on_chunk is not None:
+            chunk_callback = lambda chunk: on_chunk(provider, chunk)
+
+        # 圧縮・切り詰めはプロバイダーのコンテキストウィンドウごとに行う
+        provider_history = await _prepare_history(history, provider)
+        content, answered = await _generate(provider, provider_history, use_cache, chunk_callback, failover=False)
+
+        async with save_lock:
+            message = await uow.add_assistant_message(content, parent_id, answered)
+        if on_complete is not None:
+            await on_complete(provider, message)
+        return provider, message
+
+    return await asyncio.gather(*(generate(provider) for provider in providers))
+
+
+async def generate_alternatives(
+    uow: ChatUnitOfWork,
+    parent_id: int,
+    history: List[MessageResponse],
+    provider: LLMProvider,
+    count: int,
+    on_chunk: Optional[AlternativeChunkCallback] = None,
+    on_complete: Optional[AlternativeCompleteCallback] = None
+) -> List[Message]:
+    """1つのプロバイダーでcount個の別の応答を並行して生成し、parent_idの子（兄弟ノード）として保存
+
+    候補数を指定できるプロバイダー（OpenAIのn）では1回のリクエストで、それ以外では
+    count個の並行したリクエストで生成する。別の応答を得るのが目的のため応答キャッシュは
+    使わず、全ての候補を指定したプロバイダーで生成する（代替プロバイダーに切り替えない）。
+    各候補は完了した時点で保存する。結果は候補番号の順。
+    """
+    history = await _prepare_history(history, provider)
+    save_lock = asyncio.Lock()
+    messages: List[Optional[Message]] = [None] * count
+
+    async def save(index: int, content: str, answered: Optional[LLMProvider]):
+        async with save_lock:
+            message = await uow.add_assistant_message(content, parent_id, answered)
+        messages[index] = message
+        if on_complete is not None:
+            await on_complete(index, message)
+
+    async def generate(index: int):
+        chunk_callback = None
+        if on_chunk is not None:
+            chunk_callback = lambda chunk: on_chunk(index, chunk)
+        content, answered = await _generate(provider, history, False, chunk_callback, failover=False)
+        await save(index, content, answered)
+
+    try:
+        native = count > 1 and llm_service.supports_native_choices(provider)
+    except ValueError:
+        native = False
+
+    if not native:
+        await asyncio.gather(*(generate(index) for index in range(count)))
+        return messages
+
+    chunks: List[List[str]] = [[] for _ in range(count)]
+    failed = False
+    try:
+        async with aclosing(llm_service.generate_streaming_choices(provider, history, count)) as stream:
+            async for index, chunk in stream:
+                if index >= count or messages[index] is not None:
+                    continue
+                if chunk is None:
+                    await save(index, "".join(chunks[index]), provider)
+                else:
+                    chunks[index].append(chunk)
+                    if on_chunk is not None:
+                        await on_chunk(index, chunk)
+    except Exception as e:
+        print(f"Error generating alternatives from {provider.name}: {str(e)}")
+        failed = True
+
+    unfinished = [index for index in range(count) if messages[index] is None]
+    if failed:
+        for index in unfinished:
+            content = "".join(chunks[index])
+            if content:
+                await save(index, f"{content}\n\n{GENERATION_ERROR_MESSAGE}", provider)
+            else:
+                await save(index, GENERATION_ERROR_MESSAGE, None)
+    else:
+        # nに対応していない互換APIでは一部の候補しか返らないため、残りは個別に生成する
+        await asyncio.gather(*(generate(index) for index in unfinished if not chunks[index]))
+        for index in unfinished:
+            if chunks[index]:
+                await save(index, "".join(chunks[index]), provider)
+    return messages
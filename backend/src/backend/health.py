@@ -0,0 +1,244 @@
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterable, List, Optional, Tuple
+import asyncio
+import os
+import time
+
+from dotenv import load_dotenv
+
+from .models import LLMProvider
+from .resilience import is_transient
+from .scheduler import SchedulerTimeout
+
+load_dotenv()
+
+# バックグラウンドでプロバイダーを確認する間隔（秒、既定の0なら確認しない）
+# 確認のたびに全プロバイダーへ課金されるリクエストを送るため、必要な場合だけ有効にする
+PROVIDER_HEALTH_INTERVAL = float(os.getenv("PROVIDER_HEALTH_INTERVAL", "0"))
+# 確認用リクエストのタイムアウト（秒、キューでの待ち時間は含まない）
+PROVIDER_HEALTH_TIMEOUT = float(os.getenv("PROVIDER_HEALTH_TIMEOUT", "30"))
+# 連続してこの回数失敗したらサーキットブレーカーを開く
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+# ブレーカーを開いてから試行を1つだけ通すまでの秒数
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+# 所要時間・エラー率の統計に使う直近の結果の数
+_HEALTH_SAMPLES = 100
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# (プロバイダー, タイムアウト) を受け取り (所要時間, 最初のチャンクまでの時間) を返す確認処理
+ProbeFunction = Callable[[LLMProvider, float], Awaitable[Tuple[float, Optional[float]]]]
+
+
+class CircuitOpenError(ValueError):
+    """サーキットブレーカーが開いているため送信しなかった"""
+
+
+class CircuitBreaker:
+    """連続した失敗でリクエストを止め、一定時間後に試行を1つだけ通して回復を確かめる"""
+
+    def __init__(
+        self,
+        failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+        reset_timeout: float = CIRCUIT_RESET_TIMEOUT,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0
+        self._opened_at = 0.0
+        self._clock = clock
+
+    def allow(self) -> bool:
+        """リクエストを送ってよいか（開いている間は待ち時間が過ぎるごとに1つだけ通す）"""
+        if self.state == CLOSED:
+            return True
+        now = self._clock()
+        if now - self._opened_at < self.reset_timeout:
+            return False
+        # 試行の結果が記録されないまま終わっても止まったままにならないよう、次の試行の時刻も進める
+        self.state = HALF_OPEN
+        self._opened_at = now
+        return True
+
+    def retry_after(self) -> float:
+        """次の試行を通すまでの秒数"""
+        if self.state == CLOSED:
+            return 0.0
+        return max(0.0, self.reset_timeout - (self._clock() - self._opened_at))
+
+    def record_success(self):
+        self.state = CLOSED
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+            if self.state == CLOSED:
+                self.opened += 1
+            self.state = OPEN
+            self._opened_at = self._clock()
+
+
+def _summary(values: Iterable[float]) -> Dict[str, Optional[float]]:
+    """平均と95パーセンタイル（ミリ秒）"""
+    ordered = sorted(values)
+    if not ordered:
+        return {"avg_ms": None, "p95_ms": None}
+    return {
+        "avg_ms": sum(ordered) / len(ordered) * 1000,
+        "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+    }
+
+
+class ProviderHealth:
+    """1つのプロバイダーの直近の所要時間・最初のチャンクまでの時間・エラー率とブレーカー"""
+
+    def __init__(self, breaker: CircuitBreaker, samples: int = _HEALTH_SAMPLES):
+        self.breaker = breaker
+        self.latencies: Deque[float] = deque(maxlen=samples)
+        self.ttfts: Deque[float] = deque(maxlen=samples)
+        self.outcomes: Deque[bool] = deque(maxlen=samples)
+        self.last_error: Optional[str] = None
+        self.last_probe_at: Optional[datetime] = None
+        self.last_probe_ok: Optional[bool] = None
+
+    def record_success(self, latency: float, ttft: Optional[float] = None):
+        self.latencies.append(latency)
+        if ttft is not None:
+            self.ttfts.append(ttft)
+        self.outcomes.append(True)
+        self.breaker.record_success()
+
+    def record_failure(self, error: BaseException, trip: bool = True):
+        """失敗を記録（tripがFalseならエラー率にだけ数え、ブレーカーには数えない）"""
+        self.outcomes.append(False)
+        self.last_error = str(error) or type(error).__name__
+        if trip:
+            self.breaker.record_failure()
+
+    def stats(self) -> Dict[str, Any]:
+        errors = self.outcomes.count(False)
+        return {
+            "state": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "circuit_opened": self.breaker.opened,
+            "retry_after_s": self.breaker.retry_after(),
+            "samples": len(self.outcomes),
+            "error_rate": errors / len(self.outcomes) if self.outcomes else 0.0,
+            "latency": _summary(self.latencies),
+            "ttft": _summary(self.ttfts),
+            "last_error": self.last_error,
+            "last_probe_at": self.last_probe_at.isoformat() if self.last_probe_at else None,
+            "last_probe_ok": self.last_probe_ok,
+        }
+
+
+class HealthMonitor:
+    """プロバイダーごとの状態を実際のリクエストと定期的な確認から記録する
+
+    - 実際のリクエストでは一時的なエラー（タイムアウト・429・5xxなど）だけをブレーカーに数える
+      （入力に原因があるエラーでプロバイダー全体を止めないため）
+    - 定期的な確認は小さなリクエストを全プロバイダーに並行して送り、失敗は全てブレーカーに数える。
+      成功すればブレーカーを閉じるため、障害からの回復を実際のリクエストを待たずに検知できる
+    """
+
+    def __init__(
+        self,
+        interval: float = PROVIDER_HEALTH_INTERVAL,
+        probe_timeout: float = PROVIDER_HEALTH_TIMEOUT,
+        failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+        reset_timeout: float = CIRCUIT_RESET_TIMEOUT,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self.interval = interval
+        self.probe_timeout = probe_timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._health: Dict[object, ProviderHealth] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def health_for(self, provider: LLMProvider) -> ProviderHealth:
+        """プロバイダーの状態を取得（なければ作成）"""
+        key = provider.id if provider.id is not None else provider.name
+        health = self._health.get(key)
+        if health is None:
+            health = ProviderHealth(CircuitBreaker(self.failure_threshold, self.reset_timeout, self._clock))
+            self._health[key] = health
+        return health
+
+    def check(self, provider: LLMProvider):
+        """ブレーカーが開いていればCircuitOpenErrorを送出（タイムアウトを待たずに失敗させる）"""
+        breaker = self.health_for(provider).breaker
+        if not breaker.allow():
+            raise CircuitOpenError(
+                f"{provider.name} is unavailable after repeated failures; retry in {breaker.retry_after():.0f}s"
+            )
+
+    def record_success(self, provider: LLMProvider, latency: float, ttft: Optional[float] = None):
+        self.health_for(provider).record_success(latency, ttft)
+
+    def record_error(self, provider: LLMProvider, error: BaseException):
+        """実際のリクエストの失敗を記録"""
+        self.health_for(provider).record_failure(error, trip=is_transient(error))
+
+    async def probe(self, provider: LLMProvider, probe: ProbeFunction):
+        """1つのプロバイダーを確認して記録（キューでのタイムアウトはプロバイダーの失敗に数えない）"""
+        health = self.health_for(provider)
+        try:
+            latency, ttft = await probe(provider, self.probe_timeout)
+        except SchedulerTimeout:
+            return
+        except Exception as e:
+            health.record_failure(e)
+            health.last_probe_ok = False
+            print(f"Health check failed for provider '{provider.name}': {health.last_error}")
+        else:
+            health.record_success(latency, ttft)
+            health.last_probe_ok = True
+        health.last_probe_at = datetime.now(timezone.utc)
+
+    async def probe_all(self, providers: List[LLMProvider], probe: ProbeFunction):
+        """全プロバイダーを並行して確認（削除されたプロバイダーの状態は破棄）"""
+        keys = {provider.id if provider.id is not None else provider.name for provider in providers}
+        for key in list(self._health):
+            if key not in keys:
+                del self._health[key]
+        await asyncio.gather(*(self.probe(provider, probe) for provider in providers))
+
+    def start(self, load_providers: Callable[[], Awaitable[List[LLMProvider]]], probe: ProbeFunction):
+        """定期的な確認をバックグラウンドで開始（間隔が0なら何もしない）"""
+        if self.interval <= 0 or self._task is not None:
+            return
+        self._task = asyncio.create_task(self._run(load_providers, probe))
+
+    async def stop(self):
+        """定期的な確認を停止"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def stats(self, provider: LLMProvider) -> Dict[str, Any]:
+        return self.health_for(provider).stats()
+
+    async def _run(self, load_providers: Callable[[], Awaitable[List[LLMProvider]]], probe: ProbeFunction):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.probe_all(await load_providers(), probe)
+            except Exception as e:
+                print(f"Provider health check failed: {str(e)}")
+
+
+provider_health = HealthMonitor()
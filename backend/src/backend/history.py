@@ -0,0 +1,325 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, func, and_, or_
+from typing import Dict, List, Optional
+
+from .cache import HISTORY, TREE, SKELETON, history_cache, estimate_messages_size, estimate_tree_size
+from .models import Message, next_path_prefix
+from .schemas import MessageResponse, MessageSkeleton, MessageTreeNode
+
+# IN句1回あたりのID数（古いSQLiteのバインド変数上限 999 を超えないように分割）
+_IN_CLAUSE_CHUNK = 500
+
+
+async def get_message(
+    conversation_id: int,
+    message_id: int,
+    db: AsyncSession
+) -> Optional[Message]:
+    """会話に属するメッセージを取得"""
+    query = select(Message).where(
+        Message.id == message_id,
+        Message.conversation_id == conversation_id
+    )
+    result = await db.execute(query)
+    return result.scalar_one_or_none()
+
+
+async def _get_messages_in_order(message_ids: List[int], db: AsyncSession) -> List[Message]:
+    """主キーでメッセージを取得し、指定されたIDの順に並べる"""
+    found: Dict[int, Message] = {}
+
+    for i in range(0, len(message_ids), _IN_CLAUSE_CHUNK):
+        query = select(Message).where(Message.id.in_(message_ids[i:i + _IN_CLAUSE_CHUNK]))
+        result = await db.execute(query)
+        found.update({msg.id: msg for msg in result.scalars().all()})
+
+    return [found[message_id] for message_id in message_ids if message_id in found]
+
+
+async def get_ancestors(message: Message, db: AsyncSession) -> List[Message]:
+    """メッセージの祖先を根から順に取得（自身は含まない）
+
+    マテリアライズドパスに含まれるIDを主キーで引くだけなので、
+    親子関係を辿る必要がない。
+    """
+    return await _get_messages_in_order(message.ancestor_ids, db)
+
+
+async def _build_history(message: Message, db: AsyncSession) -> List[MessageResponse]:
+    """祖先チェーンを組み立ててキャッシュに格納
+
+    自身のチェーンがキャッシュになくても、キャッシュ済みの最も深い祖先の
+    チェーンを再利用し、それより下の祖先のみをDBから読み込む。
+    """
+    conversation_id = message.conversation_id
+    generation = history_cache.generation(conversation_id, HISTORY)
+    ancestor_ids = message.ancestor_ids
+
+    prefix: List[MessageResponse] = []
+    missing_ids = ancestor_ids
+    for index in range(len(ancestor_ids) - 1, -1, -1):
+        cached_prefix = history_cache.peek((HISTORY, conversation_id, ancestor_ids[index]))
+        if cached_prefix is not None:
+            prefix = cached_prefix
+            missing_ids = ancestor_ids[index + 1:]
+            break
+
+    missing = await _get_messages_in_order(missing_ids, db)
+    chain = prefix + [MessageResponse.model_validate(msg) for msg in [*missing, message]]
+
+    history_cache.set((HISTORY, conversation_id, message.id), chain, estimate_messages_size(chain), generation)
+    return list(chain)
+
+
+async def get_history_for_message(message: Message, db: AsyncSession) -> List[MessageResponse]:
+    """読み込み済みのメッセージから根までの会話履歴を取得（根→ノードの順）"""
+    cached = history_cache.get((HISTORY, message.conversation_id, message.id))
+    if cached is not None:
+        return list(cached)
+
+    return await _build_history(message, db)
+
+
+async def get_conversation_history(
+    conversation_id: int,
+    message_id: Optional[int] = None,
+    db: AsyncSession = None
+) -> List[MessageResponse]:
+    """指定されたノードから根までの会話履歴を取得（根→ノードの順）"""
+    if message_id is None:
+        return []
+
+    cached = history_cache.get((HISTORY, conversation_id, message_id))
+    if cached is not None:
+        return list(cached)
+
+    message = await get_message(conversation_id, message_id, db)
+    if not message:
+        return []
+
+    return await _build_history(message, db)
+
+
+def _subtree_query(entities, conversation_id: int, root: Optional[Message], max_depth: Optional[int]):
+    """部分木を取得するクエリを構築（rootがNoneなら会話全体）"""
+    if root is None:
+        query = select(*entities).where(Message.conversation_id == conversation_id)
+        if max_depth is not None:
+            query = query.where(Message.depth <= max_depth)
+    else:
+        # パスはIDで構成され会話をまたいで一意なため、pathインデックスの範囲検索のみで絞り込める
+        prefix = root.subtree_path
+        query = select(*entities).where(or_(
+            Message.id == root.id,
+            and_(Message.path >= prefix, Message.path < next_path_prefix(prefix))
+        ))
+        if max_depth is not None:
+            query = query.where(Message.depth <= root.depth + max_depth)
+
+    return query.order_by(Message.created_at, Message.id)
+
+
+async def get_subtree(
+    conversation_id: int,
+    db: AsyncSession,
+    root_id: Optional[int] = None,
+    max_depth: Optional[int] = None
+) -> List[Message]:
+    """会話のメッセージを作成日時順に取得
+
+    root_idを指定した場合はそのノードと子孫のみ、max_depthを指定した場合は
+    起点からの深さがmax_depth以下のノードのみを返す。子孫の検索はパスの
+    インデックスに対する範囲検索になる。
+    """
+    root = None
+    if root_id is not None:
+        root = await get_message(conversation_id, root_id, db)
+        if not root:
+            return []
+
+    result = await db.execute(_subtree_query([Message], conversation_id, root, max_depth))
+    return list(result.scalars().all())
+
+
+async def get_subtree_skeleton(
+    conversation_id: int,
+    db: AsyncSession,
+    root_id: Optional[int] = None,
+    max_depth: Optional[int] = None,
+    preview_length: int = 80
+) -> Optional[List[MessageSkeleton]]:
+    """本文を含まない部分木（ID・親子関係・先頭のプレビューのみ）を取得
+
+    本文はSQL側で切り詰めるため、長いメッセージでも転送量はプレビュー分のみ。
+    root_idが会話内に存在しない場合はNoneを返す。
+    """
+    key = (SKELETON, conversation_id, root_id, max_depth, preview_length)
+    cached = history_cache.get(key)
+    if cached is not None:
+        return cached
+
+    generation = history_cache.generation(conversation_id, SKELETON)
+    root = None
+    if root_id is not None:
+        root = await get_message(conversation_id, root_id, db)
+        if not root:
+            return None
+
+    columns = [
+        Message.id,
+        Message.parent_id,
+        Message.role,
+        Message.created_at,
+        Message.depth,
+        func.substr(Message.content, 1, preview_length).label("preview")
+    ]
+    result = await db.execute(_subtree_query(columns, conversation_id, root, max_depth))
+    rows = result.all()
+
+    child_counts: Dict[int, int] = {}
+    for row in rows:
+        if row.parent_id is not None:
+            child_counts[row.parent_id] = child_counts.get(row.parent_id, 0) + 1
+
+    if max_depth is not None and rows:
+        base_depth = root.depth if root is not None else 0
+        frontier = [row.id for row in rows if row.depth == base_depth + max_depth]
+        child_counts.update(await count_children(frontier, db))
+
+    skeleton = [
+        MessageSkeleton(
+            id=row.id,
+            parent_id=row.parent_id,
+            role=row.role,
+            created_at=row.created_at,
+            preview=row.preview,
+            child_count=child_counts.get(row.id, 0)
+        )
+        for row in rows
+    ]
+    history_cache.set(key, skeleton, estimate_messages_size(skeleton), generation)
+    return skeleton
+
+
+async def get_messages_by_ids(
+    conversation_id: int,
+    message_ids: List[int],
+    db: AsyncSession
+) -> List[MessageResponse]:
+    """指定されたIDのメッセージ本文をまとめて取得（指定順、会話外のIDは無視）"""
+    found: Dict[int, Message] = {}
+    unique_ids = list(dict.fromkeys(message_ids))
+
+    for i in range(0, len(unique_ids), _IN_CLAUSE_CHUNK):
+        query = select(Message).where(
+            Message.conversation_id == conversation_id,
+            Message.id.in_(unique_ids[i:i + _IN_CLAUSE_CHUNK])
+        )
+        result = await db.execute(query)
+        found.update({msg.id: msg for msg in result.scalars().all()})
+
+    return [MessageResponse.model_validate(found[message_id]) for message_id in unique_ids if message_id in found]
+
+
+async def count_children(parent_ids: List[int], db: AsyncSession) -> Dict[int, int]:
+    """指定されたノードそれぞれの子の数を取得"""
+    counts: Dict[int, int] = {}
+
+    for i in range(0, len(parent_ids), _IN_CLAUSE_CHUNK):
+        query = (
+            select(Message.parent_id, func.count(Message.id))
+            .where(Message.parent_id.in_(parent_ids[i:i + _IN_CLAUSE_CHUNK]))
+            .group_by(Message.parent_id)
+        )
+        result = await db.execute(query)
+        counts.update({parent_id: count for parent_id, count in result.all()})
+
+    return counts
+
+
+def build_message_tree(
+    messages: List[Message],
+    root_id: Optional[int] = None,
+    frontier_counts: Optional[Dict[int, int]] = None
+) -> List[MessageTreeNode]:
+    """メッセージ一覧をツリー構造に変換（1パスで親→子のインデックスを構築）
+
+    messagesは作成日時順であること。frontier_countsには深さ制限で子を
+    読み込まなかったノードの子の数を渡す。
+    """
+    nodes: Dict[int, MessageTreeNode] = {
+        message.id: MessageTreeNode(
+            id=message.id,
+            role=message.role,
+            content=message.content,
+            created_at=message.created_at,
+            children=[]
+        )
+        for message in messages
+    }
+    roots: List[MessageTreeNode] = []
+
+    for message in messages:
+        node = nodes[message.id]
+        is_root = message.id == root_id if root_id is not None else message.parent_id is None
+        if is_root:
+            roots.append(node)
+        elif message.parent_id in nodes:
+            nodes[message.parent_id].children.append(node)
+
+    frontier_counts = frontier_counts or {}
+    for node_id, node in nodes.items():
+        node.child_count = frontier_counts.get(node_id, len(node.children))
+
+    return roots
+
+
+async def load_conversation_tree(
+    conversation_id: int,
+    db: AsyncSession,
+    root_id: Optional[int] = None,
+    max_depth: Optional[int] = None
+) -> Optional[List[MessageTreeNode]]:
+    """会話（またはroot_id以下の部分木）をツリー構造で取得
+
+    max_depthを指定した場合、最下層のノードは子を含まず child_count のみを返す。
+    root_idが会話内に存在しない場合はNoneを返す。
+    """
+    key = (TREE, conversation_id, root_id, max_depth)
+    cached = history_cache.get(key)
+    if cached is not None:
+        return cached
+
+    generation = history_cache.generation(conversation_id, TREE)
+    messages = await get_subtree(conversation_id, db, root_id=root_id, max_depth=max_depth)
+    if root_id is not None and not messages:
+        return None
+
+    frontier_counts = None
+    if max_depth is not None and messages:
+        base_depth = messages[0].depth if root_id is not None else 0
+        frontier = [msg.id for msg in messages if msg.depth == base_depth + max_depth]
+        frontier_counts = await count_children(frontier, db)
+
+    roots = build_message_tree(messages, root_id=root_id, frontier_counts=frontier_counts)
+    history_cache.set(key, roots, estimate_tree_size(roots), generation)
+    return roots
+
+
+async def get_changed_messages(
+    conversation_id: int,
+    since: int,
+    db: AsyncSession,
+    limit: Optional[int] = None
+) -> List[MessageResponse]:
+    """指定された版数より後に追加・変更されたメッセージを版数順に取得"""
+    query = (
+        select(Message)
+        .where(Message.conversation_id == conversation_id, Message.version > since)
+        .order_by(Message.version, Message.id)
+    )
+    if limit is not None:
+        query = query.limit(limit)
+
+    result = await db.execute(query)
+    return [MessageResponse.model_validate(msg) for msg in result.scalars().all()]
@@ -1,495 +1,522 @@
-import openai
-import anthropic
-import google.generativeai as genai
-import httpx
-from typing import List, Dict, Any, Optional, AsyncGenerator
+from typing import List, Dict, Any, Optional, AsyncGenerator, AsyncIterator, Callable, Tuple, TypeVar
+import asyncio
 import os
+import time
 from dotenv import load_dotenv
-import json
-import asyncio
 
+from bisect import bisect_left
+from itertools import accumulate
+
+from .health import HealthMonitor, provider_health
 from .models import LLMProvider
+from .provider_adapters import AdapterRegistry, resolve_provider_type
 from .schemas import MessageResponse
+from .resilience import GenerationInfo, ResilientExecutor
+from .response_cache import ResponseCache, response_cache
+from .singleflight import SingleFlight
+from .scheduler import BATCH, INTERACTIVE, RequestScheduler, request_scheduler
+from .tokenizer import DEFAULT_TOKENIZER, Tokenizer, get_context_window, get_tokenizer
 
 load_dotenv()
 
+# 応答の最大トークン数の既定値（generate_responseのmax_tokensと同じ）
+DEFAULT_REPLY_TOKENS = 2000
+DEFAULT_TEMPERATURE = 0.7
+# キャッシュ済みの応答をストリーミングで返すときの1チャンクの文字数
+CACHED_STREAM_CHUNK_SIZE = 64
+
+# プロバイダーが不明な場合の履歴のトークン数
+DEFAULT_CONTEXT_BUDGET = 4000
+# 履歴に使うトークン数の上限（0ならモデルのコンテキストウィンドウ全体）
+# 長い会話で1ターンごとの入力コストと所要時間が増えすぎないよう、既定では従来の4000に抑える
+MAX_CONTEXT_TOKENS = int(os.getenv("MAX_CONTEXT_TOKENS", "4000"))
+
+# 定期的な確認で送るメッセージと応答の最大トークン数
+PROBE_MESSAGE = "ping"
+PROBE_MAX_TOKENS = 1
+
+T = TypeVar("T")
+
+
+async def _first_chunk(stream: AsyncGenerator) -> Tuple[Optional[Any], AsyncGenerator]:
+    """最初の要素まで受信したストリームを返す（空ならNone、失敗時はストリームを閉じて送出）"""
+    try:
+        first = await stream.__anext__()
+    except StopAsyncIteration:
+        return None, stream
+    except BaseException:
+        await stream.aclose()
+        raise
+    return first, stream
+
+
+def _chat_messages(messages: List[MessageResponse]) -> List[Dict[str, str]]:
+    """アダプターに渡すrole / contentの形式に変換（systemメッセージの扱いなどはアダプターが行う）"""
+    return [{"role": message.role, "content": message.content} for message in messages]
+
 
 class LLMService:
     """LLMプロバイダーとの統合サービス"""
     
-    def __init__(self):
-        self.clients = {}  # プロバイダーIDごとにクライアントをキャッシュ
+    def __init__(
+        self,
+        cache: ResponseCache = response_cache,
+        scheduler: RequestScheduler = request_scheduler,
+        resilience: Optional[ResilientExecutor] = None,
+        health: HealthMonitor = provider_health
+    ):
+        self.adapters = AdapterRegistry()  # プロバイダーごとのアダプター（クライアントを保持）
+        self.response_cache = cache
+        self.scheduler = scheduler  # プロバイダーごとの同時実行数・レート制限
+        self.resilience = resilience or ResilientExecutor()  # 再試行・フェイルオーバー・ヘッジ
+        self.health = health  # プロバイダーごとの所要時間・エラー率とサーキットブレーカー
+        self.flights = SingleFlight()  # 同時に実行中の同じ生成の共有
+        # プロバイダーの代替先（フェイルオーバーの順）を返す関数
+        self.fallback_resolver: Callable[[LLMProvider], List[LLMProvider]] = lambda provider: []
+    
+    async def aclose(self):
+        """アダプターが保持しているクライアントを閉じる（アプリ終了時）"""
+        await self.adapters.aclose()
     
     def _get_provider_type(self, provider: LLMProvider) -> str:
-        """プロバイダーの種類を判定"""
-        name_lower = provider.name.lower()
-        
-        if "openai" in name_lower or "gpt" in name_lower:
-            return "openai"
-        elif "azure" in name_lower:
-            return "openai"  # Azure OpenAI は OpenAI API と同じ
-        elif "anthropic" in name_lower or "claude" in name_lower:
-            return "anthropic"
-        elif "gemini" in name_lower or "google" in name_lower:
-            return "gemini"
-        elif "ollama" in name_lower:
-            return "ollama"
-        else:
-            # モデル名からも判定を試行
-            model_lower = provider.model_name.lower()
-            if "gpt" in model_lower:
-                return "openai"
-            elif "claude" in model_lower:
-                return "anthropic"
-            elif "gemini" in model_lower:
-                return "gemini"
-            elif "llama" in model_lower or "qwen" in model_lower:
-                return "ollama"
-            else:
-                raise ValueError(f"Cannot determine provider type for: {provider.name} with model: {provider.model_name}")
+        """プロバイダーの種別を取得"""
+        return resolve_provider_type(provider)
     
     async def generate_response(
         self,
         provider: LLMProvider,
         messages: List[MessageResponse],
-        max_tokens: int = 2000
+        max_tokens: int = DEFAULT_REPLY_TOKENS,
+        raise_errors: bool = False,
+        use_cache: bool = True,
+        priority: int = INTERACTIVE,
+        failover: bool = True,
+        info: Optional[GenerationInfo] = None
     ) -> str:
-        """LLMからの応答を生成"""
-        
+        """LLMからの応答を生成（raise_errorsがFalseならエラー時は謝罪文を返す）
+
+        応答キャッシュが有効でuse_cacheがTrueなら、同じ入力に対する応答を再利用する。
+        use_cacheがTrueなら、同じ入力の生成が実行中の場合はその結果を共有する。
+        プロバイダーへの送信はスケジューラーの実行枠を確保してから行い、失敗時は
+        再試行や代替プロバイダーへの切り替えを行う。実際に応答したプロバイダーはinfoに記録する。
+        """
+        info = info if info is not None else GenerationInfo()
         provider_type = self._get_provider_type(provider)
         
         # メッセージを適切な形式に変換
-        formatted_messages = self._format_messages_for_provider(provider_type, messages)
+        formatted_messages = _chat_messages(messages)
+        
+        cache_key = self._response_cache_key(provider, provider_type, formatted_messages, max_tokens, use_cache)
+        if cache_key:
+            cached = await self.response_cache.get(cache_key)
+            if cached is not None:
+                info.provider = provider
+                info.cached = True
+                return cached
+        
+        async def generate(target: GenerationInfo) -> AsyncGenerator[str, None]:
+            answered, response = await self.resilience.run(
+                self._candidates(provider, failover),
+                lambda candidate: self._generate_once(candidate, messages, max_tokens, priority),
+                target
+            )
+            # 代替プロバイダーの応答は元のプロバイダーの応答としてキャッシュしない
+            if cache_key and response and answered is provider:
+                await self.response_cache.set(cache_key, response)
+            yield response
         
+        flight_key = self._flight_key(
+            "generate", provider, provider_type, formatted_messages, max_tokens, failover, use_cache
+        )
         try:
-            if provider_type == "openai":
-                return await self._generate_openai_response(
-                    provider, formatted_messages, max_tokens
-                )
-            elif provider_type == "anthropic":
-                return await self._generate_anthropic_response(
-                    provider, formatted_messages, max_tokens
-                )
-            elif provider_type == "gemini":
-                return await self._generate_gemini_response(
-                    provider, formatted_messages, max_tokens
-                )
-            elif provider_type == "ollama":
-                return await self._generate_ollama_response(
-                    provider, formatted_messages, max_tokens
-                )
-            else:
-                raise ValueError(f"Unsupported provider type: {provider_type}")
+            # 応答全体を1つのチャンクとして受け取る
+            return "".join([response async for response in self._shared(flight_key, generate, info)])
                 
         except Exception as e:
             # エラーハンドリング - 実際のアプリケーションではより詳細なログを記録
             print(f"Error generating response from {provider.name} ({provider_type}): {str(e)}")
+            if raise_errors:
+                raise
             return f"申し訳ございません。{provider.name}からの応答生成中にエラーが発生しました。"
     
-    def _format_messages_for_provider(
-        self, 
-        provider_name: str, 
-        messages: List[MessageResponse]
-    ) -> List[Dict[str, str]]:
-        """プロバイダー固有の形式にメッセージを変換"""
-        formatted = []
-        
-        for msg in messages:
-            if provider_name == "anthropic" and msg.role == "system":
-                # Anthropicはsystemメッセージを別途処理
-                continue
-            
-            formatted.append({
-                "role": msg.role,
-                "content": msg.content
-            })
-        
-        return formatted
+    async def _shared(
+        self,
+        flight_key: Optional[str],
+        produce: Callable[[GenerationInfo], AsyncIterator[T]],
+        info: GenerationInfo
+    ) -> AsyncGenerator[T, None]:
+        """同じキーの生成が実行中ならそのチャンクを共有し、なければ開始する（キーがNoneなら共有しない）
+
+        生成は最初の呼び出し元の記録（GenerationInfo）に記録し、終了時にinfoへ写す。
+        """
+        if flight_key is None:
+            async for chunk in produce(info):
+                yield chunk
+            return
+        
+        shared = GenerationInfo()
+        flight = self.flights.join(flight_key, lambda: produce(shared), shared)
+        subscription = self.flights.subscribe(flight)
+        try:
+            async for chunk in subscription:
+                yield chunk
+        finally:
+            # 受信をやめたことをすぐに伝える（他に受信者がいなければ生成が止まる）
+            await subscription.aclose()
+            info.update(flight.shared, coalesced=flight.shared is not shared)
     
-    async def _generate_openai_response(
+    def _flight_key(
         self,
+        kind: str,
         provider: LLMProvider,
-        messages: List[Dict[str, str]],
-        max_tokens: int
-    ) -> str:
-        """OpenAI/Azure OpenAI APIからの応答生成"""
-        # プロバイダーごとにクライアントをキャッシュ
-        client_key = f"openai_{provider.id}"
-        if client_key not in self.clients:
-            # APIキーが無効な場合のチェック
-            if not provider.api_key or provider.api_key == "your-api-key-here":
-                raise ValueError(f"Invalid API key for {provider.name}. Please set a valid API key in settings.")
-            
-            base_url = provider.api_url if provider.api_url else None
-            self.clients[client_key] = openai.AsyncOpenAI(
-                api_key=provider.api_key,
-                base_url=base_url
-            )
-        
-        client = self.clients[client_key]
-        response = await client.chat.completions.create(
-            model=provider.model_name,
-            messages=messages,
-            max_tokens=max_tokens,
-            temperature=0.7
+        provider_type: str,
+        formatted_messages: List[Dict[str, str]],
+        max_tokens: int,
+        failover: bool,
+        use_cache: bool
+    ) -> Optional[str]:
+        """実行中の生成を共有するためのキー（新しい応答が必要な場合はNone）"""
+        if not use_cache:
+            return None
+        return self.response_cache.make_key(
+            provider_type,
+            provider.model_name,
+            provider.api_url,
+            {
+                "kind": kind,
+                "provider_id": provider.id,
+                "failover": failover,
+                "max_tokens": max_tokens,
+                "temperature": DEFAULT_TEMPERATURE,
+            },
+            formatted_messages
         )
-        
-        return response.choices[0].message.content
     
-    async def _generate_anthropic_response(
+    def _candidates(self, provider: LLMProvider, failover: bool) -> List[LLMProvider]:
+        """試行するプロバイダーの順序（代替先が設定されていれば続けて試す）"""
+        if not failover:
+            return [provider]
+        return [provider, *self.fallback_resolver(provider)]
+    
+    async def _generate_once(
         self,
         provider: LLMProvider,
-        messages: List[Dict[str, str]],
-        max_tokens: int
+        messages: List[MessageResponse],
+        max_tokens: int,
+        priority: int
     ) -> str:
-        """Anthropic APIからの応答生成"""
-        # プロバイダーごとにクライアントをキャッシュ
-        client_key = f"anthropic_{provider.id}"
-        if client_key not in self.clients:
-            if not provider.api_key or provider.api_key == "your-api-key-here":
-                raise ValueError(f"Invalid API key for {provider.name}. Please set a valid API key in settings.")
-            
-            self.clients[client_key] = anthropic.AsyncAnthropic(api_key=provider.api_key)
-        
-        client = self.clients[client_key]
-        
-        # systemメッセージを分離
-        system_message = ""
-        user_messages = []
-        
-        for msg in messages:
-            if msg["role"] == "system":
-                system_message = msg["content"]
-            else:
-                user_messages.append(msg)
-        
-        response = await client.messages.create(
-            model=provider.model_name,
-            max_tokens=max_tokens,
-            system=system_message if system_message else "You are a helpful assistant.",
-            messages=user_messages
-        )
-        
-        return response.content[0].text
+        """1つのプロバイダーに1回送信して応答全体を取得"""
+        provider_type = self._get_provider_type(provider)
+        formatted_messages = _chat_messages(messages)
+        adapter = self.adapters.get(provider)
+        self.health.check(provider)
+        async with self._scheduled(provider, provider_type, formatted_messages, max_tokens, priority):
+            start = time.perf_counter()
+            try:
+                response = await adapter.generate(
+                    provider.model_name, formatted_messages, max_tokens, DEFAULT_TEMPERATURE
+                )
+            except Exception as e:
+                self.health.record_error(provider, e)
+                raise
+            self.health.record_success(provider, time.perf_counter() - start)
+            return response
     
-    async def _generate_gemini_response(
+    def _response_cache_key(
         self,
         provider: LLMProvider,
-        messages: List[Dict[str, str]],
-        max_tokens: int
-    ) -> str:
-        """Google Gemini APIからの応答生成"""
-        if not provider.api_key or provider.api_key == "your-api-key-here":
-            raise ValueError(f"Invalid API key for {provider.name}. Please set a valid API key in settings.")
-        
-        genai.configure(api_key=provider.api_key)
-        model = genai.GenerativeModel(provider.model_name)
-        
-        # Gemini用にメッセージを変換
-        conversation_text = ""
-        for msg in messages:
-            role_prefix = "Human: " if msg["role"] == "user" else "Assistant: "
-            conversation_text += f"{role_prefix}{msg['content']}\n\n"
-        
-        conversation_text += "Assistant: "
-        
-        response = await model.generate_content_async(
-            conversation_text,
-            generation_config=genai.types.GenerationConfig(
-                max_output_tokens=max_tokens,
-                temperature=0.7
-            )
+        provider_type: str,
+        formatted_messages: List[Dict[str, str]],
+        max_tokens: int,
+        use_cache: bool
+    ) -> Optional[str]:
+        """応答キャッシュのキー（キャッシュを使わない場合はNone）"""
+        if not use_cache or not self.response_cache.enabled:
+            return None
+        return self.response_cache.make_key(
+            provider_type,
+            provider.model_name,
+            provider.api_url,
+            {"max_tokens": max_tokens, "temperature": DEFAULT_TEMPERATURE},
+            formatted_messages
         )
-        
-        return response.text
     
-    async def _generate_ollama_response(
+    async def generate_streaming_response(
         self,
         provider: LLMProvider,
-        messages: List[Dict[str, str]],
-        max_tokens: int
-    ) -> str:
-        """Ollama APIからの応答生成"""
-        # api_urlが設定されているかチェック
-        if not provider.api_url:
-            raise ValueError(f"Ollama provider '{provider.name}' requires a base URL. Please set the base URL in settings (e.g., http://localhost:11434)")
-        
-        # メッセージを単一のプロンプトに変換
-        prompt = ""
-        for msg in messages:
-            if msg["role"] == "user":
-                prompt += f"User: {msg['content']}\n"
-            elif msg["role"] == "assistant":
-                prompt += f"Assistant: {msg['content']}\n"
-            elif msg["role"] == "system":
-                prompt += f"System: {msg['content']}\n"
-        
-        prompt += "Assistant: "
+        messages: List[MessageResponse],
+        max_tokens: int = DEFAULT_REPLY_TOKENS,
+        use_cache: bool = True,
+        priority: int = INTERACTIVE,
+        failover: bool = True,
+        info: Optional[GenerationInfo] = None
+    ) -> AsyncGenerator[str, None]:
+        """LLMからのストリーミング応答を生成（キャッシュ済みの応答はチャンクに分けて返す）
+
+        再試行・フェイルオーバー・ヘッジは最初のチャンクを受け取るまでに限る
+        （送信済みのチャンクは取り消せないため）。use_cacheがTrueなら、同じ入力の生成が
+        実行中の場合は1つの生成のチャンクを共有し、全ての受信者がいなくなるまで生成を続ける。
+        """
+        info = info if info is not None else GenerationInfo()
+        provider_type = self._get_provider_type(provider)
         
+        # メッセージを適切な形式に変換
+        formatted_messages = _chat_messages(messages)
+        
+        cache_key = self._response_cache_key(provider, provider_type, formatted_messages, max_tokens, use_cache)
+        if cache_key:
+            cached = await self.response_cache.get(cache_key)
+            if cached is not None:
+                info.provider = provider
+                info.cached = True
+                for i in range(0, len(cached), CACHED_STREAM_CHUNK_SIZE):
+                    yield cached[i:i + CACHED_STREAM_CHUNK_SIZE]
+                return
+        
+        flight_key = self._flight_key(
+            "stream", provider, provider_type, formatted_messages, max_tokens, failover, use_cache
+        )
+        stream = self._shared(
+            flight_key,
+            lambda target: self._stream_response(provider, messages, max_tokens, priority, failover, cache_key, target),
+            info
+        )
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{provider.api_url}/api/generate",
-                    json={
-                        "model": provider.model_name,
-                        "prompt": prompt,
-                        "stream": False,
-                        "options": {
-                            "num_predict": max_tokens,
-                            "temperature": 0.7
-                        }
-                    },
-                    timeout=60.0
-                )
-                
-                response.raise_for_status()
-                result = response.json()
-                
-                return result["response"]
-        except httpx.ConnectError:
-            raise ValueError(f"Cannot connect to Ollama server at {provider.api_url}. Please ensure Ollama is running and accessible.")
-        except httpx.TimeoutException:
-            raise ValueError(f"Timeout connecting to Ollama server at {provider.api_url}. The request took too long.")
-        except httpx.HTTPStatusError as e:
-            if e.response.status_code == 404:
-                raise ValueError(f"Model '{provider.model_name}' not found on Ollama server. Please check if the model is installed.")
-            else:
-                raise ValueError(f"Ollama server error (HTTP {e.response.status_code}): {e.response.text}")
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
     
-    async def generate_streaming_response(
+    async def _stream_response(
         self,
         provider: LLMProvider,
         messages: List[MessageResponse],
-        max_tokens: int = 2000
+        max_tokens: int,
+        priority: int,
+        failover: bool,
+        cache_key: Optional[str],
+        info: GenerationInfo
     ) -> AsyncGenerator[str, None]:
-        """LLMからのストリーミング応答を生成"""
-        
+        """プロバイダーからストリーミングで受信（エラー時は謝罪文を返す）"""
         provider_type = self._get_provider_type(provider)
-        
-        # メッセージを適切な形式に変換
-        formatted_messages = self._format_messages_for_provider(provider_type, messages)
-        
         try:
-            if provider_type == "openai":
-                async for chunk in self._generate_openai_streaming_response(
-                    provider, formatted_messages, max_tokens
-                ):
-                    yield chunk
-            elif provider_type == "anthropic":
-                async for chunk in self._generate_anthropic_streaming_response(
-                    provider, formatted_messages, max_tokens
-                ):
-                    yield chunk
-            elif provider_type == "gemini":
-                async for chunk in self._generate_gemini_streaming_response(
-                    provider, formatted_messages, max_tokens
-                ):
-                    yield chunk
-            elif provider_type == "ollama":
-                async for chunk in self._generate_ollama_streaming_response(
-                    provider, formatted_messages, max_tokens
-                ):
-                    yield chunk
-            else:
-                raise ValueError(f"Unsupported provider type: {provider_type}")
-                
+            answered, (first_chunk, stream) = await self.resilience.run(
+                self._candidates(provider, failover),
+                lambda candidate: self._open_stream(candidate, messages, max_tokens, priority),
+                info,
+                discard=lambda opened: opened[1].aclose(),
+                kind="stream"
+            )
         except Exception as e:
             # エラーハンドリング
             print(f"Error generating streaming response from {provider.name} ({provider_type}): {str(e)}")
             yield f"申し訳ございません。{provider.name}からの応答生成中にエラーが発生しました。"
-
-    def truncate_messages_for_context(
-        self,
-        messages: List[MessageResponse],
-        max_tokens: int = 4000
-    ) -> List[MessageResponse]:
-        """コンテキスト制限に合わせてメッセージを切り詰め"""
-        # 簡単な実装：文字数ベースで切り詰め（実際にはトークン数で計算すべき）
-        total_chars = 0
-        truncated_messages = []
-        
-        # 最新のメッセージから逆順で追加
-        for message in reversed(messages):
-            message_chars = len(message.content)
-            if total_chars + message_chars > max_tokens * 4:  # 大まかな文字数換算
-                break
-            
-            truncated_messages.insert(0, message)
-            total_chars += message_chars
+            return
         
-        return truncated_messages
-
-
-    async def _generate_openai_streaming_response(
+        chunks = []
+        try:
+            if first_chunk is not None:
+                chunks.append(first_chunk)
+                yield first_chunk
+            async for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+                
+        except Exception as e:
+            # エラーハンドリング
+            print(f"Error generating streaming response from {answered.name}: {str(e)}")
+            yield f"申し訳ございません。{answered.name}からの応答生成中にエラーが発生しました。"
+            return
+        finally:
+            await stream.aclose()
+        
+        # 最後まで受信できた応答のみキャッシュする
+        if cache_key and chunks and answered is provider:
+            await self.response_cache.set(cache_key, "".join(chunks))
+    
+    async def _open_stream(
         self,
         provider: LLMProvider,
-        messages: List[Dict[str, str]],
-        max_tokens: int
-    ) -> AsyncGenerator[str, None]:
-        """OpenAI/Azure OpenAI APIからのストリーミング応答生成"""
-        # プロバイダーごとにクライアントをキャッシュ
-        client_key = f"openai_{provider.id}"
-        if client_key not in self.clients:
-            # APIキーが無効な場合のチェック
-            if not provider.api_key or provider.api_key == "your-api-key-here":
-                raise ValueError(f"Invalid API key for {provider.name}. Please set a valid API key in settings.")
-            
-            base_url = provider.api_url if provider.api_url else None
-            self.clients[client_key] = openai.AsyncOpenAI(
-                api_key=provider.api_key,
-                base_url=base_url
-            )
-        
-        client = self.clients[client_key]
-        stream = await client.chat.completions.create(
-            model=provider.model_name,
-            messages=messages,
-            max_tokens=max_tokens,
-            temperature=0.7,
-            stream=True
+        messages: List[MessageResponse],
+        max_tokens: int,
+        priority: int
+    ) -> Tuple[Optional[str], AsyncGenerator[str, None]]:
+        """ストリーミングを開始し、(最初のチャンク, 残りのストリーム)を返す（空の応答ならチャンクはNone）"""
+        provider_type = self._get_provider_type(provider)
+        formatted_messages = _chat_messages(messages)
+        adapter = self.adapters.get(provider)
+        self.health.check(provider)
+        stream = self._measured_stream(
+            provider, provider_type, formatted_messages, max_tokens, priority,
+            lambda: adapter.stream(provider.model_name, formatted_messages, max_tokens, DEFAULT_TEMPERATURE)
         )
-        
-        async for chunk in stream:
-            if chunk.choices[0].delta.content is not None:
-                yield chunk.choices[0].delta.content
+        return await _first_chunk(stream)
 
-    async def _generate_anthropic_streaming_response(
+    async def _measured_stream(
         self,
         provider: LLMProvider,
-        messages: List[Dict[str, str]],
-        max_tokens: int
-    ) -> AsyncGenerator[str, None]:
-        """Anthropic APIからのストリーミング応答生成"""
-        # プロバイダーごとにクライアントをキャッシュ
-        client_key = f"anthropic_{provider.id}"
-        if client_key not in self.clients:
-            if not provider.api_key or provider.api_key == "your-api-key-here":
-                raise ValueError(f"Invalid API key for {provider.name}. Please set a valid API key in settings.")
-            
-            self.clients[client_key] = anthropic.AsyncAnthropic(api_key=provider.api_key)
-        
-        client = self.clients[client_key]
-        
-        # systemメッセージを分離
-        system_message = ""
-        user_messages = []
-        
-        for msg in messages:
-            if msg["role"] == "system":
-                system_message = msg["content"]
-            else:
-                user_messages.append(msg)
-        
-        async with client.messages.stream(
-            model=provider.model_name,
-            max_tokens=max_tokens,
-            system=system_message if system_message else "You are a helpful assistant.",
-            messages=user_messages
-        ) as stream:
-            async for text in stream.text_stream:
-                yield text
-
-    async def _generate_gemini_streaming_response(
+        provider_type: str,
+        formatted_messages: List[Dict[str, str]],
+        reply_tokens: int,
+        priority: int,
+        open_stream: Callable[[], AsyncIterator[Any]]
+    ) -> AsyncGenerator[Any, None]:
+        """実行枠を確保してストリームを受信し、所要時間・最初のチャンクまでの時間・エラーを記録"""
+        async with self._scheduled(provider, provider_type, formatted_messages, reply_tokens, priority):
+            start = time.perf_counter()
+            ttft = None
+            try:
+                async for item in open_stream():
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                    yield item
+            except Exception as e:
+                self.health.record_error(provider, e)
+                raise
+            self.health.record_success(provider, time.perf_counter() - start, ttft)
+
+    async def probe(self, provider: LLMProvider, timeout: float) -> Tuple[float, Optional[float]]:
+        """小さなリクエストで接続を確認し、(所要時間, 最初のチャンクまでの時間)を返す
+
+        定期的な確認用。ブレーカーが開いていても送信し（回復の確認のため）、結果は呼び出し元が記録する。
+        キューでの待ち時間はタイムアウトに含めない。
+        """
+        provider_type = self._get_provider_type(provider)
+        formatted_messages = [{"role": "user", "content": PROBE_MESSAGE}]
+        adapter = self.adapters.get(provider)
+        
+        async def receive() -> Tuple[float, Optional[float]]:
+            start = time.perf_counter()
+            ttft = None
+            async for _ in adapter.stream(provider.model_name, formatted_messages, PROBE_MAX_TOKENS, 0):
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+            return time.perf_counter() - start, ttft
+        
+        async with self._scheduled(provider, provider_type, formatted_messages, PROBE_MAX_TOKENS, BATCH):
+            return await asyncio.wait_for(receive(), timeout)
+
+    def supports_native_choices(self, provider: LLMProvider) -> bool:
+        """1回のリクエストで複数の候補を生成できるプロバイダーか（OpenAIのnなど）"""
+        return self.adapters.get(provider).native_choices
+
+    async def generate_streaming_choices(
         self,
         provider: LLMProvider,
-        messages: List[Dict[str, str]],
-        max_tokens: int
-    ) -> AsyncGenerator[str, None]:
-        """Google Gemini APIからのストリーミング応答生成"""
-        if not provider.api_key or provider.api_key == "your-api-key-here":
-            raise ValueError(f"Invalid API key for {provider.name}. Please set a valid API key in settings.")
-        
-        genai.configure(api_key=provider.api_key)
-        model = genai.GenerativeModel(provider.model_name)
-        
-        # Gemini用にメッセージを変換
-        conversation_text = ""
-        for msg in messages:
-            role_prefix = "Human: " if msg["role"] == "user" else "Assistant: "
-            conversation_text += f"{role_prefix}{msg['content']}\n\n"
-        
-        conversation_text += "Assistant: "
+        messages: List[MessageResponse],
+        n: int,
+        max_tokens: int = DEFAULT_REPLY_TOKENS,
+        priority: int = INTERACTIVE
+    ) -> AsyncGenerator[Tuple[int, Optional[str]], None]:
+        """n個の候補を1回のリクエストでストリーミング生成（候補の完了時はチャンクがNone）
+
+        別の候補を得るのが目的のため応答キャッシュは使わない。最初のチャンクまでは
+        同じプロバイダーに再試行し、それでも失敗したエラーは呼び出し元に送出する。
+        """
+        provider_type = self._get_provider_type(provider)
+        formatted_messages = _chat_messages(messages)
+        adapter = self.adapters.get(provider)
+        
+        async def open_choices(candidate: LLMProvider):
+            self.health.check(candidate)
+            return await _first_chunk(self._measured_stream(
+                candidate, provider_type, formatted_messages, max_tokens * n, priority,
+                lambda: adapter.stream_choices(
+                    candidate.model_name, formatted_messages, max_tokens, DEFAULT_TEMPERATURE, n
+                )
+            ))
         
-        # Geminiはストリーミングをサポートしていないため、非ストリーミング応答を分割して送信
-        response = await model.generate_content_async(
-            conversation_text,
-            generation_config=genai.types.GenerationConfig(
-                max_output_tokens=max_tokens,
-                temperature=0.7
-            )
+        _, (first_item, stream) = await self.resilience.run(
+            [provider], open_choices, kind="choices", hedge=False
         )
-        
-        # 応答を単語単位で分割してストリーミング風に送信
-        words = response.text.split()
-        for i, word in enumerate(words):
-            if i == 0:
-                yield word
-            else:
-                yield " " + word
-            # 少し遅延を入れてストリーミング感を演出
-            await asyncio.sleep(0.05)
-
-    async def _generate_ollama_streaming_response(
+        try:
+            if first_item is not None:
+                yield first_item
+            async for item in stream:
+                yield item
+        finally:
+            await stream.aclose()
+
+    def _scheduled(
         self,
         provider: LLMProvider,
-        messages: List[Dict[str, str]],
-        max_tokens: int
-    ) -> AsyncGenerator[str, None]:
-        """Ollama APIからのストリーミング応答生成"""
-        # api_urlが設定されているかチェック
-        if not provider.api_url:
-            raise ValueError(f"Ollama provider '{provider.name}' requires a base URL. Please set the base URL in settings (e.g., http://localhost:11434)")
-        
-        # メッセージを単一のプロンプトに変換
-        prompt = ""
-        for msg in messages:
-            if msg["role"] == "user":
-                prompt += f"User: {msg['content']}\n"
-            elif msg["role"] == "assistant":
-                prompt += f"Assistant: {msg['content']}\n"
-            elif msg["role"] == "system":
-                prompt += f"System: {msg['content']}\n"
-        
-        prompt += "Assistant: "
-        
+        provider_type: str,
+        formatted_messages: List[Dict[str, str]],
+        reply_tokens: int,
+        priority: int
+    ):
+        """スケジューラーの実行枠（トークン数は入力の見積もりと応答の上限の合計で数える）"""
+        tokenizer = get_tokenizer(provider_type, provider.model_name)
+        tokens = sum(tokenizer.count_message(message["content"]) for message in formatted_messages) + reply_tokens
+        return self.scheduler.slot(provider, provider_type, tokens, priority)
+
+    def get_tokenizer(self, provider: Optional[LLMProvider]) -> Tokenizer:
+        """プロバイダーとモデルに対応するトークナイザーを取得"""
+        if provider is None:
+            return DEFAULT_TOKENIZER
+        return get_tokenizer(self._get_provider_type_or_none(provider), provider.model_name)
+
+    def get_context_budget(
+        self,
+        provider: Optional[LLMProvider],
+        reply_tokens: int = DEFAULT_REPLY_TOKENS
+    ) -> int:
+        """履歴に使えるトークン数（コンテキストウィンドウから応答分を除いた値）"""
+        if provider is None:
+            return DEFAULT_CONTEXT_BUDGET
+
+        window = get_context_window(self._get_provider_type_or_none(provider), provider.model_name)
+        budget = window - reply_tokens
+        if MAX_CONTEXT_TOKENS:
+            budget = min(budget, MAX_CONTEXT_TOKENS)
+        return max(budget, 0)
+
+    def truncate_messages_for_context(
+        self,
+        messages: List[MessageResponse],
+        max_tokens: Optional[int] = None,
+        provider: Optional[LLMProvider] = None,
+        reply_tokens: int = DEFAULT_REPLY_TOKENS
+    ) -> List[MessageResponse]:
+        """コンテキスト制限に合わせて古いメッセージから切り詰め
+
+        messagesは根から順の祖先チェーン。メッセージに保存された累積トークン数
+        （根からの接頭辞和）が使える場合は二分探索で切り詰め位置を決める。
+        最新のメッセージは上限を超えていても残す。
+        """
+        if not messages:
+            return []
+
+        budget = max_tokens if max_tokens is not None else self.get_context_budget(provider, reply_tokens)
+        tokenizer = self.get_tokenizer(provider)
+
+        first, last = messages[0], messages[-1]
+        if (
+            tokenizer.name == DEFAULT_TOKENIZER.name
+            and first.context_tokens is not None and first.token_count is not None
+            and last.context_tokens is not None
+        ):
+            # 親の累積値が不明なノードの子孫も不明になるため、末尾に値があれば祖先全体に値がある
+            # （先頭が要約ノードの場合は値がないため数え直す）
+            threshold = last.context_tokens - budget
+            start = bisect_left(
+                messages,
+                threshold,
+                hi=len(messages) - 1,
+                key=lambda message: message.context_tokens - message.token_count
+            )
+            return messages[start:]
+
+        # 保存値が使えない場合はこのトークナイザーで数えて接頭辞和を作る
+        prefix_sums = [0, *accumulate(tokenizer.count_message(message.content) for message in messages)]
+        start = bisect_left(prefix_sums, prefix_sums[-1] - budget, hi=len(messages) - 1)
+        return messages[start:]
+
+    def _get_provider_type_or_none(self, provider: LLMProvider) -> Optional[str]:
         try:
-            async with httpx.AsyncClient() as client:
-                async with client.stream(
-                    "POST",
-                    f"{provider.api_url}/api/generate",
-                    json={
-                        "model": provider.model_name,
-                        "prompt": prompt,
-                        "stream": True,
-                        "options": {
-                            "num_predict": max_tokens,
-                            "temperature": 0.7
-                        }
-                    },
-                    timeout=60.0
-                ) as response:
-                    response.raise_for_status()
-                    
-                    async for line in response.aiter_lines():
-                        if line.strip():
-                            try:
-                                data = json.loads(line)
-                                if "response" in data:
-                                    yield data["response"]
-                                if data.get("done", False):
-                                    break
-                            except json.JSONDecodeError:
-                                continue
-                                
-        except httpx.ConnectError:
-            raise ValueError(f"Cannot connect to Ollama server at {provider.api_url}. Please ensure Ollama is running and accessible.")
-        except httpx.TimeoutException:
-            raise ValueError(f"Timeout connecting to Ollama server at {provider.api_url}. The request took too long.")
-        except httpx.HTTPStatusError as e:
-            if e.response.status_code == 404:
-                raise ValueError(f"Model '{provider.model_name}' not found on Ollama server. Please check if the model is installed.")
-            else:
-                raise ValueError(f"Ollama server error (HTTP {e.response.status_code}): {e.response.text}")
+            return self._get_provider_type(provider)
+        except ValueError:
+            return None
 
 
 # グローバルインスタンス
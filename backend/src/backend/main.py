@@ -3,16 +3,36 @@ from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 import uvicorn
 
-from .database import init_db
+from .database import AsyncSessionLocal, init_db
+from .cache import history_cache
+from .health import provider_health
+from .response_cache import response_cache
+from .llm_service import llm_service
+from .provider_registry import provider_registry
+from .scheduler import request_scheduler
 from .routers import chat, conversations, providers, websocket_chat
 
 
+async def load_providers():
+    """定期的な確認の対象（登録されている全プロバイダー）"""
+    async with AsyncSessionLocal() as db:
+        return await provider_registry.list_providers(db)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # アプリケーション起動時
     await init_db()
+    # アクティブなプロバイダーとクライアントを最初のメッセージの前に用意
+    async with AsyncSessionLocal() as db:
+        await provider_registry.get_active(db)
+    # 全プロバイダーの状態を定期的に確認
+    provider_health.start(load_providers, llm_service.probe)
     yield
-    # アプリケーション終了時（必要に応じて）
+    # アプリケーション終了時
+    await provider_health.stop()
+    await llm_service.aclose()
+    response_cache.close()
 
 
 app = FastAPI(
@@ -29,6 +49,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 # ルーターの登録
@@ -48,6 +69,42 @@ async def health_check():
     return {"status": "healthy"}
 
 
+@app.get("/health/cache")
+async def cache_stats():
+    """履歴・ツリーキャッシュの統計情報"""
+    return history_cache.stats()
+
+
+@app.get("/health/response-cache")
+async def response_cache_stats():
+    """LLM応答キャッシュの統計情報"""
+    return response_cache.stats()
+
+
+@app.get("/health/providers")
+async def provider_registry_stats():
+    """アクティブプロバイダーのキャッシュの統計情報"""
+    return provider_registry.stats()
+
+
+@app.get("/health/scheduler")
+async def scheduler_stats():
+    """プロバイダーごとの送信キューの統計情報（実行中・待機中の数と待ち時間）"""
+    return request_scheduler.stats()
+
+
+@app.get("/health/resilience")
+async def resilience_stats():
+    """再試行・フェイルオーバー・ヘッジの回数"""
+    return llm_service.resilience.stats()
+
+
+@app.get("/health/inflight")
+async def inflight_stats():
+    """実行中の生成と、同じ生成を共有したリクエストの数"""
+    return llm_service.flights.stats()
+
+
 if __name__ == "__main__":
     uvicorn.run(
         "backend.main:app",
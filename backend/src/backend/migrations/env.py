@@ -0,0 +1,60 @@
+from logging.config import fileConfig
+
+from alembic import context
+
+from backend.models import Base
+
+config = context.config
+
+# alembic.ini から実行された場合のみログ設定を読み込む
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+target_metadata = Base.metadata
+
+
+def run_migrations_offline():
+    """SQLスクリプトを出力するオフラインモード"""
+    from backend.database import SYNC_DATABASE_URL
+
+    context.configure(
+        url=SYNC_DATABASE_URL,
+        target_metadata=target_metadata,
+        literal_binds=True,
+        render_as_batch=True,
+    )
+
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    """データベースに接続してマイグレーションを実行"""
+    # アプリ起動時（init_db）は既存の接続が渡される
+    connection = config.attributes.get("connection")
+
+    if connection is None:
+        from backend.database import get_sync_engine
+
+        with get_sync_engine().connect() as connection:
+            _run(connection)
+            connection.commit()
+    else:
+        _run(connection)
+
+
+def _run(connection):
+    context.configure(
+        connection=connection,
+        target_metadata=target_metadata,
+        # SQLiteのALTER TABLE制限に対応
+        render_as_batch=True,
+    )
+
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
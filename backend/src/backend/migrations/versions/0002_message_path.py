@@ -0,0 +1,94 @@
+"""materialized path for message ancestry
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0002'
+down_revision: Union[str, Sequence[str], None] = '0001'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# models.PATH_SEGMENT_WIDTH と同じ値（マイグレーションはモデルの変更に依存させない）
+PATH_SEGMENT_WIDTH = 10
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    columns = {column['name'] for column in sa.inspect(bind).get_columns('messages')}
+
+    # create_allで作成済みのDBではカラムが既に存在する
+    if 'path' not in columns:
+        with op.batch_alter_table('messages') as batch_op:
+            batch_op.add_column(sa.Column('path', sa.Text(), nullable=True))
+            batch_op.add_column(sa.Column('depth', sa.Integer(), nullable=True))
+            batch_op.create_index('ix_messages_path', ['path'])
+
+    backfill_paths(bind)
+
+
+def backfill_paths(bind) -> None:
+    """既存メッセージのパスと深さをparent_idから計算して設定"""
+    messages = sa.table(
+        'messages',
+        sa.column('id', sa.Integer),
+        sa.column('parent_id', sa.Integer),
+        sa.column('path', sa.Text),
+        sa.column('depth', sa.Integer),
+    )
+
+    rows = bind.execute(
+        sa.select(messages.c.id, messages.c.parent_id, messages.c.path, messages.c.depth)
+    ).all()
+    parents = {row.id: row.parent_id for row in rows}
+    paths = {row.id: (row.path, row.depth) for row in rows if row.path is not None}
+
+    def resolve(message_id):
+        # パスが確定している祖先まで遡ってから根側から順に計算する（再帰を使わない）
+        chain = []
+        current = message_id
+        while current is not None and current not in paths:
+            chain.append(current)
+            parent_id = parents[current]
+            # 存在しない親を指すノードはrootとして扱う
+            current = parent_id if parent_id in parents else None
+
+        for node in reversed(chain):
+            parent_id = parents[node]
+            if parent_id in paths:
+                parent_path, parent_depth = paths[parent_id]
+                paths[node] = (parent_path + str(parent_id).zfill(PATH_SEGMENT_WIDTH), parent_depth + 1)
+            else:
+                paths[node] = ('', 0)
+
+    updates = []
+    for row in rows:
+        if row.path is None:
+            resolve(row.id)
+            path, depth = paths[row.id]
+            updates.append({'message_id': row.id, 'new_path': path, 'new_depth': depth})
+
+    if updates:
+        bind.execute(
+            messages.update()
+            .where(messages.c.id == sa.bindparam('message_id'))
+            .values(path=sa.bindparam('new_path'), depth=sa.bindparam('new_depth')),
+            updates,
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.drop_index('ix_messages_path')
+        batch_op.drop_column('depth')
+        batch_op.drop_column('path')
@@ -0,0 +1,48 @@
+"""conversation version for incremental tree sync
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0003'
+down_revision: Union[str, Sequence[str], None] = '0002'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    inspector = sa.inspect(op.get_bind())
+    conversation_columns = {column['name'] for column in inspector.get_columns('conversations')}
+    message_columns = {column['name'] for column in inspector.get_columns('messages')}
+
+    # create_allで作成済みのDBではカラムが既に存在する
+    if 'version' not in conversation_columns:
+        with op.batch_alter_table('conversations') as batch_op:
+            batch_op.add_column(sa.Column('version', sa.Integer(), nullable=False, server_default='0'))
+
+    if 'version' not in message_columns:
+        with op.batch_alter_table('messages') as batch_op:
+            batch_op.add_column(sa.Column('version', sa.Integer(), nullable=True))
+            batch_op.create_index('ix_messages_conversation_version', ['conversation_id', 'version'])
+
+    # 既存メッセージは版数0（差分同期の起点より前）として扱う
+    op.execute("UPDATE messages SET version = 0 WHERE version IS NULL")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.drop_index('ix_messages_conversation_version')
+        batch_op.drop_column('version')
+
+    with op.batch_alter_table('conversations') as batch_op:
+        batch_op.drop_column('version')
@@ -0,0 +1,58 @@
+"""denormalized conversation summary for the sidebar
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0004'
+down_revision: Union[str, Sequence[str], None] = '0003'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# models.SUMMARY_PREVIEW_LENGTH と同じ値
+SUMMARY_PREVIEW_LENGTH = 100
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    inspector = sa.inspect(op.get_bind())
+    columns = {column['name'] for column in inspector.get_columns('conversations')}
+    indexes = {index['name'] for index in inspector.get_indexes('conversations')}
+
+    # create_allで作成済みのDBではカラムが既に存在する
+    with op.batch_alter_table('conversations') as batch_op:
+        if 'message_count' not in columns:
+            batch_op.add_column(sa.Column('message_count', sa.Integer(), nullable=False, server_default='0'))
+        if 'last_message_preview' not in columns:
+            batch_op.add_column(sa.Column('last_message_preview', sa.String(length=SUMMARY_PREVIEW_LENGTH), nullable=True))
+        if 'last_activity_at' not in columns:
+            batch_op.add_column(sa.Column('last_activity_at', sa.DateTime(), nullable=True))
+        if 'ix_conversations_updated_at_id' not in indexes:
+            batch_op.create_index('ix_conversations_updated_at_id', ['updated_at', 'id'])
+
+    # 既存の会話のサマリーを集計
+    op.execute(
+        "UPDATE conversations SET "
+        "message_count = (SELECT COUNT(*) FROM messages m WHERE m.conversation_id = conversations.id), "
+        "last_activity_at = (SELECT MAX(m.created_at) FROM messages m WHERE m.conversation_id = conversations.id), "
+        f"last_message_preview = (SELECT SUBSTR(m.content, 1, {SUMMARY_PREVIEW_LENGTH}) FROM messages m "
+        "WHERE m.conversation_id = conversations.id ORDER BY m.created_at DESC, m.id DESC LIMIT 1)"
+    )
+    op.execute("UPDATE conversations SET updated_at = created_at WHERE updated_at IS NULL")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('conversations') as batch_op:
+        batch_op.drop_index('ix_conversations_updated_at_id')
+        batch_op.drop_column('last_activity_at')
+        batch_op.drop_column('last_message_preview')
+        batch_op.drop_column('message_count')
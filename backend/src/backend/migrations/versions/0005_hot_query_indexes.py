@@ -0,0 +1,41 @@
+"""indexes for hot message queries
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0005'
+down_revision: Union[str, Sequence[str], None] = '0004'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+INDEXES = [
+    # 会話単位のメッセージ一覧（created_at順）とconversation_idでの絞り込み
+    ('ix_messages_conversation_created_at', ['conversation_id', 'created_at']),
+    # 子ノードの検索・子の数の集計
+    ('ix_messages_parent_id', ['parent_id']),
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    existing = {index['name'] for index in sa.inspect(op.get_bind()).get_indexes('messages')}
+
+    for name, columns in INDEXES:
+        # create_allで作成済みのDBではインデックスが既に存在する
+        if name not in existing:
+            op.create_index(name, 'messages', columns)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for name, _ in reversed(INDEXES):
+        op.drop_index(name, table_name='messages')
@@ -0,0 +1,102 @@
+"""per-message token counts for context budgeting
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+from typing import Sequence, Union
+import math
+import re
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0006'
+down_revision: Union[str, Sequence[str], None] = '0005'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# tokenizer.DEFAULT_TOKENIZER（heuristic-v1）の移行時点の規則
+# （マイグレーションはアプリのコードに依存させない。トークナイザーを変えてもこの値は変えない）
+_CJK_PATTERN = re.compile(
+    r"[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]"
+)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def count_message_tokens(content: str) -> int:
+    """1メッセージ分のトークン数の見積もり（区切りのオーバーヘッドを含む）"""
+    tokens = 0
+    if content:
+        ascii_chars = len(content.encode('ascii', 'ignore'))
+        cjk_chars = len(_CJK_PATTERN.findall(content))
+        other_chars = len(content) - ascii_chars - cjk_chars
+        tokens = math.ceil(ascii_chars / 4.0 + cjk_chars * 1.0 + other_chars * 0.5)
+    return tokens + MESSAGE_OVERHEAD_TOKENS
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    columns = {column['name'] for column in sa.inspect(bind).get_columns('messages')}
+
+    # create_allで作成済みのDBではカラムが既に存在する
+    if 'token_count' not in columns:
+        with op.batch_alter_table('messages') as batch_op:
+            batch_op.add_column(sa.Column('token_count', sa.Integer(), nullable=True))
+            batch_op.add_column(sa.Column('context_tokens', sa.Integer(), nullable=True))
+
+    backfill_token_counts(bind)
+
+
+def backfill_token_counts(bind) -> None:
+    """既存メッセージのトークン数と累積トークン数を設定（パスの浅い順に親の累積値へ加算）"""
+    messages = sa.table(
+        'messages',
+        sa.column('id', sa.Integer),
+        sa.column('parent_id', sa.Integer),
+        sa.column('content', sa.Text),
+        sa.column('depth', sa.Integer),
+        sa.column('token_count', sa.Integer),
+        sa.column('context_tokens', sa.Integer),
+    )
+
+    rows = bind.execute(
+        sa.select(
+            messages.c.id,
+            messages.c.parent_id,
+            messages.c.content,
+            messages.c.token_count,
+            messages.c.context_tokens,
+        ).order_by(messages.c.depth, messages.c.id)
+    ).all()
+    context = {row.id: row.context_tokens for row in rows if row.context_tokens is not None}
+
+    updates = []
+    for row in rows:
+        if row.context_tokens is not None:
+            continue
+        token_count = row.token_count
+        if token_count is None:
+            token_count = count_message_tokens(row.content)
+        # 存在しない親を指すノードはrootとして扱う（パスのバックフィルと同じ）
+        context[row.id] = context.get(row.parent_id, 0) + token_count
+        updates.append({'message_id': row.id, 'new_count': token_count, 'new_context': context[row.id]})
+
+    if updates:
+        bind.execute(
+            messages.update()
+            .where(messages.c.id == sa.bindparam('message_id'))
+            .values(token_count=sa.bindparam('new_count'), context_tokens=sa.bindparam('new_context')),
+            updates,
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.drop_column('context_tokens')
+        batch_op.drop_column('token_count')
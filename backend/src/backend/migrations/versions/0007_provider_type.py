@@ -0,0 +1,77 @@
+"""explicit adapter type on llm_providers
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+from typing import Optional, Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0007'
+down_revision: Union[str, Sequence[str], None] = '0006'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def infer_provider_type(name: str, model_name: str) -> Optional[str]:
+    """移行前の名前・モデル名による判定（provider_adapters.infer_provider_type と同じ規則）"""
+    name_lower = (name or '').lower()
+    model_lower = (model_name or '').lower()
+
+    if 'openai' in name_lower or 'gpt' in name_lower or 'azure' in name_lower:
+        return 'openai'
+    if 'anthropic' in name_lower or 'claude' in name_lower:
+        return 'anthropic'
+    if 'gemini' in name_lower or 'google' in name_lower:
+        return 'gemini'
+    if 'ollama' in name_lower:
+        return 'ollama'
+    if 'gpt' in model_lower:
+        return 'openai'
+    if 'claude' in model_lower:
+        return 'anthropic'
+    if 'gemini' in model_lower:
+        return 'gemini'
+    if 'llama' in model_lower or 'qwen' in model_lower:
+        return 'ollama'
+    return None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    columns = {column['name'] for column in sa.inspect(bind).get_columns('llm_providers')}
+
+    # create_allで作成済みのDBではカラムが既に存在する
+    if 'provider_type' not in columns:
+        with op.batch_alter_table('llm_providers') as batch_op:
+            batch_op.add_column(sa.Column('provider_type', sa.String(length=20), nullable=True))
+
+    providers = sa.table(
+        'llm_providers',
+        sa.column('id', sa.Integer),
+        sa.column('name', sa.String),
+        sa.column('model_name', sa.String),
+        sa.column('provider_type', sa.String),
+    )
+    rows = bind.execute(
+        sa.select(providers.c.id, providers.c.name, providers.c.model_name)
+        .where(providers.c.provider_type.is_(None))
+    ).all()
+    for row in rows:
+        provider_type = infer_provider_type(row.name, row.model_name)
+        if provider_type is not None:
+            bind.execute(
+                providers.update().where(providers.c.id == row.id).values(provider_type=provider_type)
+            )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('llm_providers') as batch_op:
+        batch_op.drop_column('provider_type')
@@ -0,0 +1,45 @@
+"""fallback provider chain and the provider that answered each message
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0008'
+down_revision: Union[str, Sequence[str], None] = '0007'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    provider_columns = {column['name'] for column in sa.inspect(bind).get_columns('llm_providers')}
+    message_columns = {column['name'] for column in sa.inspect(bind).get_columns('messages')}
+
+    # create_allで作成済みのDBではカラムが既に存在する
+    if 'fallback_provider_id' not in provider_columns:
+        with op.batch_alter_table('llm_providers') as batch_op:
+            batch_op.add_column(sa.Column('fallback_provider_id', sa.Integer(), nullable=True))
+
+    with op.batch_alter_table('messages') as batch_op:
+        if 'provider_name' not in message_columns:
+            batch_op.add_column(sa.Column('provider_name', sa.String(length=50), nullable=True))
+        if 'model_name' not in message_columns:
+            batch_op.add_column(sa.Column('model_name', sa.String(length=100), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.drop_column('model_name')
+        batch_op.drop_column('provider_name')
+    with op.batch_alter_table('llm_providers') as batch_op:
+        batch_op.drop_column('fallback_provider_id')
@@ -1,10 +1,36 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Boolean, Index, event, inspect, select, update
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime, timezone
+from typing import List
+
+from .tokenizer import DEFAULT_TOKENIZER
 
 Base = declarative_base()
 
+# マテリアライズドパスの1セグメント（ゼロ埋めしたメッセージID）の桁数
+PATH_SEGMENT_WIDTH = 10
+
+# 会話サマリーに保持する最新メッセージのプレビュー文字数
+SUMMARY_PREVIEW_LENGTH = 100
+
+
+def path_segment(message_id: int) -> str:
+    """メッセージIDをパスのセグメントに変換"""
+    return str(message_id).zfill(PATH_SEGMENT_WIDTH)
+
+
+def next_path_prefix(prefix: str) -> str:
+    """数字のみからなるプレフィックスの直後の値（範囲検索の上限）を返す"""
+    digits = list(prefix)
+    for i in range(len(digits) - 1, -1, -1):
+        if digits[i] != "9":
+            digits[i] = str(int(digits[i]) + 1)
+            return "".join(digits)
+        digits[i] = "0"
+    # 全桁が9の場合は1桁長い値が上限になる
+    return "1" + "".join(digits)
+
 
 class Conversation(Base):
     """会話セッション"""
@@ -14,6 +40,16 @@ class Conversation(Base):
     title = Column(String(255), nullable=False)
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
     updated_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+    # 変更のたびに増える版数（差分同期用）
+    version = Column(Integer, nullable=False, default=0, server_default="0")
+    # サイドバー用のサマリー（メッセージ追加時に更新）
+    message_count = Column(Integer, nullable=False, default=0, server_default="0")
+    last_message_preview = Column(String(SUMMARY_PREVIEW_LENGTH), nullable=True)
+    last_activity_at = Column(DateTime, nullable=True)
+    
+    __table_args__ = (
+        Index("ix_conversations_updated_at_id", "updated_at", "id"),
+    )
     
     # リレーション
     messages = relationship("Message", back_populates="conversation", cascade="all, delete-orphan")
@@ -29,11 +65,141 @@ class Message(Base):
     role = Column(String(20), nullable=False)  # "user", "assistant", "system"
     content = Column(Text, nullable=False)
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    # 祖先IDを根から順に連結したマテリアライズドパス（自身は含まない、rootは空文字）
+    path = Column(Text, nullable=True, index=True)
+    depth = Column(Integer, nullable=True)  # rootが0
+    # 最後に追加・変更されたときの会話の版数
+    version = Column(Integer, nullable=True)
+    # 本文のトークン数（DEFAULT_TOKENIZERによる）と、根から自身までの累積トークン数
+    token_count = Column(Integer, nullable=True)
+    context_tokens = Column(Integer, nullable=True)
+    # 応答を生成したプロバイダー（フェイルオーバー時は代替先、プロバイダー削除後も残すため名前で保持）
+    provider_name = Column(String(50), nullable=True)
+    model_name = Column(String(100), nullable=True)
+    
+    __table_args__ = (
+        Index("ix_messages_conversation_created_at", "conversation_id", "created_at"),
+        Index("ix_messages_conversation_version", "conversation_id", "version"),
+        Index("ix_messages_parent_id", "parent_id"),
+    )
     
     # リレーション
     conversation = relationship("Conversation", back_populates="messages")
     parent = relationship("Message", remote_side=[id], backref="children")
 
+    @property
+    def ancestor_ids(self) -> List[int]:
+        """祖先IDのリスト（根から順）"""
+        return [
+            int(self.path[i:i + PATH_SEGMENT_WIDTH])
+            for i in range(0, len(self.path or ""), PATH_SEGMENT_WIDTH)
+        ]
+
+    @property
+    def subtree_path(self) -> str:
+        """子孫ノードのパスが共通して持つプレフィックス"""
+        return (self.path or "") + path_segment(self.id)
+
+
+@event.listens_for(Message, "before_insert")
+def assign_message_path(mapper, connection, target: Message):
+    """挿入時に親のパスからマテリアライズドパスと累積トークン数を設定"""
+    if target.token_count is None:
+        target.token_count = DEFAULT_TOKENIZER.count_message(target.content)
+
+    if target.path is not None:
+        return
+
+    if target.parent_id is None:
+        target.path = ""
+        target.depth = 0
+        target.context_tokens = target.token_count
+        return
+
+    parent = connection.execute(
+        select(Message.path, Message.depth, Message.context_tokens).where(Message.id == target.parent_id)
+    ).one_or_none()
+
+    if parent is None or parent.path is None:
+        # 親が存在しない場合はrootとして扱う（従来の履歴取得と同じ挙動）
+        target.path = ""
+        target.depth = 0
+        target.context_tokens = target.token_count
+        return
+
+    target.path = parent.path + path_segment(target.parent_id)
+    target.depth = parent.depth + 1
+    # 親の累積値が不明な場合は子孫も不明のままにする（切り詰め時に数え直す）
+    if parent.context_tokens is not None:
+        target.context_tokens = parent.context_tokens + target.token_count
+
+
+def bump_conversation_version(connection, conversation_id: int, **values) -> int:
+    """会話の版数をDB上で1つ進め、新しい版数を返す（valuesで他のカラムも同時に更新）"""
+    return connection.execute(
+        update(Conversation)
+        .where(Conversation.id == conversation_id)
+        .values(version=Conversation.version + 1, **values)
+        .returning(Conversation.version)
+    ).scalar_one()
+
+
+@event.listens_for(Message, "before_insert")
+def assign_message_version(mapper, connection, target: Message):
+    """メッセージ追加時に会話の版数とサマリーを更新"""
+    if target.created_at is None:
+        target.created_at = datetime.now(timezone.utc)
+
+    target.version = bump_conversation_version(
+        connection,
+        target.conversation_id,
+        message_count=Conversation.message_count + 1,
+        last_message_preview=target.content[:SUMMARY_PREVIEW_LENGTH],
+        last_activity_at=target.created_at,
+        updated_at=target.created_at
+    )
+
+
+def update_token_counts(connection, target: Message):
+    """本文の変更に合わせてトークン数を更新し、自身と子孫の累積トークン数をずらす"""
+    token_count = DEFAULT_TOKENIZER.count_message(target.content)
+    delta = token_count - (target.token_count or 0)
+    target.token_count = token_count
+
+    if target.context_tokens is None or delta == 0:
+        return
+
+    target.context_tokens += delta
+    if target.path is not None and target.id is not None:
+        prefix = target.subtree_path
+        connection.execute(
+            update(Message)
+            .where(Message.path >= prefix, Message.path < next_path_prefix(prefix))
+            .values(context_tokens=Message.context_tokens + delta)
+        )
+
+
+@event.listens_for(Message, "before_update")
+def update_message_version(mapper, connection, target: Message):
+    """本文の変更（再生成など）時に会話の版数を進める"""
+    if inspect(target).attrs.content.history.has_changes():
+        update_token_counts(connection, target)
+        now = datetime.now(timezone.utc)
+        target.version = bump_conversation_version(
+            connection,
+            target.conversation_id,
+            last_message_preview=target.content[:SUMMARY_PREVIEW_LENGTH],
+            last_activity_at=now,
+            updated_at=now
+        )
+
+
+@event.listens_for(Conversation, "before_update")
+def update_conversation_version(mapper, connection, target: Conversation):
+    """タイトル変更時に会話の版数を進める"""
+    if inspect(target).attrs.title.history.has_changes():
+        target.version = bump_conversation_version(connection, target.id)
+
 
 class LLMProvider(Base):
     """LLMプロバイダー設定"""
@@ -41,9 +207,11 @@ class LLMProvider(Base):
     
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(50), nullable=False, unique=True)  # "openai", "gemini", "claude", etc.
+    provider_type = Column(String(20), nullable=True)  # アダプターの種類（"openai", "anthropic", "gemini", "ollama"）
     api_key = Column(String(255), nullable=True)
     api_url = Column(String(255), nullable=True)  # Ollamaなど用
     model_name = Column(String(100), nullable=False)
+    fallback_provider_id = Column(Integer, nullable=True)  # 失敗時に切り替えるプロバイダー（削除時はNULLにする）
     is_active = Column(Boolean, default=False)
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
     updated_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
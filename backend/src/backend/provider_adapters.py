@@ -0,0 +1,559 @@
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, AsyncGenerator, Dict, List, Optional, Set, Tuple, Type
+import asyncio
+import json
+import os
+
+import httpx
+from dotenv import load_dotenv
+
+from .models import LLMProvider
+
+# 各SDKは読み込みに時間がかかるため、そのアダプターを初めて使うときにimportする
+if TYPE_CHECKING:
+    import anthropic
+    import openai
+    from google.ai import generativelanguage as glm
+
+load_dotenv()
+
+# OllamaへのHTTP接続プールとタイムアウト（秒）
+OLLAMA_MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", "20"))
+OLLAMA_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OLLAMA_MAX_KEEPALIVE_CONNECTIONS", "10"))
+OLLAMA_KEEPALIVE_EXPIRY = float(os.getenv("OLLAMA_KEEPALIVE_EXPIRY", "30"))
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "5"))
+OLLAMA_READ_TIMEOUT = float(os.getenv("OLLAMA_READ_TIMEOUT", "60"))
+# 1リクエスト全体（ストリーミングでは最後のチャンクまで）の上限
+OLLAMA_TOTAL_TIMEOUT = float(os.getenv("OLLAMA_TOTAL_TIMEOUT", "300"))
+
+PLACEHOLDER_API_KEY = "your-api-key-here"
+
+
+class TransientProviderError(ValueError):
+    """時間をおけば成功する可能性があるエラー（接続失敗・タイムアウト・過負荷など）"""
+
+# 設定変更で置き換えたアダプターを閉じるまでの猶予（実行中のリクエストを完了させるため）
+RETIRED_ADAPTER_CLOSE_DELAY = 300.0
+
+
+class ProviderAdapter(ABC):
+    """LLMプロバイダーとの通信を抽象化するアダプター
+
+    プロバイダー設定（APIキー・URL）ごとに1つ作られ、SDKのクライアントや
+    接続プールを保持する。実装するのはストリーミングのstreamのみで、
+    非ストリーミングのgenerateと複数候補のstream_choicesはstreamから導出する。
+    """
+
+    provider_type = ""
+    # 1回のリクエストで複数の候補を生成できるか（stream_choicesを独自に実装しているか）
+    native_choices = False
+
+    def __init__(
+        self,
+        api_key: Optional[str],
+        api_url: Optional[str],
+        http_clients: Optional["OllamaClientPool"] = None
+    ):
+        self.api_key = api_key
+        self.api_url = api_url
+        # 同じサーバーを指すプロバイダー間で共有するHTTPクライアント（AdapterRegistryが渡す）
+        self.http_clients = http_clients
+
+    @abstractmethod
+    def stream(
+        self,
+        model_name: str,
+        messages: List[Dict[str, str]],
+        max_tokens: int,
+        temperature: float
+    ) -> AsyncGenerator[str, None]:
+        """応答をチャンクごとに返す"""
+
+    async def generate(
+        self,
+        model_name: str,
+        messages: List[Dict[str, str]],
+        max_tokens: int,
+        temperature: float
+    ) -> str:
+        """応答全体を返す（streamのチャンクを連結）"""
+        chunks = []
+        async for chunk in self.stream(model_name, messages, max_tokens, temperature):
+            chunks.append(chunk)
+        return "".join(chunks)
+
+    async def stream_choices(
+        self,
+        model_name: str,
+        messages: List[Dict[str, str]],
+        max_tokens: int,
+        temperature: float,
+        n: int
+    ) -> AsyncGenerator[Tuple[int, Optional[str]], None]:
+        """n個の候補を生成し、(候補番号, チャンク)を返す（候補の完了時はチャンクがNone）
+
+        既定ではstreamをn個並行して呼ぶ。1回のリクエストで生成できるプロバイダーは上書きする。
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+
+        async def pump(index: int):
+            try:
+                async for chunk in self.stream(model_name, messages, max_tokens, temperature):
+                    queue.put_nowait((index, chunk, None))
+                queue.put_nowait((index, None, None))
+            except Exception as e:
+                queue.put_nowait((index, None, e))
+
+        tasks = [asyncio.create_task(pump(index)) for index in range(n)]
+        try:
+            remaining = n
+            while remaining:
+                index, chunk, error = await queue.get()
+                if error is not None:
+                    raise error
+                if chunk is None:
+                    remaining -= 1
+                yield index, chunk
+        finally:
+            # 途中で失敗・中断した場合は残りの候補の生成を止める
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def warm(self):
+        """SDKのクライアントや接続プールを事前に作成（最初のリクエストでの作成を避ける）"""
+
+    async def aclose(self):
+        """保持しているクライアントを閉じる"""
+
+    def _require_api_key(self, provider_name: str):
+        if not self.api_key or self.api_key == PLACEHOLDER_API_KEY:
+            raise ValueError(f"Invalid API key for {provider_name}. Please set a valid API key in settings.")
+
+
+# プロバイダー種別 → アダプタークラス
+ADAPTERS: Dict[str, Type[ProviderAdapter]] = {}
+
+
+def register_adapter(cls: Type[ProviderAdapter]) -> Type[ProviderAdapter]:
+    """アダプタークラスを登録（クラスデコレーター）"""
+    ADAPTERS[cls.provider_type] = cls
+    return cls
+
+
+def infer_provider_type(name: str, model_name: str) -> Optional[str]:
+    """プロバイダー名やモデル名から種別を推定（provider_type未設定の既存データ用）"""
+    name_lower = (name or "").lower()
+
+    if "openai" in name_lower or "gpt" in name_lower:
+        return "openai"
+    elif "azure" in name_lower:
+        return "openai"  # Azure OpenAI は OpenAI API と同じ
+    elif "anthropic" in name_lower or "claude" in name_lower:
+        return "anthropic"
+    elif "gemini" in name_lower or "google" in name_lower:
+        return "gemini"
+    elif "ollama" in name_lower:
+        return "ollama"
+
+    # モデル名からも判定を試行
+    model_lower = (model_name or "").lower()
+    if "gpt" in model_lower:
+        return "openai"
+    elif "claude" in model_lower:
+        return "anthropic"
+    elif "gemini" in model_lower:
+        return "gemini"
+    elif "llama" in model_lower or "qwen" in model_lower:
+        return "ollama"
+    return None
+
+
+def resolve_provider_type(provider: LLMProvider) -> str:
+    """プロバイダーの種別（保存された値を優先し、なければ推定）"""
+    provider_type = provider.provider_type or infer_provider_type(provider.name, provider.model_name)
+    if provider_type is None:
+        raise ValueError(f"Cannot determine provider type for: {provider.name} with model: {provider.model_name}")
+    if provider_type not in ADAPTERS:
+        raise ValueError(f"Unsupported provider type: {provider_type}")
+    return provider_type
+
+
+class OllamaClientPool:
+    """ベースURLごとに共有するHTTPクライアント
+
+    同じOllamaサーバーを指す複数のプロバイダーで1つの接続プールを使うため、
+    OLLAMA_MAX_CONNECTIONSはサーバーごとの上限になる。
+    """
+
+    def __init__(self):
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+
+    def get(self, base_url: str) -> httpx.AsyncClient:
+        base_url = base_url.rstrip("/")
+        client = self._clients.get(base_url)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                base_url=base_url,
+                limits=httpx.Limits(
+                    max_connections=OLLAMA_MAX_CONNECTIONS,
+                    max_keepalive_connections=OLLAMA_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=OLLAMA_KEEPALIVE_EXPIRY
+                ),
+                timeout=httpx.Timeout(
+                    connect=OLLAMA_CONNECT_TIMEOUT,
+                    read=OLLAMA_READ_TIMEOUT,
+                    write=OLLAMA_READ_TIMEOUT,
+                    pool=OLLAMA_CONNECT_TIMEOUT
+                )
+            )
+            self._clients[base_url] = client
+        return client
+
+    async def aclose(self):
+        clients = list(self._clients.values())
+        self._clients.clear()
+        for client in clients:
+            await client.aclose()
+
+
+class AdapterRegistry:
+    """プロバイダーごとのアダプターを保持し、設定が変わったら作り直す"""
+
+    def __init__(self):
+        self._adapters: Dict[object, Tuple[Tuple, ProviderAdapter]] = {}
+        self.http_clients = OllamaClientPool()
+        # 設定変更で置き換え、閉じるのを待っているアダプターと閉じている途中のタスク
+        self._retired: Dict[ProviderAdapter, asyncio.TimerHandle] = {}
+        self._closing: Set[asyncio.Task] = set()
+
+    def get(self, provider: LLMProvider) -> ProviderAdapter:
+        provider_type = resolve_provider_type(provider)
+        key = provider.id if provider.id is not None else provider.name
+        fingerprint = (provider_type, provider.api_key, provider.api_url)
+
+        entry = self._adapters.get(key)
+        if entry is not None and entry[0] == fingerprint:
+            return entry[1]
+
+        adapter = ADAPTERS[provider_type](provider.api_key, provider.api_url, self.http_clients)
+        self._adapters[key] = (fingerprint, adapter)
+        if entry is not None:
+            # APIキーやURLが変わった場合は古いクライアントを閉じる
+            self._close_later(entry[1])
+        return adapter
+
+    async def aclose(self):
+        """全アダプター（閉じるのを待っているものを含む）と共有しているHTTPクライアントを閉じる"""
+        adapters = [adapter for _, adapter in self._adapters.values()]
+        self._adapters.clear()
+        for adapter, handle in self._retired.items():
+            handle.cancel()
+            adapters.append(adapter)
+        self._retired.clear()
+
+        for adapter in adapters:
+            await adapter.aclose()
+        await asyncio.gather(*self._closing, return_exceptions=True)
+        await self.http_clients.aclose()
+
+    def _close_later(self, adapter: ProviderAdapter):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        # 古いアダプターで実行中のリクエストが終わるのを待ってから閉じる
+        self._retired[adapter] = loop.call_later(RETIRED_ADAPTER_CLOSE_DELAY, self._close_retired, adapter)
+
+    def _close_retired(self, adapter: ProviderAdapter):
+        if self._retired.pop(adapter, None) is None:
+            return
+        # 参照を持っておかないとタスクが完了前に破棄されることがある
+        task = asyncio.get_running_loop().create_task(adapter.aclose())
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+
+def _split_system_message(messages: List[Dict[str, str]]) -> Tuple[str, List[Dict[str, str]]]:
+    """systemメッセージを分離（複数ある場合は連結）"""
+    system_parts = []
+    other_messages = []
+    for msg in messages:
+        if msg["role"] == "system":
+            system_parts.append(msg["content"])
+        else:
+            other_messages.append(msg)
+    return "\n\n".join(system_parts), other_messages
+
+
+@register_adapter
+class OpenAIAdapter(ProviderAdapter):
+    """OpenAI / Azure OpenAI / OpenAI互換API"""
+
+    provider_type = "openai"
+    native_choices = True
+
+    def __init__(
+        self,
+        api_key: Optional[str],
+        api_url: Optional[str],
+        http_clients: Optional[OllamaClientPool] = None
+    ):
+        super().__init__(api_key, api_url, http_clients)
+        self._client: Optional["openai.AsyncOpenAI"] = None
+
+    def _get_client(self) -> "openai.AsyncOpenAI":
+        if self._client is None:
+            self._require_api_key("OpenAI")
+            import openai
+
+            self._client = openai.AsyncOpenAI(api_key=self.api_key, base_url=self.api_url or None)
+        return self._client
+
+    async def stream(self, model_name, messages, max_tokens, temperature):
+        stream = await self._get_client().chat.completions.create(
+            model=model_name,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=True
+        )
+
+        async for chunk in stream:
+            # Azureでは最初のチャンクにchoicesが含まれないことがある
+            if chunk.choices and chunk.choices[0].delta.content is not None:
+                yield chunk.choices[0].delta.content
+
+    async def stream_choices(self, model_name, messages, max_tokens, temperature, n):
+        stream = await self._get_client().chat.completions.create(
+            model=model_name,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            n=n,
+            stream=True
+        )
+
+        async for chunk in stream:
+            for choice in chunk.choices:
+                if choice.delta is not None and choice.delta.content:
+                    yield choice.index, choice.delta.content
+                if choice.finish_reason is not None:
+                    yield choice.index, None
+
+    def warm(self):
+        self._get_client()
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+
+@register_adapter
+class AnthropicAdapter(ProviderAdapter):
+    """Anthropic API"""
+
+    provider_type = "anthropic"
+
+    def __init__(
+        self,
+        api_key: Optional[str],
+        api_url: Optional[str],
+        http_clients: Optional[OllamaClientPool] = None
+    ):
+        super().__init__(api_key, api_url, http_clients)
+        self._client: Optional["anthropic.AsyncAnthropic"] = None
+
+    def _get_client(self) -> "anthropic.AsyncAnthropic":
+        if self._client is None:
+            self._require_api_key("Anthropic")
+            import anthropic
+
+            self._client = anthropic.AsyncAnthropic(api_key=self.api_key, base_url=self.api_url or None)
+        return self._client
+
+    async def stream(self, model_name, messages, max_tokens, temperature):
+        system_message, user_messages = _split_system_message(messages)
+
+        async with self._get_client().messages.stream(
+            model=model_name,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            system=system_message if system_message else "You are a helpful assistant.",
+            messages=user_messages
+        ) as stream:
+            async for text in stream.text_stream:
+                yield text
+
+    def warm(self):
+        self._get_client()
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+
+@register_adapter
+class GeminiAdapter(ProviderAdapter):
+    """Google Gemini API
+
+    genai.configure() はプロセス全体の設定を書き換えるため使わず、
+    APIキーごとに専用のクライアントを作り、generativelanguageの公開APIで直接リクエストする。
+    """
+
+    provider_type = "gemini"
+
+    def __init__(
+        self,
+        api_key: Optional[str],
+        api_url: Optional[str],
+        http_clients: Optional[OllamaClientPool] = None
+    ):
+        super().__init__(api_key, api_url, http_clients)
+        self._client: Optional["glm.GenerativeServiceAsyncClient"] = None
+
+    def _get_client(self) -> "glm.GenerativeServiceAsyncClient":
+        if self._client is None:
+            self._require_api_key("Gemini")
+            from google.ai import generativelanguage as glm
+
+            self._client = glm.GenerativeServiceAsyncClient(client_options={"api_key": self.api_key})
+        return self._client
+
+    async def stream(self, model_name, messages, max_tokens, temperature):
+        from google.ai import generativelanguage as glm
+
+        client = self._get_client()
+
+        # Gemini用にメッセージを変換
+        conversation_text = ""
+        for msg in messages:
+            role_prefix = "Human: " if msg["role"] == "user" else "Assistant: "
+            conversation_text += f"{role_prefix}{msg['content']}\n\n"
+
+        conversation_text += "Assistant: "
+
+        request = glm.GenerateContentRequest(
+            model=model_name if model_name.startswith("models/") else f"models/{model_name}",
+            contents=[glm.Content(role="user", parts=[glm.Part(text=conversation_text)])],
+            generation_config=glm.GenerationConfig(
+                max_output_tokens=max_tokens,
+                temperature=temperature
+            )
+        )
+        response = await client.stream_generate_content(request=request)
+
+        # 受信したチャンクをそのまま送信（空白での分割や待機はしない）
+        async for chunk in response:
+            text = _gemini_chunk_text(chunk)
+            if text:
+                yield text
+
+    def warm(self):
+        self._get_client()
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.transport.close()
+            self._client = None
+
+
+def _gemini_chunk_text(chunk: "glm.GenerateContentResponse") -> str:
+    """Geminiのストリーミングチャンクからテキストを取り出す（テキストのないチャンクは空文字）"""
+    # 安全性フィルタなどで候補やテキストパートを含まないチャンクもある
+    if not chunk.candidates:
+        return ""
+    return "".join(part.text for part in chunk.candidates[0].content.parts)
+
+
+@register_adapter
+class OllamaAdapter(ProviderAdapter):
+    """Ollama API（ベースURLごとの接続プールを共有し、keep-aliveで接続を再利用）"""
+
+    provider_type = "ollama"
+
+    def __init__(
+        self,
+        api_key: Optional[str],
+        api_url: Optional[str],
+        http_clients: Optional[OllamaClientPool] = None
+    ):
+        # 単独で作った場合（レジストリを通さない場合）は自分専用のプールを持ち、閉じるときに閉じる
+        self._owns_clients = http_clients is None
+        super().__init__(api_key, api_url, http_clients or OllamaClientPool())
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if not self.api_url:
+            raise ValueError("Ollama provider requires a base URL. Please set the base URL in settings (e.g., http://localhost:11434)")
+        return self.http_clients.get(self.api_url)
+
+    async def stream(self, model_name, messages, max_tokens, temperature):
+        client = self._get_client()
+
+        # メッセージを単一のプロンプトに変換
+        prompt = ""
+        for msg in messages:
+            if msg["role"] == "user":
+                prompt += f"User: {msg['content']}\n"
+            elif msg["role"] == "assistant":
+                prompt += f"Assistant: {msg['content']}\n"
+            elif msg["role"] == "system":
+                prompt += f"System: {msg['content']}\n"
+
+        prompt += "Assistant: "
+
+        # ジェネレーター内ではyieldをまたぐasyncio.timeoutを使えないため期限を都度確認する
+        deadline = asyncio.get_running_loop().time() + OLLAMA_TOTAL_TIMEOUT
+        try:
+            async with client.stream(
+                "POST",
+                "/api/generate",
+                json={
+                    "model": model_name,
+                    "prompt": prompt,
+                    "stream": True,
+                    "options": {
+                        "num_predict": max_tokens,
+                        "temperature": temperature
+                    }
+                }
+            ) as response:
+                if response.is_error:
+                    # エラー時の本文をメッセージに含めるため読み込んでおく
+                    await response.aread()
+                response.raise_for_status()
+
+                async for line in response.aiter_lines():
+                    if asyncio.get_running_loop().time() > deadline:
+                        raise ValueError(f"Timeout waiting for Ollama server at {self.api_url}. The request took longer than {OLLAMA_TOTAL_TIMEOUT:g} seconds.")
+                    if line.strip():
+                        try:
+                            data = json.loads(line)
+                            if "response" in data:
+                                yield data["response"]
+                            if data.get("done", False):
+                                break
+                        except json.JSONDecodeError:
+                            continue
+
+        except httpx.ConnectError:
+            raise TransientProviderError(f"Cannot connect to Ollama server at {self.api_url}. Please ensure Ollama is running and accessible.")
+        except httpx.TimeoutException:
+            raise TransientProviderError(f"Timeout connecting to Ollama server at {self.api_url}. The request took too long.")
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 404:
+                raise ValueError(f"Model '{model_name}' not found on Ollama server. Please check if the model is installed.")
+            elif e.response.status_code == 429 or e.response.status_code >= 500:
+                raise TransientProviderError(f"Ollama server error (HTTP {e.response.status_code}): {e.response.text}")
+            else:
+                raise ValueError(f"Ollama server error (HTTP {e.response.status_code}): {e.response.text}")
+
+    def warm(self):
+        self._get_client()
+
+    async def aclose(self):
+        # 共有しているクライアントは他のプロバイダーが使っているため、レジストリが閉じる
+        if self._owns_clients:
+            await self.http_clients.aclose()
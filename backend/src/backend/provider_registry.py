@@ -0,0 +1,112 @@
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import inspect, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .llm_service import llm_service
+from .models import LLMProvider
+from .provider_adapters import AdapterRegistry
+
+
+def snapshot_provider(provider: LLMProvider) -> LLMProvider:
+    """セッションに属さないコピーを作成（ロールバックや別セッションでの失効の影響を受けない）"""
+    return LLMProvider(**{
+        attr.key: getattr(provider, attr.key)
+        for attr in inspect(LLMProvider).column_attrs
+    })
+
+
+class ActiveProviderRegistry:
+    """アクティブなLLMプロバイダーと代替先のプロセス内キャッシュ
+
+    最初の参照時に1度だけDBから全プロバイダー（件数はわずか）を読み込み、以降は
+    メモリから返す。読み込み時にアクティブなプロバイダーと代替先のクライアントも
+    作成しておく。プロバイダーの作成・更新・切り替え・削除のAPIでinvalidate()を呼び、
+    次の参照で読み込み直す。
+    """
+
+    def __init__(self, adapters: AdapterRegistry):
+        self.adapters = adapters
+        self._provider: Optional[LLMProvider] = None
+        self._providers: Dict[int, LLMProvider] = {}
+        self._loaded = False
+        self._generation = 0
+
+        self.hits = 0
+        self.loads = 0
+        self.invalidations = 0
+
+    async def get_active(self, db: AsyncSession) -> Optional[LLMProvider]:
+        """アクティブなLLMプロバイダーを取得（なければNone）"""
+        if self._loaded:
+            self.hits += 1
+            return self._provider
+
+        generation = self._generation
+        result = await db.execute(select(LLMProvider))
+        providers = {provider.id: snapshot_provider(provider) for provider in result.scalars()}
+        active = next((provider for provider in providers.values() if provider.is_active), None)
+        self.loads += 1
+
+        # 読み込み中に無効化された場合は古い値を保持しない
+        if generation == self._generation:
+            self._providers = providers
+            self._provider = active
+            self._loaded = True
+
+        if active is not None:
+            for provider in [active, *self._fallback_chain(active, providers)]:
+                self._warm(provider)
+        return active
+
+    async def list_providers(self, db: AsyncSession) -> List[LLMProvider]:
+        """登録されている全プロバイダーを取得"""
+        await self.get_active(db)
+        return list(self._providers.values())
+
+    def fallbacks_for(self, provider: LLMProvider) -> List[LLMProvider]:
+        """プロバイダーの代替先を試す順に取得（読み込み前は空）"""
+        return self._fallback_chain(provider, self._providers)
+
+    def invalidate(self):
+        """キャッシュを破棄（次の参照でDBから読み込み直す）"""
+        self._provider = None
+        self._providers = {}
+        self._loaded = False
+        self._generation += 1
+        self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """キャッシュの統計情報"""
+        return {
+            "loaded": self._loaded,
+            "provider": self._provider.name if self._provider is not None else None,
+            "hits": self.hits,
+            "loads": self.loads,
+            "invalidations": self.invalidations,
+        }
+
+    @staticmethod
+    def _fallback_chain(provider: LLMProvider, providers: Dict[int, LLMProvider]) -> List[LLMProvider]:
+        """fallback_provider_idをたどった代替先（循環や削除済みの参照はそこで打ち切る）"""
+        chain = []
+        seen = {provider.id}
+        fallback_id = provider.fallback_provider_id
+        while fallback_id is not None and fallback_id not in seen and fallback_id in providers:
+            seen.add(fallback_id)
+            fallback = providers[fallback_id]
+            chain.append(fallback)
+            fallback_id = fallback.fallback_provider_id
+        return chain
+
+    def _warm(self, provider: LLMProvider):
+        try:
+            self.adapters.get(provider).warm()
+        except Exception as e:
+            # 設定の不備（APIキー未設定など）は実際のリクエスト時にエラーとして返す
+            print(f"Failed to warm up provider '{provider.name}': {str(e)}")
+
+
+provider_registry = ActiveProviderRegistry(llm_service.adapters)
+# フェイルオーバー先はレジストリに読み込んだ設定から解決する
+llm_service.fallback_resolver = provider_registry.fallbacks_for
@@ -0,0 +1,235 @@
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple, TypeVar
+import asyncio
+import os
+import random
+import time
+
+import httpx
+from dotenv import load_dotenv
+
+from .models import LLMProvider
+from .provider_adapters import TransientProviderError
+
+load_dotenv()
+
+# 一時的なエラーの再試行回数（プロバイダーごと、最初の試行を除く）と待ち時間（秒）
+LLM_RETRY_ATTEMPTS = int(os.getenv("LLM_RETRY_ATTEMPTS", "2"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "8"))
+
+# ヘッジ: 応答がp95の所要時間を過ぎても返らなければ同じリクエストをもう1つ送り、先に返った方を使う
+LLM_HEDGING = os.getenv("LLM_HEDGING", "false").lower() == "true"
+HEDGE_QUANTILE = 0.95
+# ヘッジの待ち時間を決めるのに必要な所要時間のサンプル数
+HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+_LATENCY_SAMPLES = 200
+
+# 再試行するHTTPステータス（429・5xx・Anthropicの過負荷529など）
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+
+# SDKを読み込まずに判定するため、一時的なエラーを表す例外はクラス名で判定する
+_TRANSIENT_ERROR_NAMES = {
+    "APIConnectionError",   # openai / anthropic
+    "APITimeoutError",
+    "RateLimitError",
+    "InternalServerError",
+    "OverloadedError",
+    "ServiceUnavailable",   # google.api_core
+    "DeadlineExceeded",
+    "ResourceExhausted",
+    "TooManyRequests",
+}
+
+T = TypeVar("T")
+
+
+def is_transient(error: BaseException) -> bool:
+    """再試行すれば成功する可能性があるエラーか"""
+    if isinstance(error, (TransientProviderError, asyncio.TimeoutError, httpx.TransportError)):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_STATUS_CODES
+    if getattr(error, "status_code", None) in RETRYABLE_STATUS_CODES:
+        return True
+    return any(cls.__name__ in _TRANSIENT_ERROR_NAMES for cls in type(error).__mro__)
+
+
+def backoff_delay(
+    attempt: int,
+    base_delay: float = LLM_RETRY_BASE_DELAY,
+    max_delay: float = LLM_RETRY_MAX_DELAY,
+    rng: Callable[[], float] = random.random
+) -> float:
+    """attempt回目（0始まり）の再試行までの待ち時間（指数バックオフにフルジッターをかける）"""
+    return rng() * min(max_delay, base_delay * 2 ** attempt)
+
+
+class GenerationInfo:
+    """1回の生成で実際に応答したプロバイダーと試行の記録"""
+
+    def __init__(self):
+        self.provider: Optional[LLMProvider] = None
+        self.attempts = 0
+        self.hedged = False
+        self.cached = False
+        self.coalesced = False  # 同時に実行中だった同じ生成の結果を共有した
+        self.errors: List[str] = []
+
+    def update(self, other: "GenerationInfo", coalesced: bool = False):
+        """共有した生成の記録を写す"""
+        self.provider = other.provider
+        self.attempts = other.attempts
+        self.hedged = other.hedged
+        self.cached = other.cached
+        self.coalesced = coalesced
+        self.errors = list(other.errors)
+
+
+class LatencyTracker:
+    """プロバイダーごとの直近の所要時間"""
+
+    def __init__(self, samples: int = _LATENCY_SAMPLES):
+        self.samples = samples
+        self._latencies: Dict[object, Deque[float]] = {}
+
+    def record(self, key: object, seconds: float):
+        self._latencies.setdefault(key, deque(maxlen=self.samples)).append(seconds)
+
+    def quantile(self, key: object, q: float, min_samples: int = 1) -> Optional[float]:
+        """所要時間の分位点（サンプルが足りなければNone）"""
+        latencies = self._latencies.get(key)
+        if not latencies or len(latencies) < min_samples:
+            return None
+        ordered = sorted(latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+class ResilientExecutor:
+    """LLMへの送信を再試行・フェイルオーバー・ヘッジつきで実行する
+
+    - 一時的なエラーはジッターつきの指数バックオフで同じプロバイダーに再試行する
+    - 再試行しても失敗した場合や一時的でないエラーの場合は、次の代替プロバイダーに切り替える
+    - ヘッジが有効なら、p95の所要時間を過ぎた時点で同じリクエストをもう1つ送り、
+      先に成功した方を使って残りはキャンセルする
+    """
+
+    def __init__(
+        self,
+        retry_attempts: int = LLM_RETRY_ATTEMPTS,
+        base_delay: float = LLM_RETRY_BASE_DELAY,
+        max_delay: float = LLM_RETRY_MAX_DELAY,
+        hedging: bool = LLM_HEDGING,
+        hedge_min_samples: int = HEDGE_MIN_SAMPLES
+    ):
+        self.retry_attempts = retry_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedging = hedging
+        self.hedge_min_samples = hedge_min_samples
+        self.latency = LatencyTracker()
+
+        self.retries = 0
+        self.failovers = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    async def run(
+        self,
+        providers: List[LLMProvider],
+        operation: Callable[[LLMProvider], Awaitable[T]],
+        info: Optional[GenerationInfo] = None,
+        discard: Optional[Callable[[T], Awaitable[None]]] = None,
+        kind: str = "generate",
+        hedge: bool = True
+    ) -> Tuple[LLMProvider, T]:
+        """providersの順に試行し、最初に成功した(プロバイダー, 結果)を返す（全て失敗したら最後のエラーを送出）
+
+        discardはヘッジで不要になった成功結果の後始末（ストリームを閉じるなど）に使う。
+        """
+        info = info if info is not None else GenerationInfo()
+        last_error: Optional[BaseException] = None
+
+        for index, provider in enumerate(providers):
+            if index > 0:
+                self.failovers += 1
+                print(f"Failing over from {providers[index - 1].name} to {provider.name}")
+
+            for attempt in range(self.retry_attempts + 1):
+                info.attempts += 1
+                try:
+                    result = await self._attempt(provider, operation, info, discard, kind, hedge)
+                except Exception as e:
+                    last_error = e
+                    info.errors.append(f"{provider.name}: {str(e)}")
+                    if attempt < self.retry_attempts and is_transient(e):
+                        self.retries += 1
+                        await asyncio.sleep(backoff_delay(attempt, self.base_delay, self.max_delay))
+                        continue
+                    break
+
+                info.provider = provider
+                return provider, result
+
+        raise last_error
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "retries": self.retries,
+            "failovers": self.failovers,
+            "hedging": self.hedging,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+        }
+
+    async def _attempt(
+        self,
+        provider: LLMProvider,
+        operation: Callable[[LLMProvider], Awaitable[T]],
+        info: GenerationInfo,
+        discard: Optional[Callable[[T], Awaitable[None]]],
+        kind: str,
+        hedge: bool
+    ) -> T:
+        key = (kind, provider.id if provider.id is not None else provider.name)
+        delay = None
+        if self.hedging and hedge:
+            delay = self.latency.quantile(key, HEDGE_QUANTILE, self.hedge_min_samples)
+
+        start = time.perf_counter()
+        if delay is None:
+            result = await operation(provider)
+            self.latency.record(key, time.perf_counter() - start)
+            return result
+
+        primary = asyncio.ensure_future(operation(provider))
+        pending: Set[asyncio.Future] = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if not done:
+                info.hedged = True
+                self.hedges += 1
+                pending.add(asyncio.ensure_future(operation(provider)))
+
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                succeeded = [task for task in done if task.exception() is None]
+                if succeeded:
+                    winner = primary if primary in succeeded else succeeded[0]
+                    for task in succeeded:
+                        if task is not winner and discard is not None:
+                            await discard(task.result())
+                    if winner is not primary:
+                        self.hedge_wins += 1
+                    self.latency.record(key, time.perf_counter() - start)
+                    return winner.result()
+                error = error or next(iter(done)).exception()
+            raise error
+        finally:
+            # 負けたリクエストをキャンセル（キャンセル前に成功していた場合は後始末）
+            for task in pending:
+                task.cancel()
+            for outcome in await asyncio.gather(*pending, return_exceptions=True):
+                if discard is not None and not isinstance(outcome, BaseException):
+                    await discard(outcome)
@@ -0,0 +1,221 @@
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 永続層で期限切れ・上限超過のエントリを掃除する間隔（書き込み回数）
+_PRUNE_INTERVAL = 100
+
+
+class ResponseCache:
+    """LLM応答の完全一致キャッシュ
+
+    メモリ上のLRU（エントリ数・バイト数の上限つき）と、再起動後も残る
+    SQLiteファイルの永続層の2段構成。どちらのエントリもTTLで期限切れになる。
+    キーはプロバイダー種別・モデル・パラメータ・整形済みメッセージのハッシュ。
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        ttl: float = 24 * 60 * 60,
+        max_entries: int = 1024,
+        max_bytes: int = 32 * 1024 * 1024,
+        db_path: Optional[str] = None,
+        max_disk_entries: int = 100000,
+        max_response_bytes: int = 256 * 1024
+    ):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.db_path = db_path or None
+        self.max_disk_entries = max_disk_entries
+        self.max_response_bytes = max_response_bytes
+
+        self._entries: "OrderedDict[str, Tuple[str, float, int]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._writes = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(
+        provider_type: str,
+        model_name: str,
+        api_url: Optional[str],
+        params: Dict[str, Any],
+        messages: List[Dict[str, str]]
+    ) -> str:
+        """キャッシュキー（入力を正規化したJSONのSHA-256）"""
+        payload = json.dumps(
+            {
+                "provider_type": provider_type,
+                "model": model_name,
+                "api_url": api_url,
+                "params": params,
+                "messages": messages,
+            },
+            ensure_ascii=False,
+            sort_keys=True,
+            separators=(",", ":")
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        """応答を取得（メモリ→SQLiteの順、SQLiteでのヒットはメモリに昇格）"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                self._remove(key)
+
+        if self.db_path:
+            value = await asyncio.to_thread(self._disk_get, key, now)
+            if value is not None:
+                response, expires_at = value
+                self._memory_set(key, response, expires_at)
+                with self._lock:
+                    self.hits += 1
+                    self.disk_hits += 1
+                return response
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    async def set(self, key: str, response: str):
+        """応答を格納（上限を超える大きさの応答は格納しない）"""
+        if sys.getsizeof(response) > self.max_response_bytes:
+            return
+
+        expires_at = time.time() + self.ttl
+        self._memory_set(key, response, expires_at)
+        if self.db_path:
+            await asyncio.to_thread(self._disk_set, key, response, expires_at)
+
+    async def clear(self):
+        """全エントリを削除"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if self.db_path:
+            await asyncio.to_thread(self._disk_execute, "DELETE FROM response_cache")
+
+    def close(self):
+        """永続層の接続を閉じる"""
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def stats(self) -> Dict[str, Any]:
+        """キャッシュの統計情報"""
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "persistent": self.db_path is not None,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _memory_set(self, key: str, response: str, expires_at: float):
+        size = sys.getsizeof(response)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (response, expires_at, size)
+            self._bytes += size
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                "expires_at REAL NOT NULL, last_used_at REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS ix_response_cache_last_used_at ON response_cache (last_used_at)"
+            )
+            self._db.commit()
+        return self._db
+
+    def _disk_get(self, key: str, now: float) -> Optional[Tuple[str, float]]:
+        with self._db_lock:
+            db = self._connection()
+            row = db.execute(
+                "SELECT response, expires_at FROM response_cache WHERE key = ? AND expires_at > ?",
+                (key, now)
+            ).fetchone()
+            if row is not None:
+                db.execute("UPDATE response_cache SET last_used_at = ? WHERE key = ?", (now, key))
+                db.commit()
+            return row
+
+    def _disk_set(self, key: str, response: str, expires_at: float):
+        now = time.time()
+        with self._db_lock:
+            db = self._connection()
+            db.execute(
+                "INSERT OR REPLACE INTO response_cache (key, response, expires_at, last_used_at) VALUES (?, ?, ?, ?)",
+                (key, response, expires_at, now)
+            )
+
+            self._writes += 1
+            if self._writes % _PRUNE_INTERVAL == 0:
+                db.execute("DELETE FROM response_cache WHERE expires_at <= ?", (now,))
+                # 最近使われた max_disk_entries 件だけを残す
+                db.execute(
+                    "DELETE FROM response_cache WHERE key IN ("
+                    "SELECT key FROM response_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_disk_entries,)
+                )
+            db.commit()
+
+    def _disk_execute(self, statement: str):
+        with self._db_lock:
+            db = self._connection()
+            db.execute(statement)
+            db.commit()
+
+
+response_cache = ResponseCache(
+    enabled=os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true",
+    ttl=float(os.getenv("RESPONSE_CACHE_TTL", str(24 * 60 * 60))),
+    max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024")),
+    max_bytes=int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(32 * 1024 * 1024))),
+    db_path=os.getenv("RESPONSE_CACHE_PATH", "./response_cache.db"),
+    max_disk_entries=int(os.getenv("RESPONSE_CACHE_MAX_DISK_ENTRIES", "100000"))
+)
@@ -1,50 +1,22 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
-from sqlalchemy.orm import selectinload
-from typing import List, Optional
+from typing import List
 
 from ..database import get_db
-from ..models import Conversation, Message, LLMProvider
-from ..schemas import ChatRequest, ChatResponse, MessageResponse
+from ..models import Conversation, LLMProvider, Message
+from ..schemas import ChatRequest, ChatResponse, FanOutReply, FanOutRequest, FanOutResponse, MessageResponse
 from ..llm_service import llm_service
+from ..compaction import compact_history
+from ..fanout import MAX_ALTERNATIVES, fan_out, generate_alternatives, load_providers
+from ..history import get_conversation_history, get_history_for_message
+from ..provider_registry import provider_registry
+from ..resilience import GenerationInfo
+from ..unit_of_work import ChatUnitOfWork
 
 router = APIRouter()
 
 
-async def get_conversation_history(
-    conversation_id: int,
-    parent_id: int = None,
-    db: AsyncSession = None
-) -> List[MessageResponse]:
-    """指定されたノードから根までの会話履歴を取得"""
-    messages = []
-    current_id = parent_id
-    
-    # parent_idから根まで遡る
-    while current_id is not None:
-        query = select(Message).where(Message.id == current_id)
-        result = await db.execute(query)
-        message = result.scalar_one_or_none()
-        
-        if not message:
-            break
-            
-        messages.insert(0, MessageResponse.from_orm(message))
-        current_id = message.parent_id
-    
-    return messages
-
-
-async def get_active_llm_provider(db: AsyncSession) -> Optional[LLMProvider]:
-    """アクティブなLLMプロバイダーを取得"""
-    query = select(LLMProvider).where(LLMProvider.is_active == True)
-    result = await db.execute(query)
-    provider = result.scalar_one_or_none()
-    
-    return provider
-
-
 @router.post("/send", response_model=ChatResponse)
 async def send_message(
     chat_request: ChatRequest,
@@ -63,96 +35,139 @@ async def send_message(
             detail="Conversation not found"
         )
     
+    uow = ChatUnitOfWork(db, conversation)
+    
     # アクティブなLLMプロバイダーを取得
-    provider = await get_active_llm_provider(db)
+    provider = await provider_registry.get_active(db)
+    
+    # ユーザーメッセージを保存
+    user_message = await uow.add_user_message(chat_request.message, chat_request.parent_id)
+    user_response = MessageResponse.model_validate(user_message)
     
     if not provider:
-        # アクティブなプロバイダーがない場合はエラーを返す
-        error_message = Message(
-            conversation_id=chat_request.conversation_id,
-            parent_id=chat_request.parent_id,
-            role="assistant",
-            content="プロバイダーが選択されていません。設定画面でLLMプロバイダーを選択してください。"
-        )
-        db.add(error_message)
-        await db.commit()
-        await db.refresh(error_message)
+        # アクティブなプロバイダーがない場合はエラーメッセージを応答として保存
+        error_message = await uow.add_assistant_message(
+            "プロバイダーが選択されていません。設定画面でLLMプロバイダーを選択してください。",
+            user_response.id
+        )
         
         return ChatResponse(
-            user_message=MessageResponse.from_orm(user_message),
-            assistant_message=MessageResponse.from_orm(error_message)
+            user_message=user_response,
+            assistant_message=MessageResponse.model_validate(error_message)
         )
     
-    # ユーザーメッセージを保存
-    user_message = Message(
-        conversation_id=chat_request.conversation_id,
-        parent_id=chat_request.parent_id,
-        role="user",
-        content=chat_request.message
-    )
-    db.add(user_message)
-    await db.commit()
-    await db.refresh(user_message)
-    
     try:
         # 会話履歴を取得（選択されたノードから根まで）
-        history = await get_conversation_history(
-            chat_request.conversation_id,
-            user_message.id,
-            db
-        )
+        history = await get_history_for_message(user_message, db)
         
-        # コンテキスト制限に合わせて履歴を切り詰め
-        truncated_history = llm_service.truncate_messages_for_context(history)
+        # LLMの応答待ちの間は接続を保持しない
+        await uow.release()
+        
+        # 古い祖先を要約で圧縮し、コンテキスト制限に合わせて切り詰め
+        history = await compact_history(history, provider)
+        truncated_history = llm_service.truncate_messages_for_context(history, provider=provider)
         
         # LLMからの応答を生成
+        info = GenerationInfo()
         assistant_response = await llm_service.generate_response(
             provider,
-            truncated_history
+            truncated_history,
+            use_cache=not chat_request.bypass_cache,
+            info=info
         )
         
-        # アシスタントメッセージを保存
-        assistant_message = Message(
-            conversation_id=chat_request.conversation_id,
-            parent_id=user_message.id,
-            role="assistant",
-            content=assistant_response
-        )
-        db.add(assistant_message)
-        await db.commit()
-        await db.refresh(assistant_message)
-        
-        # 会話の更新日時を更新
-        conversation.updated_at = assistant_message.created_at
-        await db.commit()
+        # アシスタントメッセージを保存（会話の更新日時も同じトランザクションで更新）
+        assistant_message = await uow.add_assistant_message(assistant_response, user_response.id, info.provider)
         
         return ChatResponse(
-            user_message=MessageResponse.from_orm(user_message),
-            assistant_message=MessageResponse.from_orm(assistant_message)
+            user_message=user_response,
+            assistant_message=MessageResponse.model_validate(assistant_message)
         )
         
     except Exception as e:
         # エラーが発生した場合、ユーザーメッセージは保存されているが、
         # アシスタントメッセージは保存されない
         print(f"Error generating LLM response: {str(e)}")
+        await db.rollback()
         
         # エラーメッセージをアシスタントメッセージとして保存
-        error_message = Message(
-            conversation_id=chat_request.conversation_id,
-            parent_id=user_message.id,
-            role="assistant",
-            content="申し訳ございません。応答の生成中にエラーが発生しました。しばらく時間をおいて再度お試しください。"
+        error_message = await uow.add_assistant_message(
+            "申し訳ございません。応答の生成中にエラーが発生しました。しばらく時間をおいて再度お試しください。",
+            user_response.id
         )
-        db.add(error_message)
-        await db.commit()
-        await db.refresh(error_message)
         
         return ChatResponse(
-            user_message=MessageResponse.from_orm(user_message),
-            assistant_message=MessageResponse.from_orm(error_message)
+            user_message=user_response,
+            assistant_message=MessageResponse.model_validate(error_message)
         )
 
 
+@router.post("/fanout", response_model=FanOutResponse)
+async def fan_out_message(
+    fan_out_request: FanOutRequest,
+    db: AsyncSession = Depends(get_db)
+):
+    """メッセージを送信し、複数のプロバイダーの応答を兄弟ノードとして並行して生成"""
+    
+    if len(set(fan_out_request.provider_ids)) != len(fan_out_request.provider_ids):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="provider_ids must not contain duplicates"
+        )
+    
+    # 会話の存在確認
+    conv_query = select(Conversation).where(Conversation.id == fan_out_request.conversation_id)
+    conv_result = await db.execute(conv_query)
+    conversation = conv_result.scalar_one_or_none()
+    
+    if not conversation:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Conversation not found"
+        )
+    
+    try:
+        providers = await load_providers(db, fan_out_request.provider_ids)
+    except LookupError as e:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=str(e)
+        )
+    
+    uow = ChatUnitOfWork(db, conversation)
+    
+    # ユーザーメッセージを保存
+    user_message = await uow.add_user_message(fan_out_request.message, fan_out_request.parent_id)
+    user_response = MessageResponse.model_validate(user_message)
+    
+    # 会話履歴を取得（全プロバイダーで共通）
+    history = await get_history_for_message(user_message, db)
+    
+    # LLMの応答待ちの間は接続を保持しない
+    await uow.release()
+    
+    results = await fan_out(
+        uow,
+        user_response.id,
+        history,
+        providers,
+        use_cache=not fan_out_request.bypass_cache
+    )
+    
+    return FanOutResponse(
+        user_message=user_response,
+        assistant_messages=[
+            FanOutReply(
+                provider_id=provider.id,
+                provider_name=provider.name,
+                model_name=provider.model_name,
+                message=MessageResponse.model_validate(message)
+            )
+            for provider, message in results
+        ]
+    )
+
+
 @router.get("/history/{conversation_id}")
 async def get_chat_history(
     conversation_id: int,
@@ -184,7 +199,7 @@ async def get_chat_history(
         )
         result = await db.execute(query)
         messages = result.scalars().all()
-        history = [MessageResponse.from_orm(msg) for msg in messages]
+        history = [MessageResponse.model_validate(msg) for msg in messages]
     
     return {
         "conversation_id": conversation_id,
@@ -192,14 +207,8 @@ async def get_chat_history(
     }
 
 
-@router.post("/regenerate/{message_id}", response_model=MessageResponse)
-async def regenerate_response(
-    message_id: int,
-    db: AsyncSession = Depends(get_db)
-):
-    """指定されたアシスタントメッセージを再生成"""
-    
-    # メッセージの存在確認
+async def get_regenerate_target(message_id: int, db: AsyncSession) -> Message:
+    """再生成の対象となるアシスタントメッセージを取得"""
     query = select(Message).where(Message.id == message_id)
     result = await db.execute(query)
     message = result.scalar_one_or_none()
@@ -216,8 +225,35 @@ async def regenerate_response(
             detail="Can only regenerate assistant messages"
         )
     
-    # アクティブなLLMプロバイダーを取得
-    provider = await get_active_llm_provider(db)
+    return message
+
+
+async def get_provider_for_regenerate(db: AsyncSession) -> LLMProvider:
+    """再生成に使うアクティブなLLMプロバイダーを取得"""
+    provider = await provider_registry.get_active(db)
+    
+    if not provider:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="No active provider. Select an LLM provider in settings."
+        )
+    
+    return provider
+
+
+@router.post("/regenerate/{message_id}", response_model=MessageResponse)
+async def regenerate_response(
+    message_id: int,
+    bypass_cache: bool = True,
+    db: AsyncSession = Depends(get_db)
+):
+    """指定されたアシスタントメッセージを再生成
+
+    元の応答と同じ入力になるため、既定では応答キャッシュを使わずに新しい応答を生成する。
+    """
+    
+    message = await get_regenerate_target(message_id, db)
+    provider = await get_provider_for_regenerate(db)
     
     try:
         # 親メッセージまでの履歴を取得
@@ -227,21 +263,29 @@ async def regenerate_response(
             db
         )
         
-        # コンテキスト制限に合わせて履歴を切り詰め
-        truncated_history = llm_service.truncate_messages_for_context(history)
+        # LLMの応答待ちの間は接続を保持しない（書き込みがないためfsyncは発生しない）
+        await db.commit()
+        
+        # 古い祖先を要約で圧縮し、コンテキスト制限に合わせて切り詰め
+        history = await compact_history(history, provider)
+        truncated_history = llm_service.truncate_messages_for_context(history, provider=provider)
         
         # LLMからの新しい応答を生成
+        info = GenerationInfo()
         new_response = await llm_service.generate_response(
             provider,
-            truncated_history
+            truncated_history,
+            use_cache=not bypass_cache,
+            info=info
         )
         
-        # メッセージの内容を更新
+        # メッセージの内容と応答したプロバイダーを更新（接続はここで取り直す）
         message.content = new_response
+        message.provider_name = info.provider.name if info.provider is not None else None
+        message.model_name = info.provider.model_name if info.provider is not None else None
         await db.commit()
-        await db.refresh(message)
         
-        return MessageResponse.from_orm(message)
+        return MessageResponse.model_validate(message)
         
     except Exception as e:
         print(f"Error regenerating response: {str(e)}")
@@ -249,3 +293,32 @@ async def regenerate_response(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Failed to regenerate response"
         )
+
+
+@router.post("/regenerate/{message_id}/alternatives", response_model=List[MessageResponse])
+async def regenerate_alternatives(
+    message_id: int,
+    count: int = Query(3, ge=1, le=MAX_ALTERNATIVES, description="生成する別の応答の数"),
+    db: AsyncSession = Depends(get_db)
+):
+    """指定されたアシスタントメッセージの別の応答を並行して生成し、兄弟ノードとして保存（元の応答は残す）"""
+    
+    message = await get_regenerate_target(message_id, db)
+    provider = await get_provider_for_regenerate(db)
+    
+    conv_query = select(Conversation).where(Conversation.id == message.conversation_id)
+    conv_result = await db.execute(conv_query)
+    conversation = conv_result.scalar_one()
+    
+    # 親メッセージまでの履歴を取得
+    history = await get_conversation_history(message.conversation_id, message.parent_id, db)
+    
+    uow = ChatUnitOfWork(db, conversation)
+    parent_id = message.parent_id
+    
+    # LLMの応答待ちの間は接続を保持しない
+    await uow.release()
+    
+    alternatives = await generate_alternatives(uow, parent_id, history, provider, count)
+    
+    return [MessageResponse.model_validate(alternative) for alternative in alternatives]
@@ -1,22 +1,36 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func
-from sqlalchemy.orm import selectinload
-from typing import List
+from sqlalchemy import select, and_, or_
+from typing import List, Optional, Tuple
+from datetime import datetime
+import base64
 
 from ..database import get_db
 from ..models import Conversation, Message
+from ..history import (
+    load_conversation_tree,
+    get_subtree_skeleton,
+    get_messages_by_ids,
+    get_changed_messages
+)
 from ..schemas import (
     ConversationCreate,
     ConversationResponse,
     ConversationListResponse,
     ConversationTree,
-    MessageTreeNode,
-    MessageResponse
+    ConversationSkeleton,
+    ConversationChanges,
+    MessageResponse,
+    MessageBodiesRequest,
+    MessageBodiesResponse
 )
 
 router = APIRouter()
 
+# 差分同期でこれを超える場合は全メッセージを返す
+MAX_SYNC_VERSION_GAP = 1000
+MAX_SYNC_DELTA_MESSAGES = 500
+
 
 @router.post("/", response_model=ConversationResponse, status_code=status.HTTP_201_CREATED)
 async def create_conversation(
@@ -35,32 +49,61 @@ async def create_conversation(
         title=db_conversation.title,
         created_at=db_conversation.created_at,
         updated_at=db_conversation.updated_at,
+        version=db_conversation.version,
         messages=[]
     )
 
 
+def encode_cursor(conversation: Conversation) -> str:
+    """会話一覧のカーソル（updated_at, id）をエンコード"""
+    raw = f"{conversation.updated_at.isoformat()}|{conversation.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """会話一覧のカーソルをデコード"""
+    try:
+        updated_at, conversation_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(updated_at), int(conversation_id)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
+
 @router.get("/", response_model=List[ConversationListResponse])
 async def get_conversations(
+    response: Response,
+    cursor: Optional[str] = Query(None, description="前ページのX-Next-Cursorヘッダーの値"),
     skip: int = 0,
-    limit: int = 100,
+    limit: int = Query(100, ge=1, le=500),
     db: AsyncSession = Depends(get_db)
 ):
-    """会話一覧を取得"""
-    # 会話とメッセージ数を取得
-    query = (
-        select(
-            Conversation,
-            func.count(Message.id).label("message_count")
-        )
-        .outerjoin(Message)
-        .group_by(Conversation.id)
-        .order_by(Conversation.updated_at.desc())
-        .offset(skip)
-        .limit(limit)
-    )
+    """会話一覧を取得
+
+    (updated_at, id) のキーセットでページングし、次ページのカーソルを
+    X-Next-Cursor ヘッダーで返す。メッセージ数は会話のサマリーカラムから読むため、
+    メッセージ数に関係なく一定のコストで取得できる。
+    """
+    query = select(Conversation)
+    
+    if cursor:
+        updated_at, conversation_id = decode_cursor(cursor)
+        query = query.where(or_(
+            Conversation.updated_at < updated_at,
+            and_(Conversation.updated_at == updated_at, Conversation.id < conversation_id)
+        ))
+    elif skip:
+        # 互換性のためのOFFSETページング
+        query = query.offset(skip)
     
+    query = query.order_by(Conversation.updated_at.desc(), Conversation.id.desc()).limit(limit)
     result = await db.execute(query)
-    conversations_with_count = result.all()
+    conversations = result.scalars().all()
+    
+    if len(conversations) == limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(conversations[-1])
     
     return [
         ConversationListResponse(
@@ -68,9 +111,11 @@ async def get_conversations(
             title=conv.title,
             created_at=conv.created_at,
             updated_at=conv.updated_at,
-            message_count=count
+            message_count=conv.message_count,
+            last_message_preview=conv.last_message_preview,
+            last_activity_at=conv.last_activity_at
         )
-        for conv, count in conversations_with_count
+        for conv in conversations
     ]
 
 
@@ -108,7 +153,8 @@ async def get_conversation(
             parent_id=msg.parent_id,
             role=msg.role,
             content=msg.content,
-            created_at=msg.created_at
+            created_at=msg.created_at,
+            version=msg.version
         )
         for msg in messages
     ]
@@ -118,6 +164,7 @@ async def get_conversation(
         title=conversation.title,
         created_at=conversation.created_at,
         updated_at=conversation.updated_at,
+        version=conversation.version,
         messages=message_responses
     )
 
@@ -125,6 +172,8 @@ async def get_conversation(
 @router.get("/{conversation_id}/tree", response_model=ConversationTree)
 async def get_conversation_tree(
     conversation_id: int,
+    root_id: Optional[int] = Query(None, description="部分木の起点となるメッセージID"),
+    max_depth: Optional[int] = Query(None, ge=0, description="起点から取得する深さ（未指定なら全て）"),
     db: AsyncSession = Depends(get_db)
 ):
     """会話のツリー構造を取得"""
@@ -139,45 +188,125 @@ async def get_conversation_tree(
             detail="Conversation not found"
         )
     
-    # 全メッセージを取得
-    messages_query = (
-        select(Message)
-        .where(Message.conversation_id == conversation_id)
-        .order_by(Message.created_at)
+    # メッセージをツリー構造に変換（root_id / max_depth で部分的に取得可能）
+    root_messages = await load_conversation_tree(
+        conversation_id,
+        db,
+        root_id=root_id,
+        max_depth=max_depth
     )
-    messages_result = await db.execute(messages_query)
-    messages = messages_result.scalars().all()
     
-    # メッセージをツリー構造に変換
-    root_messages = []
-    
-    def build_tree_node(message: Message) -> MessageTreeNode:
-        children = [
-            build_tree_node(child_msg)
-            for child_msg in messages
-            if child_msg.parent_id == message.id
-        ]
-        
-        return MessageTreeNode(
-            id=message.id,
-            role=message.role,
-            content=message.content,
-            created_at=message.created_at,
-            children=children
+    if root_messages is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Message not found"
         )
     
-    # ルートメッセージ（parent_id が None）から開始
-    for message in messages:
-        if message.parent_id is None:
-            root_messages.append(build_tree_node(message))
-    
     return ConversationTree(
         conversation_id=conversation_id,
         title=conversation.title,
+        version=conversation.version,
         root_messages=root_messages
     )
 
 
+@router.get("/{conversation_id}/skeleton", response_model=ConversationSkeleton)
+async def get_conversation_skeleton(
+    conversation_id: int,
+    root_id: Optional[int] = Query(None, description="部分木の起点となるメッセージID"),
+    max_depth: Optional[int] = Query(None, ge=0, description="起点から取得する深さ（未指定なら全て）"),
+    preview_length: int = Query(80, ge=0, le=1000, description="プレビューの最大文字数"),
+    db: AsyncSession = Depends(get_db)
+):
+    """本文を含まない会話ツリーの骨格を取得"""
+    # 会話の存在確認
+    conv_query = select(Conversation).where(Conversation.id == conversation_id)
+    conv_result = await db.execute(conv_query)
+    conversation = conv_result.scalar_one_or_none()
+    
+    if not conversation:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Conversation not found"
+        )
+    
+    messages = await get_subtree_skeleton(
+        conversation_id,
+        db,
+        root_id=root_id,
+        max_depth=max_depth,
+        preview_length=preview_length
+    )
+    
+    if messages is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Message not found"
+        )
+    
+    return ConversationSkeleton(
+        conversation_id=conversation_id,
+        title=conversation.title,
+        version=conversation.version,
+        messages=messages
+    )
+
+
+@router.get("/{conversation_id}/changes", response_model=ConversationChanges)
+async def get_conversation_changes(
+    conversation_id: int,
+    since: int = Query(..., ge=0, description="クライアントが保持している版数"),
+    db: AsyncSession = Depends(get_db)
+):
+    """指定された版数以降に追加・変更されたメッセージを取得
+
+    差分が大きすぎる場合やクライアントの版数が不正な場合は全メッセージを返す。
+    """
+    # 会話の存在確認
+    conv_query = select(Conversation).where(Conversation.id == conversation_id)
+    conv_result = await db.execute(conv_query)
+    conversation = conv_result.scalar_one_or_none()
+    
+    if not conversation:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Conversation not found"
+        )
+    
+    version = conversation.version
+    messages = None
+    
+    if since <= version and version - since <= MAX_SYNC_VERSION_GAP:
+        changed = await get_changed_messages(conversation_id, since, db, limit=MAX_SYNC_DELTA_MESSAGES + 1)
+        if len(changed) <= MAX_SYNC_DELTA_MESSAGES:
+            messages = changed
+    
+    full_snapshot = messages is None
+    if full_snapshot:
+        messages = await get_changed_messages(conversation_id, -1, db)
+    
+    return ConversationChanges(
+        conversation_id=conversation_id,
+        title=conversation.title,
+        since=since,
+        version=version,
+        full_snapshot=full_snapshot,
+        messages=messages
+    )
+
+
+@router.post("/{conversation_id}/messages/batch", response_model=MessageBodiesResponse)
+async def get_message_bodies(
+    conversation_id: int,
+    request: MessageBodiesRequest,
+    db: AsyncSession = Depends(get_db)
+):
+    """指定されたメッセージの本文をまとめて取得"""
+    messages = await get_messages_by_ids(conversation_id, request.ids, db)
+    
+    return MessageBodiesResponse(messages=messages)
+
+
 @router.delete("/{conversation_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_conversation(
     conversation_id: int,
@@ -1,19 +1,48 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, update
-from typing import List
+from typing import List, Optional
 
 from ..database import get_db
+from ..health import provider_health
 from ..models import LLMProvider
+from ..provider_adapters import ADAPTERS, infer_provider_type
+from ..provider_registry import provider_registry
 from ..schemas import (
     LLMProviderCreate,
     LLMProviderUpdate,
-    LLMProviderResponse
+    LLMProviderResponse,
+    ProviderStatusResponse
 )
 
 router = APIRouter()
 
 
+async def validate_fallback_provider(db: AsyncSession, fallback_provider_id: int, provider_id: Optional[int] = None):
+    """代替先のプロバイダーが存在し、自分自身でないか確認"""
+    if fallback_provider_id == provider_id:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="A provider cannot fall back to itself"
+        )
+    
+    result = await db.execute(select(LLMProvider.id).where(LLMProvider.id == fallback_provider_id))
+    if result.scalar_one_or_none() is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Fallback provider {fallback_provider_id} not found"
+        )
+
+
+def validate_provider_type(provider_type: str):
+    """登録されているアダプターの種類か確認"""
+    if provider_type not in ADAPTERS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown provider type '{provider_type}'. Available: {', '.join(sorted(ADAPTERS))}"
+        )
+
+
 @router.post("/", response_model=LLMProviderResponse, status_code=status.HTTP_201_CREATED)
 async def create_provider(
     provider: LLMProviderCreate,
@@ -32,9 +61,18 @@ async def create_provider(
             detail=f"Provider with name '{provider.name}' already exists"
         )
     
-    db_provider = LLMProvider(**provider.model_dump())
+    provider_data = provider.model_dump()
+    if provider_data["provider_type"] is None:
+        provider_data["provider_type"] = infer_provider_type(provider.name, provider.model_name)
+    else:
+        validate_provider_type(provider_data["provider_type"])
+    if provider_data["fallback_provider_id"] is not None:
+        await validate_fallback_provider(db, provider_data["fallback_provider_id"])
+    
+    db_provider = LLMProvider(**provider_data)
     db.add(db_provider)
     await db.commit()
+    provider_registry.invalidate()
     await db.refresh(db_provider)
     
     return db_provider
@@ -57,9 +95,7 @@ async def get_active_provider(
     db: AsyncSession = Depends(get_db)
 ):
     """アクティブなLLMプロバイダーを取得"""
-    query = select(LLMProvider).where(LLMProvider.is_active == True)
-    result = await db.execute(query)
-    provider = result.scalar_one_or_none()
+    provider = await provider_registry.get_active(db)
     
     if not provider:
         raise HTTPException(
@@ -70,6 +106,26 @@ async def get_active_provider(
     return provider
 
 
+@router.get("/status", response_model=List[ProviderStatusResponse])
+async def get_provider_status(
+    db: AsyncSession = Depends(get_db)
+):
+    """全LLMプロバイダーの状態（サーキットブレーカー・所要時間・エラー率）を取得"""
+    providers = await provider_registry.list_providers(db)
+    
+    return [
+        {
+            "id": provider.id,
+            "name": provider.name,
+            "provider_type": provider.provider_type,
+            "model_name": provider.model_name,
+            "is_active": provider.is_active,
+            **provider_health.stats(provider)
+        }
+        for provider in sorted(providers, key=lambda provider: provider.name)
+    ]
+
+
 @router.get("/{provider_id}", response_model=LLMProviderResponse)
 async def get_provider(
     provider_id: int,
@@ -108,10 +164,15 @@ async def update_provider(
     
     # 更新データを適用
     update_data = provider_update.model_dump(exclude_unset=True)
+    if update_data.get("provider_type") is not None:
+        validate_provider_type(update_data["provider_type"])
+    if update_data.get("fallback_provider_id") is not None:
+        await validate_fallback_provider(db, update_data["fallback_provider_id"], provider_id)
     for field, value in update_data.items():
         setattr(provider, field, value)
     
     await db.commit()
+    provider_registry.invalidate()
     await db.refresh(provider)
     
     return provider
@@ -143,6 +204,7 @@ async def activate_provider(
     # 指定されたプロバイダーをアクティブにする
     provider.is_active = True
     await db.commit()
+    provider_registry.invalidate()
     await db.refresh(provider)
     
     return {"message": f"Provider '{provider.name}' activated successfully"}
@@ -164,20 +226,30 @@ async def delete_provider(
             detail="Provider not found"
         )
     
+    # このプロバイダーを代替先にしている設定を解除
+    await db.execute(
+        update(LLMProvider)
+        .where(LLMProvider.fallback_provider_id == provider_id)
+        .values(fallback_provider_id=None)
+    )
     await db.delete(provider)
     await db.commit()
+    provider_registry.invalidate()
 
 
 @router.post("/test/{provider_id}")
 async def test_provider(
     provider_id: int,
     test_message: str = "Hello, this is a test message.",
+    bypass_cache: bool = False,
     db: AsyncSession = Depends(get_db)
 ):
     """LLMプロバイダーの接続をテスト"""
     from ..llm_service import llm_service
+    from ..resilience import GenerationInfo
+    from ..scheduler import BATCH
     from ..schemas import MessageResponse
-    from datetime import datetime
+    from datetime import datetime, timezone
     
     # プロバイダーの取得
     query = select(LLMProvider).where(LLMProvider.id == provider_id)
@@ -199,20 +271,27 @@ async def test_provider(
                 parent_id=None,
                 role="user",
                 content=test_message,
-                created_at=datetime.utcnow()
+                created_at=datetime.now(timezone.utc)
             )
         ]
         
-        # LLMからの応答を生成
+        # LLMからの応答を生成（接続の確認のため代替プロバイダーに切り替えず、エラーはそのまま返す）
+        info = GenerationInfo()
         response = await llm_service.generate_response(
             provider,
             test_messages,
-            max_tokens=100
+            max_tokens=100,
+            raise_errors=True,
+            use_cache=not bypass_cache,
+            priority=BATCH,
+            failover=False,
+            info=info
         )
         
         return {
             "success": True,
-            "provider": provider.name,
+            "provider": info.provider.name if info.provider is not None else provider.name,
+            "cached": info.cached,
             "test_message": test_message,
             "response": response
         }
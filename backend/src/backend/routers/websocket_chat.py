@@ -1,18 +1,35 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends
-from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect
 from sqlalchemy import select
-from typing import Dict, List
+from pydantic import ValidationError
+from contextlib import aclosing
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Dict, Optional
 import json
+import os
+import uuid
 import asyncio
-from datetime import datetime
 
 from ..database import get_db
-from ..models import Conversation, Message, LLMProvider
-from ..schemas import MessageResponse
+from ..models import Conversation, Message
+from ..schemas import FanOutRequest
 from ..llm_service import llm_service
+from ..compaction import compact_history
+from ..fanout import MAX_ALTERNATIVES, fan_out, generate_alternatives, load_providers
+from ..history import get_conversation_history, get_history_for_message
+from ..provider_registry import provider_registry
+from ..resilience import GenerationInfo
+from ..unit_of_work import ChatUnitOfWork
 
 router = APIRouter()
 
+# 1つの接続で同時に実行できる生成の数
+WS_MAX_CONCURRENT_GENERATIONS = int(os.getenv("WS_MAX_CONCURRENT_GENERATIONS", "4"))
+
+# 実行中のタスクが処理している生成のID（送信するイベントに付ける）
+current_request_id: ContextVar[Optional[str]] = ContextVar("current_request_id", default=None)
+
+GenerationHandler = Callable[[dict, str, WebSocket], Awaitable[None]]
+
 
 class ConnectionManager:
     """WebSocket接続を管理するクラス"""
@@ -37,52 +54,86 @@ class ConnectionManager:
             await websocket.send_text(message)
     
     async def send_json_message(self, data: dict, client_id: str):
-        """特定のクライアントにJSONメッセージを送信"""
+        """特定のクライアントにJSONメッセージを送信（生成のタスクからの送信にはrequest_idを付ける）"""
         if client_id in self.active_connections:
             websocket = self.active_connections[client_id]
+            request_id = current_request_id.get()
+            if request_id is not None:
+                data = {"request_id": request_id, **data}
             await websocket.send_json(data)
 
 
 manager = ConnectionManager()
 
 
-async def get_conversation_history(
-    conversation_id: int,
-    parent_id: int = None,
-    db: AsyncSession = None
-) -> List[MessageResponse]:
-    """指定されたノードから根までの会話履歴を取得"""
-    messages = []
-    current_id = parent_id
+class GenerationTasks:
+    """1つの接続で実行中の生成（request_idごとのタスク）
+
+    生成を受信ループとは別のタスクで行うため、生成中もping・キャンセル・別の生成を受け付けられる。
+    """
+    
+    def __init__(self, client_id: str, limit: int = WS_MAX_CONCURRENT_GENERATIONS):
+        self.client_id = client_id
+        self.limit = limit
+        self.tasks: Dict[str, asyncio.Task] = {}
     
-    # parent_idから根まで遡る
-    while current_id is not None:
-        query = select(Message).where(Message.id == current_id)
-        result = await db.execute(query)
-        message = result.scalar_one_or_none()
+    async def start(self, message_data: dict, handler: GenerationHandler, websocket: WebSocket):
+        """生成をタスクとして開始（request_idがなければ割り当てる）"""
+        request_id = str(message_data.get("request_id") or uuid.uuid4().hex)
         
-        if not message:
-            break
-            
-        messages.insert(0, MessageResponse.from_orm(message))
-        current_id = message.parent_id
+        if request_id in self.tasks:
+            await self._send_error(request_id, "同じrequest_idの生成が実行中です。")
+            return
+        if len(self.tasks) >= self.limit:
+            await self._send_error(request_id, "同時に実行できる生成の数を超えています。")
+            return
+        
+        self.tasks[request_id] = asyncio.create_task(self._run(request_id, handler, message_data, websocket))
     
-    return messages
-
-
-async def get_active_llm_provider(db: AsyncSession) -> LLMProvider:
-    """アクティブなLLMプロバイダーを取得"""
-    query = select(LLMProvider).where(LLMProvider.is_active == True)
-    result = await db.execute(query)
-    provider = result.scalar_one_or_none()
+    async def cancel(self, request_id: Optional[str]):
+        """生成をキャンセル（プロバイダーからの受信もすぐに止める）"""
+        task = self.tasks.get(str(request_id)) if request_id is not None else None
+        if task is None:
+            await self._send_error(request_id, "キャンセルできる生成が見つかりません。")
+            return
+        task.cancel()
+    
+    async def cancel_all(self):
+        """全ての生成をキャンセルして終了を待つ（切断時）"""
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
     
-    return provider
+    async def _run(self, request_id: str, handler: GenerationHandler, message_data: dict, websocket: WebSocket):
+        current_request_id.set(request_id)
+        try:
+            await handler(message_data, self.client_id, websocket)
+        except asyncio.CancelledError:
+            await manager.send_json_message({"type": "generation_cancelled"}, self.client_id)
+        except Exception as e:
+            print(f"Error in generation {request_id} for client {self.client_id}: {str(e)}")
+            await manager.send_json_message({
+                "type": "error",
+                "message": "メッセージの処理中にエラーが発生しました。"
+            }, self.client_id)
+        finally:
+            if self.tasks.get(request_id) is asyncio.current_task():
+                del self.tasks[request_id]
+    
+    async def _send_error(self, request_id: Optional[str], message: str):
+        await manager.send_json_message({
+            "type": "error",
+            "request_id": request_id,
+            "message": message
+        }, self.client_id)
 
 
 @router.websocket("/ws/{client_id}")
 async def websocket_endpoint(websocket: WebSocket, client_id: str):
-    """WebSocketエンドポイント"""
+    """WebSocketエンドポイント（生成はrequest_idごとのタスクで並行して行う）"""
     await manager.connect(websocket, client_id)
+    generations = GenerationTasks(client_id)
     
     try:
         while True:
@@ -92,7 +143,13 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
             
             # メッセージタイプに応じて処理を分岐
             if message_data.get("type") == "chat_message":
-                await handle_chat_message(message_data, client_id, websocket)
+                await generations.start(message_data, handle_chat_message, websocket)
+            elif message_data.get("type") == "chat_fanout":
+                await generations.start(message_data, handle_fan_out_message, websocket)
+            elif message_data.get("type") == "regenerate_alternatives":
+                await generations.start(message_data, handle_regenerate_alternatives, websocket)
+            elif message_data.get("type") == "cancel":
+                await generations.cancel(message_data.get("request_id"))
             elif message_data.get("type") == "ping":
                 await manager.send_json_message({"type": "pong"}, client_id)
             
@@ -105,6 +162,9 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
             "message": "サーバーエラーが発生しました。"
         }, client_id)
         manager.disconnect(client_id)
+    finally:
+        # 切断後も続いている生成を止める（送信先がないためトークンの無駄になる）
+        await generations.cancel_all()
 
 
 async def handle_chat_message(message_data: dict, client_id: str, websocket: WebSocket):
@@ -137,7 +197,7 @@ async def handle_chat_message(message_data: dict, client_id: str, websocket: Web
                 return
             
             # アクティブなLLMプロバイダーを取得
-            provider = await get_active_llm_provider(db)
+            provider = await provider_registry.get_active(db)
             
             if not provider:
                 await manager.send_json_message({
@@ -146,16 +206,11 @@ async def handle_chat_message(message_data: dict, client_id: str, websocket: Web
                 }, client_id)
                 return
             
+            uow = ChatUnitOfWork(db, conversation)
+            
             # ユーザーメッセージを保存
-            user_message = Message(
-                conversation_id=conversation_id,
-                parent_id=parent_id,
-                role="user",
-                content=message_content
-            )
-            db.add(user_message)
-            await db.commit()
-            await db.refresh(user_message)
+            user_message = await uow.add_user_message(message_content, parent_id)
+            user_message_id = user_message.id
             
             # ユーザーメッセージをクライアントに送信
             await manager.send_json_message({
@@ -173,40 +228,36 @@ async def handle_chat_message(message_data: dict, client_id: str, websocket: Web
                 "type": "assistant_message_start"
             }, client_id)
             
+            assistant_content = ""
+            info = GenerationInfo()
             try:
                 # 会話履歴を取得
-                history = await get_conversation_history(
-                    conversation_id,
-                    user_message.id,
-                    db
-                )
+                history = await get_history_for_message(user_message, db)
                 
-                # コンテキスト制限に合わせて履歴を切り詰め
-                truncated_history = llm_service.truncate_messages_for_context(history)
+                # ストリーミング中は接続を保持しない
+                await uow.release()
                 
-                # ストリーミング応答を生成
-                assistant_content = ""
-                async for chunk in llm_service.generate_streaming_response(
+                # 古い祖先を要約で圧縮し、コンテキスト制限に合わせて切り詰め
+                history = await compact_history(history, provider)
+                truncated_history = llm_service.truncate_messages_for_context(history, provider=provider)
+                
+                # ストリーミング応答を生成（キャンセル時はプロバイダーからの受信もすぐに止める）
+                async with aclosing(llm_service.generate_streaming_response(
                     provider,
-                    truncated_history
-                ):
-                    assistant_content += chunk
-                    # チャンクをクライアントに送信
-                    await manager.send_json_message({
-                        "type": "assistant_message_chunk",
-                        "chunk": chunk
-                    }, client_id)
+                    truncated_history,
+                    use_cache=not message_data.get("bypass_cache", False),
+                    info=info
+                )) as stream:
+                    async for chunk in stream:
+                        assistant_content += chunk
+                        # チャンクをクライアントに送信
+                        await manager.send_json_message({
+                            "type": "assistant_message_chunk",
+                            "chunk": chunk
+                        }, client_id)
                 
-                # アシスタントメッセージを保存
-                assistant_message = Message(
-                    conversation_id=conversation_id,
-                    parent_id=user_message.id,
-                    role="assistant",
-                    content=assistant_content
-                )
-                db.add(assistant_message)
-                await db.commit()
-                await db.refresh(assistant_message)
+                # アシスタントメッセージを保存（会話の更新日時も同じトランザクションで更新）
+                assistant_message = await uow.add_assistant_message(assistant_content, user_message_id, info.provider)
                 
                 # アシスタントメッセージの完了を通知
                 await manager.send_json_message({
@@ -215,27 +266,39 @@ async def handle_chat_message(message_data: dict, client_id: str, websocket: Web
                         "id": assistant_message.id,
                         "role": "assistant",
                         "content": assistant_message.content,
+                        "provider_name": assistant_message.provider_name,
+                        "model_name": assistant_message.model_name,
                         "created_at": assistant_message.created_at.isoformat()
                     }
                 }, client_id)
                 
-                # 会話の更新日時を更新
-                conversation.updated_at = assistant_message.created_at
-                await db.commit()
+            except asyncio.CancelledError:
+                # 停止した時点までの応答を保存
+                if assistant_content:
+                    partial_message = await uow.add_assistant_message(assistant_content, user_message_id, info.provider)
+                    await manager.send_json_message({
+                        "type": "assistant_message_complete",
+                        "cancelled": True,
+                        "message": {
+                            "id": partial_message.id,
+                            "role": "assistant",
+                            "content": partial_message.content,
+                            "provider_name": partial_message.provider_name,
+                            "model_name": partial_message.model_name,
+                            "created_at": partial_message.created_at.isoformat()
+                        }
+                    }, client_id)
+                raise
                 
             except Exception as e:
                 print(f"Error generating LLM response: {str(e)}")
+                await db.rollback()
                 
                 # エラーメッセージをアシスタントメッセージとして保存
-                error_message = Message(
-                    conversation_id=conversation_id,
-                    parent_id=user_message.id,
-                    role="assistant",
-                    content="申し訳ございません。応答の生成中にエラーが発生しました。しばらく時間をおいて再度お試しください。"
+                error_message = await uow.add_assistant_message(
+                    "申し訳ございません。応答の生成中にエラーが発生しました。しばらく時間をおいて再度お試しください。",
+                    user_message_id
                 )
-                db.add(error_message)
-                await db.commit()
-                await db.refresh(error_message)
                 
                 await manager.send_json_message({
                     "type": "assistant_message_complete",
@@ -255,3 +318,224 @@ async def handle_chat_message(message_data: dict, client_id: str, websocket: Web
             "type": "error",
             "message": "メッセージの処理中にエラーが発生しました。"
         }, client_id)
+
+
+async def handle_fan_out_message(message_data: dict, client_id: str, websocket: WebSocket):
+    """複数のプロバイダーへのファンアウト送信を処理（各チャンクにprovider_idを付けて並行して送信）"""
+    try:
+        fan_out_request = FanOutRequest.model_validate(message_data)
+    except ValidationError:
+        await manager.send_json_message({
+            "type": "error",
+            "message": "必要なデータが不足しています。"
+        }, client_id)
+        return
+    
+    if len(set(fan_out_request.provider_ids)) != len(fan_out_request.provider_ids):
+        await manager.send_json_message({
+            "type": "error",
+            "message": "同じプロバイダーが複数指定されています。"
+        }, client_id)
+        return
+    
+    try:
+        # データベースセッションを取得
+        async for db in get_db():
+            # 会話の存在確認
+            conv_query = select(Conversation).where(Conversation.id == fan_out_request.conversation_id)
+            conv_result = await db.execute(conv_query)
+            conversation = conv_result.scalar_one_or_none()
+            
+            if not conversation:
+                await manager.send_json_message({
+                    "type": "error",
+                    "message": "会話が見つかりません。"
+                }, client_id)
+                return
+            
+            try:
+                providers = await load_providers(db, fan_out_request.provider_ids)
+            except LookupError:
+                await manager.send_json_message({
+                    "type": "error",
+                    "message": "指定されたプロバイダーが見つかりません。"
+                }, client_id)
+                return
+            
+            uow = ChatUnitOfWork(db, conversation)
+            
+            # ユーザーメッセージを保存
+            user_message = await uow.add_user_message(fan_out_request.message, fan_out_request.parent_id)
+            user_message_id = user_message.id
+            
+            await manager.send_json_message({
+                "type": "user_message",
+                "message": {
+                    "id": user_message.id,
+                    "role": "user",
+                    "content": user_message.content,
+                    "created_at": user_message.created_at.isoformat()
+                }
+            }, client_id)
+            
+            # 会話履歴を取得（全プロバイダーで共通）
+            history = await get_history_for_message(user_message, db)
+            
+            # ストリーミング中は接続を保持しない
+            await uow.release()
+            
+            for provider in providers:
+                await manager.send_json_message({
+                    "type": "assistant_message_start",
+                    "provider_id": provider.id,
+                    "provider_name": provider.name,
+                    "model_name": provider.model_name
+                }, client_id)
+            
+            async def send_chunk(provider, chunk):
+                await manager.send_json_message({
+                    "type": "assistant_message_chunk",
+                    "provider_id": provider.id,
+                    "chunk": chunk
+                }, client_id)
+            
+            async def send_complete(provider, message):
+                await manager.send_json_message({
+                    "type": "assistant_message_complete",
+                    "provider_id": provider.id,
+                    "message": {
+                        "id": message.id,
+                        "parent_id": message.parent_id,
+                        "role": "assistant",
+                        "content": message.content,
+                        "provider_name": message.provider_name,
+                        "model_name": message.model_name,
+                        "created_at": message.created_at.isoformat()
+                    }
+                }, client_id)
+            
+            await fan_out(
+                uow,
+                user_message_id,
+                history,
+                providers,
+                use_cache=not fan_out_request.bypass_cache,
+                on_chunk=send_chunk,
+                on_complete=send_complete
+            )
+            
+            await manager.send_json_message({
+                "type": "fanout_complete",
+                "user_message_id": user_message_id
+            }, client_id)
+            
+            break  # データベースセッションのループを終了
+            
+    except Exception as e:
+        print(f"Error handling fan-out message: {str(e)}")
+        await manager.send_json_message({
+            "type": "error",
+            "message": "メッセージの処理中にエラーが発生しました。"
+        }, client_id)
+
+
+async def handle_regenerate_alternatives(message_data: dict, client_id: str, websocket: WebSocket):
+    """アシスタントメッセージの別の応答を並行して生成（完了した順に送信し、兄弟ノードとして保存）"""
+    message_id = message_data.get("message_id")
+    count = message_data.get("count", 3)
+    
+    if not isinstance(message_id, int) or not isinstance(count, int) or not 1 <= count <= MAX_ALTERNATIVES:
+        await manager.send_json_message({
+            "type": "error",
+            "message": "必要なデータが不足しています。"
+        }, client_id)
+        return
+    
+    try:
+        # データベースセッションを取得
+        async for db in get_db():
+            query = select(Message).where(Message.id == message_id)
+            result = await db.execute(query)
+            message = result.scalar_one_or_none()
+            
+            if not message or message.role != "assistant":
+                await manager.send_json_message({
+                    "type": "error",
+                    "message": "再生成できるメッセージが見つかりません。"
+                }, client_id)
+                return
+            
+            provider = await provider_registry.get_active(db)
+            
+            if not provider:
+                await manager.send_json_message({
+                    "type": "error",
+                    "message": "プロバイダーが選択されていません。設定画面でLLMプロバイダーを選択してください。"
+                }, client_id)
+                return
+            
+            conv_query = select(Conversation).where(Conversation.id == message.conversation_id)
+            conv_result = await db.execute(conv_query)
+            conversation = conv_result.scalar_one()
+            parent_id = message.parent_id
+            
+            # 親メッセージまでの履歴を取得
+            history = await get_conversation_history(message.conversation_id, parent_id, db)
+            
+            uow = ChatUnitOfWork(db, conversation)
+            
+            # ストリーミング中は接続を保持しない
+            await uow.release()
+            
+            await manager.send_json_message({
+                "type": "alternatives_start",
+                "message_id": message_id,
+                "parent_id": parent_id,
+                "count": count
+            }, client_id)
+            
+            async def send_chunk(index, chunk):
+                await manager.send_json_message({
+                    "type": "assistant_message_chunk",
+                    "alternative_index": index,
+                    "chunk": chunk
+                }, client_id)
+            
+            async def send_complete(index, alternative):
+                await manager.send_json_message({
+                    "type": "assistant_message_complete",
+                    "alternative_index": index,
+                    "message": {
+                        "id": alternative.id,
+                        "parent_id": alternative.parent_id,
+                        "role": "assistant",
+                        "content": alternative.content,
+                        "provider_name": alternative.provider_name,
+                        "model_name": alternative.model_name,
+                        "created_at": alternative.created_at.isoformat()
+                    }
+                }, client_id)
+            
+            await generate_alternatives(
+                uow,
+                parent_id,
+                history,
+                provider,
+                count,
+                on_chunk=send_chunk,
+                on_complete=send_complete
+            )
+            
+            await manager.send_json_message({
+                "type": "alternatives_complete",
+                "message_id": message_id
+            }, client_id)
+            
+            break  # データベースセッションのループを終了
+            
+    except Exception as e:
+        print(f"Error regenerating alternatives: {str(e)}")
+        await manager.send_json_message({
+            "type": "error",
+            "message": "メッセージの処理中にエラーが発生しました。"
+        }, client_id)
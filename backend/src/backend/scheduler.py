@@ -0,0 +1,267 @@
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Deque, Dict, List, Optional, Tuple
+import asyncio
+import heapq
+import itertools
+import os
+import time
+
+from dotenv import load_dotenv
+
+from .models import LLMProvider
+
+load_dotenv()
+
+# 優先度（小さいほど先に実行）
+INTERACTIVE = 0  # ユーザーが応答を待っているリクエスト
+BATCH = 1        # 接続テストなど、待たせてもよいリクエスト
+
+# キューで待てる最大秒数（超えた場合はSchedulerTimeout）
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "120"))
+
+# これ以上キューで待ったリクエストはログに出す（秒）
+QUEUE_WAIT_LOG_THRESHOLD = 1.0
+
+# 待ち時間の統計に使う直近のリクエスト数
+_WAIT_SAMPLES = 1000
+
+
+class SchedulerTimeout(Exception):
+    """キューでの待ち時間が上限を超えた"""
+
+
+class ProviderLimits:
+    """プロバイダーごとの上限（0以下は無制限）"""
+
+    def __init__(self, max_concurrency: int = 0, requests_per_minute: int = 0, tokens_per_minute: int = 0):
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+
+    @classmethod
+    def from_env(cls, provider_type: str) -> "ProviderLimits":
+        """環境変数から上限を読み込む（<TYPE>_MAX_CONCURRENCY などがあればLLM_*より優先）"""
+        def read(name: str, default: str) -> int:
+            value = os.getenv(f"{provider_type.upper().replace('-', '_')}_{name}") or os.getenv(f"LLM_{name}", default)
+            return int(value)
+
+        return cls(
+            max_concurrency=read("MAX_CONCURRENCY", "8"),
+            requests_per_minute=read("REQUESTS_PER_MINUTE", "0"),
+            tokens_per_minute=read("TOKENS_PER_MINUTE", "0")
+        )
+
+
+class TokenBucket:
+    """1分あたりの上限を持つトークンバケット（最大で1分ぶんをまとめて使える）"""
+
+    def __init__(self, per_minute: int, clock: Callable[[], float] = time.monotonic):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self._clock = clock
+        self._updated = clock()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.capacity <= 0
+
+    def wait_time(self, amount: float) -> float:
+        """amountを使えるようになるまでの秒数"""
+        if self.unlimited:
+            return 0.0
+        self._refill()
+        # 1分の上限を超える要求は、満杯になった時点で実行する
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount: float):
+        if not self.unlimited:
+            self._refill()
+            self.level -= min(amount, self.capacity)
+
+    def _refill(self):
+        now = self._clock()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class ProviderQueue:
+    """1つのプロバイダーへのリクエストの同時実行数・レートを制御する優先度つきキュー
+
+    上限に達している間のリクエストは優先度順（同じ優先度なら到着順）に待たせる。
+    先頭のリクエストが実行できるまで後続も実行しないため、大きなリクエストが
+    小さなリクエストに追い越され続けることはない。
+    """
+
+    def __init__(self, name: str, limits: ProviderLimits, clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.limits = limits
+        self.requests = TokenBucket(limits.requests_per_minute, clock)
+        self.tokens = TokenBucket(limits.tokens_per_minute, clock)
+        self.in_flight = 0
+
+        self._waiters: List[Tuple[int, int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+        self.started = 0
+        self.queued = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._recent_waits: Deque[float] = deque(maxlen=_WAIT_SAMPLES)
+
+    async def acquire(self, tokens: int, priority: int = INTERACTIVE, timeout: Optional[float] = None) -> float:
+        """実行枠を確保し、キューで待った秒数を返す"""
+        if not self._waiters and self._try_start(tokens):
+            self._record_wait(0.0)
+            return 0.0
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        entry = (priority, next(self._sequence), tokens, future)
+        heapq.heappush(self._waiters, entry)
+        self.queued += 1
+        start = loop.time()
+        self._dispatch()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # 枠を確保した直後にキャンセル・タイムアウトした場合は返却する
+                self.release()
+            else:
+                future.cancel()
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._dispatch()
+            if isinstance(e, asyncio.TimeoutError):
+                self.timeouts += 1
+                raise SchedulerTimeout(f"Request to {self.name} waited more than {timeout:.0f}s in the queue") from None
+            raise
+
+        waited = loop.time() - start
+        self._record_wait(waited)
+        return waited
+
+    def release(self):
+        """実行枠を返却し、待っているリクエストを開始"""
+        self.in_flight -= 1
+        self._dispatch()
+
+    def stats(self) -> Dict[str, Any]:
+        recent = sorted(self._recent_waits)
+        return {
+            "in_flight": self.in_flight,
+            "waiting": len(self._waiters),
+            "started": self.started,
+            "queued": self.queued,
+            "timeouts": self.timeouts,
+            "avg_wait_ms": self.total_wait / self.started * 1000 if self.started else 0.0,
+            "p95_wait_ms": recent[int(len(recent) * 0.95) - 1] * 1000 if recent else 0.0,
+            "max_wait_ms": self.max_wait * 1000,
+            "limits": {
+                "max_concurrency": self.limits.max_concurrency,
+                "requests_per_minute": self.limits.requests_per_minute,
+                "tokens_per_minute": self.limits.tokens_per_minute,
+            },
+        }
+
+    def _try_start(self, tokens: int) -> bool:
+        wait = self._wait_time(tokens)
+        if wait is None or wait > 0:
+            return False
+        self.requests.take(1)
+        self.tokens.take(tokens)
+        self.in_flight += 1
+        self.started += 1
+        return True
+
+    def _wait_time(self, tokens: int) -> Optional[float]:
+        """開始できるまでの秒数（同時実行数の上限で待つ場合はNone）"""
+        if self.limits.max_concurrency > 0 and self.in_flight >= self.limits.max_concurrency:
+            return None
+        return max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+
+    def _dispatch(self):
+        while self._waiters:
+            _, _, tokens, future = self._waiters[0]
+            wait = self._wait_time(tokens)
+            if wait is None:
+                # 実行中のリクエストの完了（release）で再開する
+                return
+            if wait > 0:
+                self._schedule(wait)
+                return
+
+            heapq.heappop(self._waiters)
+            self._try_start(tokens)
+            future.set_result(None)
+
+    def _schedule(self, delay: float):
+        """レート制限の回復を待って再開する"""
+        if self._timer is not None and not self._timer.cancelled():
+            self._timer.cancel()
+        loop = asyncio.get_running_loop()
+        self._timer = loop.call_later(delay, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
+
+    def _record_wait(self, waited: float):
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        self._recent_waits.append(waited)
+
+
+class RequestScheduler:
+    """LLMへの送信をプロバイダーごとのキューで制御するスケジューラー"""
+
+    def __init__(
+        self,
+        limits_for: Callable[[str], ProviderLimits] = ProviderLimits.from_env,
+        queue_timeout: Optional[float] = LLM_QUEUE_TIMEOUT
+    ):
+        self.limits_for = limits_for
+        self.queue_timeout = queue_timeout or None
+        self._queues: Dict[object, ProviderQueue] = {}
+
+    def queue_for(self, provider: LLMProvider, provider_type: str) -> ProviderQueue:
+        """プロバイダーのキューを取得（なければ作成）"""
+        key = provider.id if provider.id is not None else provider.name
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = ProviderQueue(provider.name, self.limits_for(provider_type))
+            self._queues[key] = queue
+        return queue
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        provider: LLMProvider,
+        provider_type: str,
+        tokens: int,
+        priority: int = INTERACTIVE
+    ) -> AsyncIterator[float]:
+        """実行枠を確保してから処理を行う（値はキューで待った秒数）"""
+        queue = self.queue_for(provider, provider_type)
+        waited = await queue.acquire(tokens, priority, self.queue_timeout)
+        if waited >= QUEUE_WAIT_LOG_THRESHOLD:
+            print(f"Request to {provider.name} waited {waited:.1f}s in the queue")
+        try:
+            yield waited
+        finally:
+            queue.release()
+
+    def stats(self) -> Dict[str, Any]:
+        """プロバイダーごとのキューの統計情報"""
+        return {queue.name: queue.stats() for queue in self._queues.values()}
+
+
+request_scheduler = RequestScheduler()
@@ -20,6 +20,11 @@ class MessageResponse(MessageBase):
     conversation_id: int
     parent_id: Optional[int]
     created_at: datetime
+    version: Optional[int] = Field(None, description="最後に追加・変更された時点の会話の版数")
+    token_count: Optional[int] = Field(None, description="メッセージのトークン数（見積もり）")
+    context_tokens: Optional[int] = Field(None, description="根からこのメッセージまでの累積トークン数")
+    provider_name: Optional[str] = Field(None, description="応答を生成したプロバイダー名（フェイルオーバー時は代替先）")
+    model_name: Optional[str] = Field(None, description="応答を生成したモデル名")
 
 
 # Conversation schemas
@@ -37,6 +42,7 @@ class ConversationResponse(ConversationBase):
     id: int
     created_at: datetime
     updated_at: datetime
+    version: int = 0
     messages: List[MessageResponse] = []
 
 
@@ -47,6 +53,8 @@ class ConversationListResponse(ConversationBase):
     created_at: datetime
     updated_at: datetime
     message_count: int = Field(0, description="メッセージ数")
+    last_message_preview: Optional[str] = Field(None, description="最新メッセージのプレビュー")
+    last_activity_at: Optional[datetime] = Field(None, description="最後にメッセージが追加・更新された日時")
 
 
 # Chat schemas
@@ -54,6 +62,7 @@ class ChatRequest(BaseModel):
     conversation_id: int = Field(..., description="会話ID")
     message: str = Field(..., description="ユーザーメッセージ")
     parent_id: Optional[int] = Field(None, description="親メッセージのID")
+    bypass_cache: bool = Field(False, description="応答キャッシュを使わずに必ずLLMを呼び出す")
 
 
 class ChatResponse(BaseModel):
@@ -61,12 +70,34 @@ class ChatResponse(BaseModel):
     assistant_message: MessageResponse
 
 
+class FanOutRequest(BaseModel):
+    conversation_id: int = Field(..., description="会話ID")
+    message: str = Field(..., description="ユーザーメッセージ")
+    parent_id: Optional[int] = Field(None, description="親メッセージのID")
+    provider_ids: List[int] = Field(..., min_length=1, max_length=8, description="応答を生成するプロバイダーのIDのリスト（重複不可）")
+    bypass_cache: bool = Field(False, description="応答キャッシュを使わずに必ずLLMを呼び出す")
+
+
+class FanOutReply(BaseModel):
+    provider_id: int = Field(..., description="応答を生成したプロバイダーのID")
+    provider_name: str = Field(..., description="プロバイダー名")
+    model_name: str = Field(..., description="モデル名")
+    message: MessageResponse
+
+
+class FanOutResponse(BaseModel):
+    user_message: MessageResponse
+    assistant_messages: List[FanOutReply] = Field(..., description="プロバイダーごとの応答（兄弟ノード、provider_idsの順）")
+
+
 # LLM Provider schemas
 class LLMProviderBase(BaseModel):
     name: str = Field(..., description="プロバイダー名")
+    provider_type: Optional[str] = Field(None, description="アダプターの種類 (openai, anthropic, gemini, ollama)。省略時は名前とモデル名から推定")
     model_name: str = Field(..., description="モデル名")
     api_key: Optional[str] = Field(None, description="APIキー")
     api_url: Optional[str] = Field(None, description="API URL (Ollamaなど)")
+    fallback_provider_id: Optional[int] = Field(None, description="失敗時に切り替えるプロバイダーのID（その代替先も順にたどる）")
 
 
 class LLMProviderCreate(LLMProviderBase):
@@ -74,9 +105,11 @@ class LLMProviderCreate(LLMProviderBase):
 
 
 class LLMProviderUpdate(BaseModel):
+    provider_type: Optional[str] = None
     model_name: Optional[str] = None
     api_key: Optional[str] = None
     api_url: Optional[str] = None
+    fallback_provider_id: Optional[int] = None
     is_active: Optional[bool] = None
 
 
@@ -89,6 +122,30 @@ class LLMProviderResponse(LLMProviderBase):
     updated_at: datetime
 
 
+class LatencyStats(BaseModel):
+    avg_ms: Optional[float] = Field(None, description="直近の平均（ミリ秒、記録がなければNone）")
+    p95_ms: Optional[float] = Field(None, description="直近の95パーセンタイル（ミリ秒）")
+
+
+class ProviderStatusResponse(BaseModel):
+    id: int
+    name: str
+    provider_type: Optional[str] = None
+    model_name: str
+    is_active: bool
+    state: str = Field(..., description="サーキットブレーカーの状態 (closed, open, half_open)")
+    consecutive_failures: int = Field(..., description="連続した失敗の回数")
+    circuit_opened: int = Field(..., description="ブレーカーが開いた回数")
+    retry_after_s: float = Field(..., description="ブレーカーが次の試行を通すまでの秒数")
+    samples: int = Field(..., description="統計に使った直近のリクエスト数（定期的な確認を含む）")
+    error_rate: float = Field(..., description="直近のリクエストの失敗率")
+    latency: LatencyStats = Field(..., description="応答全体の所要時間")
+    ttft: LatencyStats = Field(..., description="最初のチャンクまでの時間（ストリーミングのみ）")
+    last_error: Optional[str] = None
+    last_probe_at: Optional[datetime] = Field(None, description="最後に定期的な確認をした日時")
+    last_probe_ok: Optional[bool] = Field(None, description="最後の定期的な確認が成功したか")
+
+
 # Tree structure for conversation visualization
 class MessageTreeNode(BaseModel):
     model_config = ConfigDict(from_attributes=True)
@@ -98,14 +155,51 @@ class MessageTreeNode(BaseModel):
     content: str
     created_at: datetime
     children: List['MessageTreeNode'] = []
+    child_count: int = Field(0, description="子ノード数（深さ制限で未展開の子も含む）")
 
 
 class ConversationTree(BaseModel):
     conversation_id: int
     title: str
+    version: int = 0
     root_messages: List[MessageTreeNode]
 
 
+# Content-free skeleton for large trees
+class MessageSkeleton(BaseModel):
+    id: int
+    parent_id: Optional[int]
+    role: str
+    created_at: datetime
+    preview: str = Field(..., description="本文の先頭部分")
+    child_count: int = Field(0, description="子ノード数")
+
+
+class ConversationSkeleton(BaseModel):
+    conversation_id: int
+    title: str
+    version: int = 0
+    messages: List[MessageSkeleton]
+
+
+class MessageBodiesRequest(BaseModel):
+    ids: List[int] = Field(..., max_length=500, description="本文を取得するメッセージIDのリスト")
+
+
+class MessageBodiesResponse(BaseModel):
+    messages: List[MessageResponse]
+
+
+# Incremental tree sync
+class ConversationChanges(BaseModel):
+    conversation_id: int
+    title: str
+    since: int = Field(..., description="クライアントが保持している版数")
+    version: int = Field(..., description="現在の版数")
+    full_snapshot: bool = Field(..., description="Trueの場合messagesは差分ではなく全メッセージ")
+    messages: List[MessageResponse]
+
+
 # WebSocket message types
 class WSMessageType(BaseModel):
     type: str = Field(..., description="メッセージタイプ")
@@ -0,0 +1,100 @@
+from typing import Any, AsyncGenerator, AsyncIterator, Callable, Dict, Generic, List, Optional, TypeVar
+import asyncio
+
+T = TypeVar("T")
+
+
+class Flight(Generic[T]):
+    """実行中の1つの生成と、その結果を受け取る購読者"""
+
+    def __init__(self, key: str, shared: Any = None):
+        self.key = key
+        self.shared = shared  # 最初の呼び出し元が渡した値（実際に応答したプロバイダーの記録など）
+        self.chunks: List[T] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        """待っている購読者を全て起こす（起こした直後に戻しても待機は解除される）"""
+        self.changed.set()
+        self.changed.clear()
+
+
+class SingleFlight:
+    """同じキーの生成を同時に1つだけ実行し、全ての購読者に同じチャンクを配る
+
+    生成中に同じキーで参加した購読者は、それまでのチャンクを受け取ってから続きを受け取る。
+    生成は購読者とは別のタスクで行い、購読者が全ていなくなった時点でキャンセルする。
+    完了した生成は破棄するため、重複を防ぐのは同時に実行中の間だけ。
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, Flight] = {}
+        self.started = 0
+        self.joined = 0
+        self.cancelled = 0
+
+    def join(self, key: str, produce: Callable[[], AsyncIterator[T]], shared: Any = None) -> Flight[T]:
+        """キーの生成に参加（なければproduceで開始し、sharedを保持する）"""
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.joined += 1
+            return flight
+
+        flight = Flight(key, shared)
+        flight.task = asyncio.create_task(self._pump(flight, produce))
+        self._flights[key] = flight
+        self.started += 1
+        return flight
+
+    async def subscribe(self, flight: Flight[T]) -> AsyncGenerator[T, None]:
+        """生成のチャンクを最初から受け取る（生成が失敗した場合はそのエラーを送出）"""
+        flight.subscribers += 1
+        index = 0
+        try:
+            while True:
+                while index < len(flight.chunks):
+                    yield flight.chunks[index]
+                    index += 1
+                if flight.done:
+                    break
+                await flight.changed.wait()
+            if flight.error is not None:
+                raise flight.error
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                # 誰も受け取らなくなった生成は止める
+                self.cancelled += 1
+                self._forget(flight)
+                flight.task.cancel()
+
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self.in_flight(),
+            "started": self.started,
+            "joined": self.joined,
+            "cancelled": self.cancelled,
+        }
+
+    async def _pump(self, flight: Flight[T], produce: Callable[[], AsyncIterator[T]]):
+        try:
+            async for chunk in produce():
+                flight.chunks.append(chunk)
+                flight.notify()
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            self._forget(flight)
+            flight.notify()
+
+    def _forget(self, flight: Flight):
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
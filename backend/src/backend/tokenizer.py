@@ -0,0 +1,152 @@
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, Optional, Tuple
+import math
+import re
+
+# ひらがな・カタカナ・CJK統合漢字・ハングル・全角記号（1文字が概ね1トークン以上になる文字）
+_CJK_PATTERN = re.compile(
+    r"[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]"
+)
+
+# role等の区切りとして1メッセージごとに加算されるトークン数
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+class Tokenizer(ABC):
+    """テキストのトークン数を数えるインターフェース"""
+
+    name = "base"
+
+    @abstractmethod
+    def count(self, text: str) -> int:
+        """テキストのトークン数"""
+
+    def count_message(self, content: str) -> int:
+        """1メッセージ分のトークン数（区切りのオーバーヘッドを含む）"""
+        return self.count(content) + MESSAGE_OVERHEAD_TOKENS
+
+
+class HeuristicTokenizer(Tokenizer):
+    """文字種ごとの係数でトークン数を見積もるトークナイザー（外部ライブラリ不要）
+
+    ASCIIは数文字で1トークンになるが、日本語や中国語は1文字が1トークン前後になるため、
+    文字数を一律に割る見積もりより大きく外れにくい。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        ascii_chars_per_token: float = 4.0,
+        cjk_tokens_per_char: float = 1.0,
+        other_tokens_per_char: float = 0.5
+    ):
+        self.name = name
+        self.ascii_chars_per_token = ascii_chars_per_token
+        self.cjk_tokens_per_char = cjk_tokens_per_char
+        self.other_tokens_per_char = other_tokens_per_char
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+
+        ascii_chars = len(text.encode("ascii", "ignore"))
+        cjk_chars = len(_CJK_PATTERN.findall(text))
+        other_chars = len(text) - ascii_chars - cjk_chars
+
+        return math.ceil(
+            ascii_chars / self.ascii_chars_per_token
+            + cjk_chars * self.cjk_tokens_per_char
+            + other_chars * self.other_tokens_per_char
+        )
+
+
+class TiktokenTokenizer(Tokenizer):
+    """tiktokenによる正確なトークン数（OpenAIのモデル用、tiktokenがインストールされている場合のみ）"""
+
+    def __init__(self, encoding):
+        self.name = f"tiktoken-{encoding.name}"
+        self._encoding = encoding
+
+    def count(self, text: str) -> int:
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+
+# メッセージに保存するトークン数の計算に使うトークナイザー
+DEFAULT_TOKENIZER = HeuristicTokenizer("heuristic-v1")
+
+# プロバイダー種別ごとのトークナイザーの生成関数（引数はモデル名）
+_tokenizer_factories: Dict[str, Callable[[str], Tokenizer]] = {}
+_tokenizers: Dict[Tuple[str, str], Tokenizer] = {}
+
+
+def register_tokenizer(provider_type: str, factory: Callable[[str], Tokenizer]):
+    """プロバイダー種別に対するトークナイザーを登録"""
+    _tokenizer_factories[provider_type] = factory
+    for key in [key for key in _tokenizers if key[0] == provider_type]:
+        del _tokenizers[key]
+
+
+def get_tokenizer(provider_type: Optional[str], model_name: str = "") -> Tokenizer:
+    """プロバイダー種別とモデル名に対応するトークナイザーを取得（未登録ならデフォルト）"""
+    key = (provider_type or "", model_name)
+    tokenizer = _tokenizers.get(key)
+    if tokenizer is None:
+        factory = _tokenizer_factories.get(provider_type or "")
+        tokenizer = (factory(model_name) if factory else None) or DEFAULT_TOKENIZER
+        _tokenizers[key] = tokenizer
+    return tokenizer
+
+
+def _openai_tokenizer(model_name: str) -> Optional[Tokenizer]:
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+
+    try:
+        encoding = tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        encoding = tiktoken.get_encoding("o200k_base")
+    return TiktokenTokenizer(encoding)
+
+
+register_tokenizer("openai", _openai_tokenizer)
+
+
+# モデル名のプレフィックスごとのコンテキストウィンドウ（最長一致）
+CONTEXT_WINDOWS: List[Tuple[str, int]] = [
+    ("gpt-3.5-turbo", 16385),
+    ("gpt-4", 8192),
+    ("gpt-4-32k", 32768),
+    ("gpt-4-turbo", 128000),
+    ("gpt-4o", 128000),
+    ("gpt-4.1", 1047576),
+    ("gpt-5", 400000),
+    ("o1", 200000),
+    ("o3", 200000),
+    ("o4", 200000),
+    ("claude", 200000),
+    ("gemini", 1048576),
+    ("gemini-1.0", 32760),
+    ("gemini-pro", 32760),
+]
+
+# プロバイダー種別ごとの既定値（Ollamaはnum_ctxを指定しない場合のサーバー既定値）
+PROVIDER_CONTEXT_WINDOWS: Dict[str, int] = {
+    "ollama": 4096,
+}
+
+DEFAULT_CONTEXT_WINDOW = 8192
+
+
+def get_context_window(provider_type: Optional[str], model_name: str) -> int:
+    """モデルのコンテキストウィンドウ（トークン数）を取得"""
+    if provider_type in PROVIDER_CONTEXT_WINDOWS:
+        return PROVIDER_CONTEXT_WINDOWS[provider_type]
+
+    model_lower = (model_name or "").lower()
+    best_prefix, best_window = "", DEFAULT_CONTEXT_WINDOW
+    for prefix, window in CONTEXT_WINDOWS:
+        if model_lower.startswith(prefix) and len(prefix) > len(best_prefix):
+            best_prefix, best_window = prefix, window
+    return best_window
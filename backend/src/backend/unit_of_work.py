@@ -0,0 +1,65 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import set_committed_value
+from typing import Optional
+
+from .models import Conversation, LLMProvider, Message
+
+
+class ChatUnitOfWork:
+    """チャット1ターン分のメッセージ永続化をまとめるクラス
+
+    - ユーザーメッセージはLLM呼び出し前に1回のコミットで保存する
+    - アシスタントメッセージの保存と会話の更新（updated_at・版数・サマリー）は
+      INSERT時のイベントで同じトランザクション内に行われるため、コミットは1回
+    - id / created_at / path / version はINSERT時に確定するためrefreshしない
+    """
+
+    def __init__(self, db: AsyncSession, conversation: Conversation):
+        self.db = db
+        self.conversation = conversation
+        # ロールバックで期限切れになっても参照できるようにIDを保持
+        self.conversation_id = conversation.id
+
+    async def add_user_message(self, content: str, parent_id: Optional[int] = None) -> Message:
+        """ユーザーメッセージを保存"""
+        return await self._add_message("user", content, parent_id)
+
+    async def add_assistant_message(
+        self,
+        content: str,
+        parent_id: Optional[int],
+        provider: Optional[LLMProvider] = None
+    ) -> Message:
+        """アシスタントメッセージを保存（会話の更新も同じトランザクション、providerは応答したプロバイダー）"""
+        return await self._add_message(
+            "assistant",
+            content,
+            parent_id,
+            provider_name=provider.name if provider is not None else None,
+            model_name=provider.model_name if provider is not None else None
+        )
+
+    async def release(self):
+        """読み込みトランザクションを終了し、接続をプールに返す
+
+        LLMの応答を待つ間に接続やSQLiteのスナップショットを保持しないようにする。
+        書き込みがないためfsyncは発生しない。
+        """
+        await self.db.commit()
+
+    async def _add_message(self, role: str, content: str, parent_id: Optional[int], **fields) -> Message:
+        message = Message(
+            conversation_id=self.conversation_id,
+            parent_id=parent_id,
+            role=role,
+            content=content,
+            **fields
+        )
+        self.db.add(message)
+        await self.db.commit()
+
+        # DB上の会話はINSERT時のイベントで更新済みのため、読み込み済みの値だけ合わせる
+        set_committed_value(self.conversation, "updated_at", message.created_at)
+        set_committed_value(self.conversation, "last_activity_at", message.created_at)
+        set_committed_value(self.conversation, "version", message.version)
+        return message
@@ -0,0 +1,125 @@
+import asyncio
+import os
+from datetime import datetime, timezone
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+import pytest
+from httpx import AsyncClient
+import httpx
+from asgi_lifespan import LifespanManager
+
+# Set in-memory database before importing the app
+os.environ["DATABASE_URL"] = "sqlite+aiosqlite:///:memory:"
+
+
+from backend.main import app
+from backend.database import Base, engine
+from backend.health import HealthMonitor
+from backend.llm_service import LLMService
+from backend.models import LLMProvider
+from backend.provider_adapters import ADAPTERS, ProviderAdapter
+from backend.resilience import ResilientExecutor
+from backend.response_cache import ResponseCache
+from backend.scheduler import RequestScheduler
+from backend.schemas import MessageResponse
+
+import pytest_asyncio
+
+
+@pytest_asyncio.fixture(scope="session", autouse=True)
+async def setup_db():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    yield
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+
+@pytest_asyncio.fixture()
+async def client():
+    async with LifespanManager(app):
+        transport = httpx.ASGITransport(app=app)
+        async with AsyncClient(transport=transport, base_url="http://test") as ac:
+            yield ac
+
+
+async def echo(model_name: str, messages: List[Dict[str, str]]) -> AsyncIterator[str]:
+    """最後のメッセージをそのまま返す応答"""
+    yield messages[-1]["content"]
+
+
+class StubAdapter(ProviderAdapter):
+    """テスト用のアダプター（応答はrespond・choicesで差し替え、呼び出しとキャンセルをモデル名で記録する）"""
+
+    provider_type = "test-stub"
+    respond: Callable[[str, List[Dict[str, str]]], AsyncIterator[str]] = echo
+    # 設定すると1回のリクエストで複数の候補を返すプロバイダーとして振る舞う
+    choices: Optional[Callable[..., AsyncIterator]] = None
+    native_choices = False
+    calls: List[str] = []
+    cancelled: List[str] = []
+
+    @classmethod
+    def reset(cls):
+        cls.respond = echo
+        cls.choices = None
+        cls.native_choices = False
+        cls.calls = []
+        cls.cancelled = []
+
+    async def stream(self, model_name, messages, max_tokens, temperature):
+        StubAdapter.calls.append(model_name)
+        try:
+            async for chunk in StubAdapter.respond(model_name, messages):
+                yield chunk
+        except asyncio.CancelledError:
+            StubAdapter.cancelled.append(model_name)
+            raise
+
+    async def stream_choices(self, model_name, messages, max_tokens, temperature, n):
+        if StubAdapter.choices is None:
+            choices = super().stream_choices(model_name, messages, max_tokens, temperature, n)
+        else:
+            choices = StubAdapter.choices(model_name, messages, n)
+        async for choice in choices:
+            yield choice
+
+
+@pytest.fixture
+def stub_adapter():
+    """StubAdapterを"test-stub"として登録（テストの終了時に登録を外す）"""
+    StubAdapter.reset()
+    ADAPTERS[StubAdapter.provider_type] = StubAdapter
+    yield StubAdapter
+    del ADAPTERS[StubAdapter.provider_type]
+    StubAdapter.reset()
+
+
+def stub_provider(provider_id: int, model_name: str, name: Optional[str] = None) -> LLMProvider:
+    return LLMProvider(
+        id=provider_id, name=name or f"stub-{model_name}", provider_type=StubAdapter.provider_type, model_name=model_name
+    )
+
+
+def service(
+    fallbacks: Optional[Dict[int, List[LLMProvider]]] = None,
+    cache: Optional[ResponseCache] = None,
+    health: Optional[HealthMonitor] = None,
+    **executor_options
+) -> LLMService:
+    """他のテストと状態を共有しないLLMService（既定ではキャッシュなし・再試行の待ち時間なし）"""
+    executor_options.setdefault("base_delay", 0)
+    llm = LLMService(
+        cache=cache or ResponseCache(enabled=False),
+        scheduler=RequestScheduler(queue_timeout=None),
+        resilience=ResilientExecutor(**executor_options),
+        health=health or HealthMonitor()
+    )
+    llm.fallback_resolver = lambda provider: (fallbacks or {}).get(provider.id, [])
+    return llm
+
+
+def history(content: str) -> List[MessageResponse]:
+    """ユーザーメッセージ1つだけの履歴"""
+    return [MessageResponse(
+        id=1, conversation_id=1, parent_id=None, role="user", content=content, created_at=datetime.now(timezone.utc)
+    )]
@@ -1,33 +1,4 @@
-import os
 import pytest
-from httpx import AsyncClient
-import httpx
-from asgi_lifespan import LifespanManager
-
-# Set in-memory database before importing the app
-os.environ["DATABASE_URL"] = "sqlite+aiosqlite:///:memory:"
-
-
-from backend.main import app
-from backend.database import Base, engine
-
-import pytest_asyncio
-
-
-@pytest_asyncio.fixture(scope="session", autouse=True)
-async def setup_db():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
-    yield
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.drop_all)
-
-@pytest_asyncio.fixture()
-async def client():
-    async with LifespanManager(app):
-        transport = httpx.ASGITransport(app=app)
-        async with AsyncClient(transport=transport, base_url="http://test") as ac:
-            yield ac
 
 
 @pytest.mark.asyncio
@@ -93,3 +64,266 @@ async def test_provider_activate(client):
     assert data["id"] == provider_id
     assert data["is_active"] is True
 
+
+
+@pytest.mark.asyncio
+async def test_conversation_tree_depth_limited(client):
+    from backend.database import AsyncSessionLocal
+    from backend.models import Message
+
+    res = await client.post("/api/conversations/", json={"title": "Tree"})
+    conv_id = res.json()["id"]
+
+    # root -> a -> a1 -> a2, root -> b
+    async with AsyncSessionLocal() as db:
+        ids = {}
+        for name, parent in [("root", None), ("a", "root"), ("b", "root"), ("a1", "a"), ("a2", "a1")]:
+            message = Message(
+                conversation_id=conv_id,
+                parent_id=ids.get(parent),
+                role="user",
+                content=name
+            )
+            db.add(message)
+            await db.flush()
+            ids[name] = message.id
+        await db.commit()
+
+    res = await client.get(f"/api/conversations/{conv_id}/tree")
+    assert res.status_code == 200
+    root = res.json()["root_messages"][0]
+    assert [c["content"] for c in root["children"]] == ["a", "b"]
+    assert root["children"][0]["children"][0]["children"][0]["content"] == "a2"
+
+    res = await client.get(f"/api/conversations/{conv_id}/tree", params={"max_depth": 1})
+    root = res.json()["root_messages"][0]
+    a = root["children"][0]
+    assert a["children"] == [] and a["child_count"] == 1
+    assert root["child_count"] == 2
+
+    # 未展開ノードを起点に続きを取得
+    res = await client.get(
+        f"/api/conversations/{conv_id}/tree",
+        params={"root_id": ids["a"], "max_depth": 1}
+    )
+    roots = res.json()["root_messages"]
+    assert [r["content"] for r in roots] == ["a"]
+    assert roots[0]["children"][0]["content"] == "a1"
+    assert roots[0]["children"][0]["child_count"] == 1
+
+    res = await client.get(f"/api/conversations/{conv_id}/tree", params={"root_id": 999999})
+    assert res.status_code == 404
+
+    await client.delete(f"/api/conversations/{conv_id}")
+
+
+@pytest.mark.asyncio
+async def test_conversation_skeleton_and_bodies(client):
+    from backend.database import AsyncSessionLocal
+    from backend.models import Message
+
+    res = await client.post("/api/conversations/", json={"title": "Skeleton"})
+    conv_id = res.json()["id"]
+
+    async with AsyncSessionLocal() as db:
+        root = Message(conversation_id=conv_id, parent_id=None, role="user", content="あ" * 500)
+        db.add(root)
+        await db.flush()
+        reply = Message(conversation_id=conv_id, parent_id=root.id, role="assistant", content="reply")
+        db.add(reply)
+        await db.commit()
+        root_id, reply_id = root.id, reply.id
+
+    res = await client.get(f"/api/conversations/{conv_id}/skeleton", params={"preview_length": 10})
+    assert res.status_code == 200
+    nodes = res.json()["messages"]
+    assert [n["id"] for n in nodes] == [root_id, reply_id]
+    assert nodes[0]["preview"] == "あ" * 10
+    assert nodes[0]["child_count"] == 1
+    assert nodes[1]["parent_id"] == root_id
+    assert "content" not in nodes[0]
+
+    res = await client.post(
+        f"/api/conversations/{conv_id}/messages/batch",
+        json={"ids": [reply_id, root_id, 999999]}
+    )
+    assert res.status_code == 200
+    bodies = res.json()["messages"]
+    assert [b["id"] for b in bodies] == [reply_id, root_id]
+    assert bodies[1]["content"] == "あ" * 500
+
+    await client.delete(f"/api/conversations/{conv_id}")
+
+
+@pytest.mark.asyncio
+async def test_conversation_changes_since_version(client):
+    from backend.database import AsyncSessionLocal
+    from backend.models import Message
+
+    res = await client.post("/api/conversations/", json={"title": "Sync"})
+    conv_id = res.json()["id"]
+    assert res.json()["version"] == 0
+
+    async with AsyncSessionLocal() as db:
+        root = Message(conversation_id=conv_id, role="user", content="root")
+        db.add(root)
+        await db.commit()
+        root_id = root.id
+
+    res = await client.get(f"/api/conversations/{conv_id}/tree")
+    base_version = res.json()["version"]
+    assert base_version == 1
+
+    async with AsyncSessionLocal() as db:
+        db.add(Message(conversation_id=conv_id, parent_id=root_id, role="assistant", content="reply"))
+        await db.commit()
+
+    res = await client.get(f"/api/conversations/{conv_id}/changes", params={"since": base_version})
+    data = res.json()
+    assert data["full_snapshot"] is False
+    assert data["version"] == 2
+    assert [m["content"] for m in data["messages"]] == ["reply"]
+
+    await client.put(f"/api/conversations/{conv_id}/title", json={"title": "Renamed"})
+    res = await client.get(f"/api/conversations/{conv_id}/changes", params={"since": 2})
+    data = res.json()
+    assert data["version"] == 3 and data["title"] == "Renamed"
+    assert data["messages"] == []
+
+    # クライアントの版数が現在より新しい場合は全体を返す
+    res = await client.get(f"/api/conversations/{conv_id}/changes", params={"since": 99})
+    data = res.json()
+    assert data["full_snapshot"] is True
+    assert len(data["messages"]) == 2
+
+    await client.delete(f"/api/conversations/{conv_id}")
+
+
+@pytest.mark.asyncio
+async def test_conversation_list_summary_and_cursor(client):
+    from backend.database import AsyncSessionLocal
+    from backend.models import Message
+
+    conv_ids = []
+    for title in ["first", "second", "third"]:
+        res = await client.post("/api/conversations/", json={"title": title})
+        conv_ids.append(res.json()["id"])
+
+    async with AsyncSessionLocal() as db:
+        root = Message(conversation_id=conv_ids[0], role="user", content="hello")
+        db.add(root)
+        await db.flush()
+        db.add(Message(conversation_id=conv_ids[0], parent_id=root.id, role="assistant", content="latest reply"))
+        await db.commit()
+
+    res = await client.get("/api/conversations/", params={"limit": 2})
+    page = res.json()
+    # メッセージが追加された会話が先頭に来る
+    assert [c["id"] for c in page] == [conv_ids[0], conv_ids[2]]
+    assert page[0]["message_count"] == 2
+    assert page[0]["last_message_preview"] == "latest reply"
+    assert page[1]["message_count"] == 0
+
+    cursor = res.headers["X-Next-Cursor"]
+    res = await client.get("/api/conversations/", params={"limit": 2, "cursor": cursor})
+    assert [c["id"] for c in res.json()] == [conv_ids[1]]
+    assert "X-Next-Cursor" not in res.headers
+
+    res = await client.get("/api/conversations/", params={"cursor": "not-a-cursor"})
+    assert res.status_code == 400
+
+    for conv_id in conv_ids:
+        await client.delete(f"/api/conversations/{conv_id}")
+
+
+@pytest.mark.asyncio
+async def test_chat_send_commits_once_per_message(client, monkeypatch):
+    from sqlalchemy import event
+    from backend.database import engine
+    from backend.models import LLMProvider
+    from backend.routers import chat
+
+    async def fake_provider(db):
+        return LLMProvider(name="openai", model_name="gpt-4o")
+
+    async def fake_response(provider, messages, **kwargs):
+        return f"echo {messages[-1].content}"
+
+    monkeypatch.setattr(chat.provider_registry, "get_active", fake_provider)
+    monkeypatch.setattr(chat.llm_service, "generate_response", fake_response)
+
+    res = await client.post("/api/conversations/", json={"title": "UoW"})
+    conv_id = res.json()["id"]
+
+    commits = []
+    listener = lambda conn: commits.append(conn)
+    event.listen(engine.sync_engine, "commit", listener)
+    try:
+        res = await client.post("/api/chat/send", json={"conversation_id": conv_id, "message": "hi"})
+    finally:
+        event.remove(engine.sync_engine, "commit", listener)
+
+    assert res.status_code == 200
+    data = res.json()
+    assert data["assistant_message"]["content"] == "echo hi"
+    assert data["assistant_message"]["parent_id"] == data["user_message"]["id"]
+    # ユーザーメッセージ、読み込みトランザクションの終了、アシスタントメッセージ
+    assert len(commits) <= 3
+
+    res = await client.get(f"/api/conversations/{conv_id}")
+    assert res.json()["version"] == data["assistant_message"]["version"]
+    res = await client.get("/api/conversations/")
+    summary = next(c for c in res.json() if c["id"] == conv_id)
+    assert summary["message_count"] == 2
+    assert summary["last_message_preview"] == "echo hi"
+
+    # プロバイダーがない場合もユーザーメッセージへの応答としてエラーを返す
+    async def no_provider(db):
+        return None
+
+    monkeypatch.setattr(chat.provider_registry, "get_active", no_provider)
+    res = await client.post("/api/chat/send", json={"conversation_id": conv_id, "message": "again"})
+    assert res.status_code == 200
+    data = res.json()
+    assert data["assistant_message"]["parent_id"] == data["user_message"]["id"]
+
+    await client.delete(f"/api/conversations/{conv_id}")
+
+
+@pytest.mark.asyncio
+async def test_regenerate_releases_the_session_while_generating(client, monkeypatch):
+    from sqlalchemy import event
+    from backend.database import engine
+    from backend.models import LLMProvider
+    from backend.routers import chat
+
+    async def fake_provider(db):
+        return LLMProvider(name="openai", model_name="gpt-4o")
+
+    events = []
+
+    async def fake_response(provider, messages, **kwargs):
+        events.append("generate")
+        return f"again {messages[-1].content}"
+
+    monkeypatch.setattr(chat.provider_registry, "get_active", fake_provider)
+    monkeypatch.setattr(chat.llm_service, "generate_response", fake_response)
+
+    res = await client.post("/api/conversations/", json={"title": "Regenerate"})
+    conv_id = res.json()["id"]
+    res = await client.post("/api/chat/send", json={"conversation_id": conv_id, "message": "hi"})
+    message_id = res.json()["assistant_message"]["id"]
+    events.clear()
+
+    listener = lambda conn: events.append("commit")
+    event.listen(engine.sync_engine, "commit", listener)
+    try:
+        res = await client.post(f"/api/chat/regenerate/{message_id}")
+    finally:
+        event.remove(engine.sync_engine, "commit", listener)
+
+    assert res.json()["content"] == "again hi"
+    # 読み込みトランザクションを終えてから生成し、保存のときに接続を取り直す
+    assert events == ["commit", "generate", "commit"]
+
+    await client.delete(f"/api/conversations/{conv_id}")
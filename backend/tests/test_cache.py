@@ -0,0 +1,78 @@
+import pytest
+
+from backend.cache import HISTORY, TREE, LRUCache, history_cache
+from backend.database import AsyncSessionLocal
+from backend.history import get_conversation_history, load_conversation_tree
+from backend.models import Conversation, Message
+
+
+def test_lru_eviction_by_entries_and_bytes():
+    cache = LRUCache(max_entries=2, max_bytes=10_000)
+    cache.set((HISTORY, 1, 1), "a", 10)
+    cache.set((HISTORY, 1, 2), "b", 10)
+    assert cache.get((HISTORY, 1, 1)) == "a"
+
+    # 最も古く使われた (1, 2) が追い出される
+    cache.set((HISTORY, 1, 3), "c", 10)
+    assert cache.get((HISTORY, 1, 2)) is None
+    assert cache.stats()["evictions"] == 1
+
+    cache.set((HISTORY, 2, 1), "big", 9_000)
+    assert cache.stats()["bytes"] <= 10_000
+    assert cache.get((HISTORY, 2, 1)) == "big"
+
+    stats = cache.stats()
+    assert stats["hits"] == 2 and stats["misses"] == 1
+
+
+def test_invalidation_by_conversation_and_kind():
+    cache = LRUCache()
+    cache.set((HISTORY, 1, 1), "history", 10)
+    cache.set((TREE, 1, None, None), "tree", 10)
+    cache.set((TREE, 2, None, None), "other", 10)
+
+    cache.invalidate(1, [TREE])
+    assert cache.get((TREE, 1, None, None)) is None
+    assert cache.get((HISTORY, 1, 1)) == "history"
+    assert cache.get((TREE, 2, None, None)) == "other"
+
+    # 無効化前に読み込みを開始した値は格納されない
+    generation = cache.generation(1, HISTORY)
+    cache.invalidate(1)
+    cache.set((HISTORY, 1, 2), "stale", 10, generation)
+    assert cache.get((HISTORY, 1, 2)) is None
+
+
+@pytest.mark.asyncio
+async def test_writes_invalidate_cached_trees_and_history(client):
+    async with AsyncSessionLocal() as db:
+        conversation = Conversation(title="Cache")
+        db.add(conversation)
+        await db.flush()
+        root = Message(conversation_id=conversation.id, role="user", content="root")
+        db.add(root)
+        await db.flush()
+        reply = Message(conversation_id=conversation.id, parent_id=root.id, role="assistant", content="reply")
+        db.add(reply)
+        await db.commit()
+
+        tree = await load_conversation_tree(conversation.id, db)
+        assert await load_conversation_tree(conversation.id, db) is tree
+        history = await get_conversation_history(conversation.id, reply.id, db)
+        assert [m.content for m in history] == ["root", "reply"]
+
+        # 追加ではツリーのみ無効化され、祖先チェーンは再利用される
+        db.add(Message(conversation_id=conversation.id, parent_id=root.id, role="assistant", content="branch"))
+        await db.commit()
+        assert await load_conversation_tree(conversation.id, db) is not tree
+        assert history_cache.peek((HISTORY, conversation.id, reply.id)) is not None
+
+        # 本文の更新（再生成）では履歴も無効化される
+        reply.content = "regenerated"
+        await db.commit()
+        history = await get_conversation_history(conversation.id, reply.id, db)
+        assert [m.content for m in history] == ["root", "regenerated"]
+
+        await db.delete(conversation)
+        await db.commit()
+        assert history_cache.peek((HISTORY, conversation.id, reply.id)) is None
@@ -0,0 +1,119 @@
+import pytest
+
+from backend import compaction
+from backend.compaction import SUMMARY_PREFIX, compact_history
+from backend.database import AsyncSessionLocal
+from backend.history import get_conversation_history
+from backend.models import LLMProvider, Message
+from tests.test_history import create_chain
+
+PROVIDER = LLMProvider(name="stub", model_name="gpt-4o")
+
+
+class StubSummarizer:
+    """呼び出しを記録し、要約対象のIDを並べた文字列を返す要約器"""
+
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, provider, previous_summary, messages):
+        self.calls.append([m.id for m in messages])
+        covered = previous_summary.split(",") if previous_summary else []
+        return ",".join(covered + [str(m.id) for m in messages])
+
+
+@pytest.fixture(autouse=True)
+def enable_compaction(monkeypatch):
+    # 既定では無効のため、このファイルのテストでは有効にする
+    monkeypatch.setattr(compaction, "HISTORY_COMPACTION", True)
+
+
+@pytest.mark.asyncio
+async def test_compaction_replaces_old_ancestors_with_summary(client):
+    async with AsyncSessionLocal() as db:
+        conversation, ids = await create_chain(db, 12)
+        history = await get_conversation_history(conversation.id, ids[-1], db)
+        budget = history[-1].token_count * 6
+
+        summarizer = StubSummarizer()
+        compacted = await compact_history(history, PROVIDER, budget=budget, summarizer=summarizer)
+
+        summary, kept = compacted[0], compacted[1:]
+        assert summary.role == "system"
+        assert summary.content == SUMMARY_PREFIX + ",".join(str(i) for i in ids[:9])
+        assert [m.id for m in kept] == ids[9:]
+        # 要約の入力も予算内に収まるよう区切って積み上げる
+        assert summarizer.calls == [ids[:6], ids[6:9]]
+
+        # 予算内の履歴はそのまま
+        assert await compact_history(history[-3:], PROVIDER, budget=budget, summarizer=summarizer) == history[-3:]
+
+        await db.delete(conversation)
+        await db.commit()
+
+
+@pytest.mark.asyncio
+async def test_sibling_branches_reuse_shared_summary(client):
+    async with AsyncSessionLocal() as db:
+        conversation, ids = await create_chain(db, 12)
+        sibling = Message(conversation_id=conversation.id, parent_id=ids[-2], role="assistant", content="message x")
+        db.add(sibling)
+        await db.commit()
+
+        history = await get_conversation_history(conversation.id, ids[-1], db)
+        budget = history[-1].token_count * 6
+
+        summarizer = StubSummarizer()
+        await compact_history(history, PROVIDER, budget=budget, summarizer=summarizer)
+        calls = len(summarizer.calls)
+
+        sibling_history = await get_conversation_history(conversation.id, sibling.id, db)
+        compacted = await compact_history(sibling_history, PROVIDER, budget=budget, summarizer=summarizer)
+
+        # 共有部分の要約を再利用し、再要約しない
+        assert len(summarizer.calls) == calls
+        assert compacted[0].role == "system"
+        assert compacted[-1].id == sibling.id
+
+        # 祖先の本文が変わると要約は無効化される
+        root = await db.get(Message, ids[0])
+        root.content = "changed"
+        await db.commit()
+        history = await get_conversation_history(conversation.id, ids[-1], db)
+        await compact_history(history, PROVIDER, budget=budget, summarizer=summarizer)
+        assert len(summarizer.calls) > calls
+
+        await db.delete(conversation)
+        await db.commit()
+
+
+@pytest.mark.asyncio
+async def test_failed_summary_falls_back_to_history(client):
+    async with AsyncSessionLocal() as db:
+        conversation, ids = await create_chain(db, 12)
+        history = await get_conversation_history(conversation.id, ids[-1], db)
+
+        async def failing(provider, previous_summary, messages):
+            raise RuntimeError("provider down")
+
+        budget = history[-1].token_count * 6
+        assert await compact_history(history, PROVIDER, budget=budget, summarizer=failing) == history
+
+        await db.delete(conversation)
+        await db.commit()
+
+
+@pytest.mark.asyncio
+async def test_compaction_is_opt_in(client, monkeypatch):
+    monkeypatch.setattr(compaction, "HISTORY_COMPACTION", False)
+    async with AsyncSessionLocal() as db:
+        conversation, ids = await create_chain(db, 12)
+        history = await get_conversation_history(conversation.id, ids[-1], db)
+
+        summarizer = StubSummarizer()
+        budget = history[-1].token_count * 6
+        assert await compact_history(history, PROVIDER, budget=budget, summarizer=summarizer) == history
+        assert summarizer.calls == []
+
+        await db.delete(conversation)
+        await db.commit()
@@ -0,0 +1,61 @@
+import pytest
+from sqlalchemy import text
+from sqlalchemy.pool import AsyncAdaptedQueuePool, StaticPool
+
+from backend.database import build_engine, sqlite_settings
+
+
+@pytest.fixture(autouse=True)
+def no_overrides(monkeypatch):
+    for name in ("SQLITE_JOURNAL_MODE", "SQLITE_SYNCHRONOUS", "SQLITE_BUSY_TIMEOUT", "SQLITE_MMAP_SIZE",
+                 "SQLITE_CACHE_SIZE", "DB_POOL_SIZE", "DB_MAX_OVERFLOW"):
+        monkeypatch.delenv(name, raising=False)
+
+
+async def pragma(engine, name):
+    async with engine.connect() as conn:
+        return (await conn.execute(text(f"PRAGMA {name}"))).scalar()
+
+
+@pytest.mark.asyncio
+async def test_production_profile_applies_pragmas_and_pool(tmp_path):
+    engine = build_engine(f"sqlite+aiosqlite:///{tmp_path / 'prod.db'}", profile="production", echo=False)
+    try:
+        assert isinstance(engine.pool, AsyncAdaptedQueuePool)
+        assert engine.pool.size() == 10
+        assert await pragma(engine, "journal_mode") == "wal"
+        assert await pragma(engine, "synchronous") == 1   # NORMAL
+        assert await pragma(engine, "busy_timeout") == 5000
+        assert await pragma(engine, "cache_size") == -64 * 1024
+    finally:
+        await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_development_profile_and_overrides(tmp_path, monkeypatch):
+    engine = build_engine(f"sqlite+aiosqlite:///{tmp_path / 'dev.db'}", profile="development", echo=False)
+    try:
+        assert engine.pool.size() == 5
+        # 設定しない項目はSQLiteのデフォルトのまま
+        assert await pragma(engine, "journal_mode") == "delete"
+        assert await pragma(engine, "synchronous") == 2   # FULL
+        assert await pragma(engine, "busy_timeout") == 5000
+    finally:
+        await engine.dispose()
+
+    memory = build_engine("sqlite+aiosqlite:///:memory:", profile="production", echo=False)
+    assert isinstance(memory.pool, StaticPool)
+    await memory.dispose()
+
+    monkeypatch.setenv("SQLITE_SYNCHRONOUS", "FULL")
+    monkeypatch.setenv("DB_POOL_SIZE", "3")
+    settings = sqlite_settings("production")
+    assert settings["synchronous"] == "FULL"
+    assert settings["pool_size"] == 3
+
+
+def test_unknown_profile_is_rejected():
+    with pytest.raises(ValueError):
+        sqlite_settings("staging")
+    with pytest.raises(ValueError):
+        build_engine("sqlite+aiosqlite:///./unused.db", profile="staging")
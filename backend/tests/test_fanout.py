@@ -0,0 +1,201 @@
+import asyncio
+import time
+
+import pytest
+
+from backend.routers import websocket_chat
+
+from conftest import StubAdapter, stub_provider
+
+
+async def delayed_echo(model_name, messages):
+    """モデル名で指定した秒数だけ待ってから応答する（"fail"なら失敗する）"""
+    if model_name == "fail":
+        raise RuntimeError("down")
+    await asyncio.sleep(float(model_name))
+    yield f"{model_name}: "
+    yield messages[-1]["content"]
+
+
+@pytest.fixture(autouse=True)
+def delayed_stub(stub_adapter):
+    stub_adapter.respond = delayed_echo
+    return stub_adapter
+
+
+async def create_providers(client, prefix, model_names):
+    ids = []
+    for i, model_name in enumerate(model_names):
+        res = await client.post(
+            "/api/providers/",
+            json={"name": f"{prefix}-{i}", "provider_type": StubAdapter.provider_type, "model_name": model_name}
+        )
+        ids.append(res.json()["id"])
+    return ids
+
+
+@pytest.mark.asyncio
+async def test_fan_out_creates_siblings_concurrently(client):
+    provider_ids = await create_providers(client, "fanout", ["0.3", "0.2", "fail"])
+    res = await client.post("/api/conversations/", json={"title": "Fan-out"})
+    conv_id = res.json()["id"]
+
+    start = time.perf_counter()
+    res = await client.post("/api/chat/fanout", json={
+        "conversation_id": conv_id, "message": "hi", "provider_ids": provider_ids, "bypass_cache": True
+    })
+    elapsed = time.perf_counter() - start
+
+    assert res.status_code == 200
+    data = res.json()
+    user_id = data["user_message"]["id"]
+    replies = data["assistant_messages"]
+    assert [reply["provider_id"] for reply in replies] == provider_ids
+    assert [reply["message"]["content"] for reply in replies[:2]] == ["0.3: hi", "0.2: hi"]
+    assert "エラー" in replies[2]["message"]["content"]
+    assert all(reply["message"]["parent_id"] == user_id for reply in replies)
+    # 合計（0.5秒）ではなく最も遅いプロバイダー（0.3秒）程度で終わる
+    assert elapsed < 0.45
+
+    res = await client.get(f"/api/conversations/{conv_id}/tree")
+    user_node = res.json()["root_messages"][0]
+    assert len(user_node["children"]) == 3
+
+    # 存在しないプロバイダーや重複はユーザーメッセージを保存せずにエラー
+    res = await client.post("/api/chat/fanout", json={"conversation_id": conv_id, "message": "x", "provider_ids": [999999]})
+    assert res.status_code == 404
+    res = await client.post("/api/chat/fanout", json={"conversation_id": conv_id, "message": "x", "provider_ids": provider_ids[:1] * 2})
+    assert res.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_websocket_fan_out_tags_chunks_by_provider(client, monkeypatch):
+    provider_ids = await create_providers(client, "ws-fanout", ["0.05", "0"])
+    res = await client.post("/api/conversations/", json={"title": "WS fan-out"})
+    conv_id = res.json()["id"]
+
+    sent = []
+
+    async def record(data, client_id):
+        sent.append(data)
+
+    monkeypatch.setattr(websocket_chat.manager, "send_json_message", record)
+    await websocket_chat.handle_fan_out_message(
+        {"type": "chat_fanout", "conversation_id": conv_id, "message": "yo", "provider_ids": provider_ids},
+        "client-1",
+        None
+    )
+
+    chunks = {}
+    for data in sent:
+        if data["type"] == "assistant_message_chunk":
+            chunks[data["provider_id"]] = chunks.get(data["provider_id"], "") + data["chunk"]
+    assert chunks == {provider_ids[0]: "0.05: yo", provider_ids[1]: "0: yo"}
+
+    completed = [data for data in sent if data["type"] == "assistant_message_complete"]
+    # 速いプロバイダーの応答が先に完了する
+    assert [data["provider_id"] for data in completed] == provider_ids[::-1]
+    user_id = sent[0]["message"]["id"]
+    assert all(data["message"]["parent_id"] == user_id for data in completed)
+    assert sent[-1]["type"] == "fanout_complete"
+
+
+async def create_answered_conversation(client, monkeypatch, provider):
+    from backend.routers import chat
+
+    async def active(db):
+        return provider
+
+    monkeypatch.setattr(chat.provider_registry, "get_active", active)
+    res = await client.post("/api/conversations/", json={"title": "Alternatives"})
+    conv_id = res.json()["id"]
+    res = await client.post("/api/chat/send", json={"conversation_id": conv_id, "message": "hi"})
+    return conv_id, res.json()
+
+
+@pytest.mark.asyncio
+async def test_regenerate_alternatives_in_parallel(client, monkeypatch):
+    provider = stub_provider(-1, "0.2", name="alt-stub")
+    conv_id, turn = await create_answered_conversation(client, monkeypatch, provider)
+    original = turn["assistant_message"]
+
+    start = time.perf_counter()
+    res = await client.post(f"/api/chat/regenerate/{original['id']}/alternatives?count=3")
+    elapsed = time.perf_counter() - start
+
+    assert res.status_code == 200
+    alternatives = res.json()
+    assert len(alternatives) == 3
+    assert all(a["parent_id"] == turn["user_message"]["id"] for a in alternatives)
+    assert elapsed < 0.5
+
+    # 元の応答も兄弟ノードとして残る
+    res = await client.get(f"/api/conversations/{conv_id}/tree")
+    children = res.json()["root_messages"][0]["children"]
+    assert {child["id"] for child in children} == {original["id"]} | {a["id"] for a in alternatives}
+
+
+@pytest.mark.asyncio
+async def test_regenerate_alternatives_uses_native_choices(client, monkeypatch, delayed_stub):
+    requests = []
+
+    async def single(model_name, messages):
+        requests.append(1)
+        yield "single"
+
+    async def choices(model_name, messages, n):
+        """1回のリクエストで候補を返す（nに対応しない互換APIを模して最大2個まで）"""
+        requests.append(n)
+        for part in ("a", "b"):
+            for index in range(min(n, 2)):
+                yield index, f"{part}{index}"
+        for index in range(min(n, 2)):
+            yield index, None
+
+    delayed_stub.respond = single
+    delayed_stub.choices = choices
+    delayed_stub.native_choices = True
+    provider = stub_provider(-2, "m", name="choices-stub")
+    conv_id, turn = await create_answered_conversation(client, monkeypatch, provider)
+    requests.clear()
+
+    res = await client.post(f"/api/chat/regenerate/{turn['assistant_message']['id']}/alternatives?count=3")
+
+    assert [a["content"] for a in res.json()] == ["a0b0", "a1b1", "single"]
+    # 2個は1回のリクエストで、返らなかった残りは個別に生成
+    assert requests == [3, 1]
+
+
+@pytest.mark.asyncio
+async def test_regenerate_alternatives_never_fail_over(client, monkeypatch, delayed_stub):
+    from backend.llm_service import llm_service
+
+    backup = stub_provider(-5, "0", name="alt-backup")
+    monkeypatch.setattr(llm_service, "fallback_resolver", lambda p: [backup] if p.id == -4 else [])
+    provider = stub_provider(-4, "fail", name="alt-failing")
+    conv_id, turn = await create_answered_conversation(client, monkeypatch, provider)
+    delayed_stub.calls.clear()
+
+    res = await client.post(f"/api/chat/regenerate/{turn['assistant_message']['id']}/alternatives?count=2")
+
+    # 別の応答は全て指定したプロバイダーのもの（失敗しても代替プロバイダーの応答にしない）
+    assert all("エラー" in a["content"] for a in res.json())
+    assert delayed_stub.calls == ["fail", "fail"]
+
+
+@pytest.mark.asyncio
+async def test_regenerate_without_active_provider_is_client_error(client, monkeypatch):
+    provider = stub_provider(-3, "0", name="none-stub")
+    conv_id, turn = await create_answered_conversation(client, monkeypatch, provider)
+
+    from backend.routers import chat
+
+    async def no_provider(db):
+        return None
+
+    monkeypatch.setattr(chat.provider_registry, "get_active", no_provider)
+    message_id = turn["assistant_message"]["id"]
+    res = await client.post(f"/api/chat/regenerate/{message_id}")
+    assert res.status_code == 400
+    res = await client.post(f"/api/chat/regenerate/{message_id}/alternatives")
+    assert res.status_code == 400
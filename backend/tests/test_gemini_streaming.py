@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+import google.generativeai as genai
+from google.ai import generativelanguage as glm
+
+from backend.provider_adapters import GeminiAdapter
+
+
+def make_chunk(text):
+    """SDKが返すストリーミングチャンク（Noneならテキストのない候補）"""
+    if text is None:
+        return glm.GenerateContentResponse(candidates=[glm.Candidate(finish_reason="SAFETY")])
+    return glm.GenerateContentResponse(
+        candidates=[glm.Candidate(content=glm.Content(role="model", parts=[glm.Part(text=text)]))]
+    )
+
+
+class FakeStream:
+    """生成したチャンク数を記録するSDKのストリームの代わり"""
+
+    def __init__(self, texts):
+        self.texts = texts
+        self.produced = 0
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for text in self.texts:
+            self.produced += 1
+            yield make_chunk(text)
+            await asyncio.sleep(0)
+
+
+class FakeClient:
+    instances = []
+
+    def __init__(self, client_options=None):
+        self.client_options = client_options
+        self.requests = []
+        self.streams = []
+        FakeClient.instances.append(self)
+
+    async def stream_generate_content(self, request=None):
+        self.requests.append(request)
+        fake = FakeStream(["こんにちは、", None, "世界。", " Hello world"])
+        self.streams.append(fake)
+        return fake
+
+
+@pytest.mark.asyncio
+async def test_gemini_streams_sdk_chunks_as_they_arrive(monkeypatch):
+    def global_configure(**kwargs):
+        raise AssertionError("genai.configure changes process-wide state")
+
+    monkeypatch.setattr(genai, "configure", global_configure)
+    monkeypatch.setattr(glm, "GenerativeServiceAsyncClient", FakeClient)
+
+    async def no_sleep(delay, *args):
+        assert delay == 0, "artificial delay between chunks"
+
+    monkeypatch.setattr(asyncio, "sleep", no_sleep)
+
+    adapter = GeminiAdapter("test-key", None)
+    messages = [{"role": "user", "content": "挨拶して"}]
+    stream = adapter.stream("gemini-1.5-flash", messages, 100, 0.7)
+
+    # 最初のチャンクは残りを受信する前に届く
+    first = await stream.__anext__()
+    assert first == "こんにちは、"
+    client = FakeClient.instances[-1]
+    assert client.client_options == {"api_key": "test-key"}
+    assert client.streams[-1].produced == 1
+
+    request = client.requests[-1]
+    assert request.model == "models/gemini-1.5-flash"
+    assert request.generation_config.max_output_tokens == 100
+    assert "Human: 挨拶して" in request.contents[0].parts[0].text
+
+    rest = [chunk async for chunk in stream]
+    # チャンクの境界はそのまま（空白で分割しない）、テキストのないチャンクは読み飛ばす
+    assert rest == ["世界。", " Hello world"]
@@ -0,0 +1,145 @@
+import asyncio
+import time
+
+import pytest
+
+from backend.health import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError, HealthMonitor
+from backend.provider_adapters import TransientProviderError
+
+from conftest import StubAdapter, service, stub_provider as provider
+
+
+async def pong(model_name, messages):
+    """モデル名が"down"なら一時的なエラー、それ以外は待ち時間（秒）として扱う"""
+    if model_name == "down":
+        raise TransientProviderError("503 Service Unavailable")
+    await asyncio.sleep(float(model_name))
+    yield "pong"
+    await asyncio.sleep(float(model_name))
+    yield "!"
+
+
+@pytest.fixture(autouse=True)
+def pong_stub(stub_adapter):
+    stub_adapter.respond = pong
+    return stub_adapter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_circuit_breaker_opens_and_half_opens():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10, clock=clock)
+
+    for _ in range(3):
+        assert breaker.allow()
+        breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    assert breaker.retry_after() == 10
+
+    # 待ち時間が過ぎたら1つだけ通し、失敗すればまた開く
+    clock.now = 10
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+
+    clock.now = 20
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert breaker.allow()
+    assert breaker.opened == 1
+
+
+@pytest.mark.asyncio
+async def test_open_circuit_fails_fast_and_fails_over(pong_stub):
+    health = HealthMonitor(failure_threshold=2, reset_timeout=60)
+    llm = service(health=health, retry_attempts=0)
+    down, backup = provider(1, "down"), provider(2, "0")
+
+    for _ in range(2):
+        await llm.generate_response(down, [], failover=False)
+    assert health.stats(down)["state"] == OPEN
+    assert health.stats(down)["error_rate"] == 1.0
+
+    pong_stub.calls.clear()
+    with pytest.raises(CircuitOpenError):
+        await llm.generate_response(down, [], raise_errors=True, failover=False)
+    assert pong_stub.calls == []
+
+    llm.fallback_resolver = lambda p: [backup]
+    chunks = [chunk async for chunk in llm.generate_streaming_response(down, [])]
+    assert "".join(chunks) == "pong!"
+    stats = health.stats(backup)
+    assert stats["state"] == CLOSED
+    assert stats["ttft"]["avg_ms"] is not None
+
+
+@pytest.mark.asyncio
+async def test_probes_run_concurrently_and_close_recovered_circuits():
+    health = HealthMonitor(probe_timeout=1, failure_threshold=2, reset_timeout=60)
+    llm = service(health=health)
+    slow, down, hung = provider(1, "0.05"), provider(2, "down"), provider(3, "5")
+
+    start = time.perf_counter()
+    for _ in range(2):
+        await health.probe_all([slow, down, hung], llm.probe)
+    assert time.perf_counter() - start < 3
+
+    slow_stats = health.stats(slow)
+    assert slow_stats["last_probe_ok"] is True
+    assert slow_stats["ttft"]["avg_ms"] >= 50
+    assert slow_stats["latency"]["avg_ms"] >= 100
+    assert health.stats(down)["state"] == OPEN
+    assert health.stats(hung)["state"] == OPEN   # タイムアウトも失敗に数える
+
+    # 確認はブレーカーが開いていても送信し、成功すれば閉じる
+    hung.model_name = "0"
+    await health.probe_all([slow, hung], llm.probe)
+    assert health.stats(hung)["state"] == CLOSED
+
+
+@pytest.mark.asyncio
+async def test_provider_status_endpoint(client):
+    res = await client.post("/api/providers/", json={"name": "status-stub", "provider_type": StubAdapter.provider_type, "model_name": "0"})
+    provider_id = res.json()["id"]
+    await client.post(f"/api/providers/test/{provider_id}")
+
+    res = await client.get("/api/providers/status")
+    assert res.status_code == 200
+    status = next(item for item in res.json() if item["id"] == provider_id)
+    assert status["state"] == CLOSED
+    assert status["samples"] >= 1
+    assert status["latency"]["avg_ms"] is not None
+
+
+@pytest.mark.asyncio
+async def test_background_probes_are_opt_in():
+    probed = []
+
+    async def load_providers():
+        return [provider(1, "0")]
+
+    async def probe(provider, timeout):
+        probed.append(provider)
+        return 0.0, 0.0
+
+    # 既定では確認用のリクエストを送らない
+    health = HealthMonitor()
+    health.start(load_providers, probe)
+    assert health._task is None
+
+    health = HealthMonitor(interval=0.01)
+    health.start(load_providers, probe)
+    await asyncio.sleep(0.05)
+    await health.stop()
+    assert probed
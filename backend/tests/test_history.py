@@ -0,0 +1,82 @@
+import pytest
+
+from backend.database import AsyncSessionLocal
+from backend.history import get_conversation_history, get_subtree
+from backend.models import Conversation, Message
+
+
+async def create_chain(db, depth):
+    conversation = Conversation(title="History")
+    db.add(conversation)
+    await db.flush()
+
+    parent_id = None
+    ids = []
+    for i in range(depth):
+        message = Message(
+            conversation_id=conversation.id,
+            parent_id=parent_id,
+            role="user" if i % 2 == 0 else "assistant",
+            content=f"message {i}"
+        )
+        db.add(message)
+        await db.flush()
+        ids.append(message.id)
+        parent_id = message.id
+
+    await db.commit()
+    return conversation, ids
+
+
+@pytest.mark.asyncio
+async def test_history_is_ordered_root_to_node(client):
+    async with AsyncSessionLocal() as db:
+        conversation, ids = await create_chain(db, 25)
+
+        history = await get_conversation_history(conversation.id, ids[9], db)
+        assert [m.id for m in history] == ids[:10]
+        assert history[0].parent_id is None
+
+        history = await get_conversation_history(conversation.id, ids[-1], db)
+        assert [m.id for m in history] == ids
+
+        await db.delete(conversation)
+        await db.commit()
+
+
+@pytest.mark.asyncio
+async def test_history_ignores_other_conversations(client):
+    async with AsyncSessionLocal() as db:
+        conversation, ids = await create_chain(db, 3)
+
+        assert await get_conversation_history(conversation.id + 1, ids[-1], db) == []
+        assert await get_conversation_history(conversation.id, None, db) == []
+
+        await db.delete(conversation)
+        await db.commit()
+
+
+@pytest.mark.asyncio
+async def test_subtree_uses_materialized_path(client):
+    async with AsyncSessionLocal() as db:
+        conversation, ids = await create_chain(db, 6)
+
+        # ids[2] から分岐する兄弟ブランチ
+        branch = Message(conversation_id=conversation.id, parent_id=ids[2], role="user", content="branch")
+        db.add(branch)
+        await db.commit()
+
+        assert branch.depth == 3
+        assert branch.ancestor_ids == ids[:3]
+
+        subtree = await get_subtree(conversation.id, db, root_id=ids[2])
+        assert {m.id for m in subtree} == set(ids[2:]) | {branch.id}
+
+        subtree = await get_subtree(conversation.id, db, root_id=ids[2], max_depth=1)
+        assert {m.id for m in subtree} == {ids[2], ids[3], branch.id}
+
+        history = await get_conversation_history(conversation.id, branch.id, db)
+        assert [m.id for m in history] == ids[:3] + [branch.id]
+
+        await db.delete(conversation)
+        await db.commit()
@@ -0,0 +1,90 @@
+from sqlalchemy import create_engine, inspect, text
+
+from backend.database import run_migrations
+
+
+def test_backfill_legacy_database(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+
+    # create_allで作成されていた旧スキーマ（path / depthなし）
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE conversations (id INTEGER PRIMARY KEY, title VARCHAR(255) NOT NULL, "
+            "created_at DATETIME, updated_at DATETIME)"
+        ))
+        conn.execute(text(
+            "CREATE TABLE messages (id INTEGER PRIMARY KEY, conversation_id INTEGER NOT NULL, "
+            "parent_id INTEGER, role VARCHAR(20) NOT NULL, content TEXT NOT NULL, created_at DATETIME)"
+        ))
+        conn.execute(text(
+            "CREATE TABLE llm_providers (id INTEGER PRIMARY KEY, name VARCHAR(50) NOT NULL UNIQUE, "
+            "api_key VARCHAR(255), api_url VARCHAR(255), model_name VARCHAR(100) NOT NULL, "
+            "is_active BOOLEAN, created_at DATETIME, updated_at DATETIME)"
+        ))
+        conn.execute(text("INSERT INTO conversations (id, title) VALUES (1, 'legacy')"))
+        # 子が親より小さいIDを持つケースも含める
+        for message_id, parent_id in [(1, None), (2, 1), (3, 2), (4, 1), (5, 6), (6, 3)]:
+            conn.execute(
+                text("INSERT INTO messages (id, conversation_id, parent_id, role, content) "
+                     "VALUES (:id, 1, :parent_id, 'user', 'x')"),
+                {"id": message_id, "parent_id": parent_id}
+            )
+
+    with engine.begin() as conn:
+        run_migrations(conn)
+
+    with engine.connect() as conn:
+        rows = conn.execute(text("SELECT id, path, depth FROM messages ORDER BY id")).all()
+        assert "alembic_version" in inspect(conn).get_table_names()
+        summary = conn.execute(text("SELECT message_count, last_message_preview FROM conversations")).one()
+
+    assert [(row.id, row.path, row.depth) for row in rows] == [
+        (1, "", 0),
+        (2, "0000000001", 1),
+        (3, "00000000010000000002", 2),
+        (4, "0000000001", 1),
+        (5, "000000000100000000020000000003" + "0000000006", 4),
+        (6, "000000000100000000020000000003", 3),
+    ]
+
+    assert summary.message_count == 6
+    assert summary.last_message_preview == "x"
+
+    # 2回目の適用は何もしない
+    with engine.begin() as conn:
+        run_migrations(conn)
+    engine.dispose()
+
+
+def test_migrations_match_models(tmp_path):
+    from alembic.autogenerate import compare_metadata
+    from alembic.migration import MigrationContext
+
+    from backend.models import Base
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'fresh.db'}")
+    with engine.begin() as conn:
+        run_migrations(conn)
+
+    with engine.connect() as conn:
+        diff = compare_metadata(MigrationContext.configure(conn), Base.metadata)
+    engine.dispose()
+
+    assert diff == []
+
+
+def test_token_backfill_matches_default_tokenizer():
+    import importlib.util
+    from pathlib import Path
+
+    from backend.tokenizer import DEFAULT_TOKENIZER
+
+    path = Path(__file__).parent.parent / "src" / "backend" / "migrations" / "versions" / "0006_message_token_counts.py"
+    spec = importlib.util.spec_from_file_location("migration_0006", path)
+    migration = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(migration)
+
+    # マイグレーションに固定した規則は、移行時点のトークナイザーと同じ値になる
+    assert DEFAULT_TOKENIZER.name == "heuristic-v1"
+    for text in ["", "hello world", "こんにちは、世界", "Ünïcødé ✓", "한국어 and 中文 mixed"]:
+        assert migration.count_message_tokens(text) == DEFAULT_TOKENIZER.count_message(text)
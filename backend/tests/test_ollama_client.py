@@ -0,0 +1,59 @@
+import json
+
+import httpx
+import pytest
+
+from backend.models import LLMProvider
+from backend.provider_adapters import AdapterRegistry, OllamaAdapter
+
+BASE_URL = "http://ollama.test"
+
+
+def stub_transport(requests):
+    def handler(request: httpx.Request):
+        requests.append(request)
+        lines = [json.dumps({"response": "po"}), json.dumps({"response": "ng", "done": True})]
+        return httpx.Response(200, text="\n".join(lines))
+
+    return httpx.MockTransport(handler)
+
+
+@pytest.mark.asyncio
+async def test_ollama_calls_share_one_pooled_client():
+    adapter = OllamaAdapter(None, BASE_URL + "/")
+    requests = []
+    client = adapter._get_client()
+    # 接続プールの設定を保ったまま、通信だけスタブに差し替える
+    client._transport = stub_transport(requests)
+
+    messages = [{"role": "user", "content": "ping"}]
+    assert await adapter.generate("llama3", messages, 10, 0.7) == "pong"
+    chunks = [chunk async for chunk in adapter.stream("llama3", messages, 10, 0.7)]
+    assert chunks == ["po", "ng"]
+
+    assert [str(request.url) for request in requests] == [BASE_URL + "/api/generate"] * 2
+    assert adapter._get_client() is client
+
+    await adapter.aclose()
+    assert client.is_closed
+
+
+@pytest.mark.asyncio
+async def test_providers_on_same_server_share_one_client():
+    registry = AdapterRegistry()
+    first = registry.get(LLMProvider(id=1, name="a", provider_type="ollama", model_name="llama3", api_url=BASE_URL))
+    second = registry.get(LLMProvider(id=2, name="b", provider_type="ollama", model_name="qwen2", api_url=BASE_URL + "/"))
+    other = registry.get(LLMProvider(id=3, name="c", provider_type="ollama", model_name="llama3", api_url="http://other.test"))
+
+    assert first is not second
+    # 接続数の上限はサーバーごとに効く
+    assert first._get_client() is second._get_client()
+    assert first._get_client() is not other._get_client()
+
+    client = first._get_client()
+    # 1つのプロバイダーを閉じても共有しているクライアントは閉じない
+    await first.aclose()
+    assert not client.is_closed
+
+    await registry.aclose()
+    assert client.is_closed
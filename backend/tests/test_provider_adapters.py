@@ -0,0 +1,131 @@
+import asyncio
+
+import pytest
+
+from backend import provider_adapters
+from backend.models import LLMProvider
+from backend.provider_adapters import (
+    AdapterRegistry,
+    OllamaAdapter,
+    OpenAIAdapter,
+    ProviderAdapter,
+    resolve_provider_type,
+)
+
+
+class EchoAdapter(ProviderAdapter):
+    """streamだけを実装したアダプター"""
+
+    provider_type = "echo-stub"
+
+    def __init__(self, api_key=None, api_url=None, http_clients=None):
+        super().__init__(api_key, api_url, http_clients)
+        self.calls = 0
+
+    async def stream(self, model_name, messages, max_tokens, temperature):
+        self.calls += 1
+        call = self.calls
+        for word in messages[-1]["content"].split():
+            await asyncio.sleep(0)
+            yield f"{word}{call}"
+
+
+def test_stored_type_takes_precedence_over_name():
+    provider = LLMProvider(name="my-gpt-proxy", provider_type="ollama", model_name="gpt-oss")
+    assert resolve_provider_type(provider) == "ollama"
+
+    legacy = LLMProvider(name="claude", model_name="claude-3-haiku")
+    assert resolve_provider_type(legacy) == "anthropic"
+
+    with pytest.raises(ValueError):
+        resolve_provider_type(LLMProvider(name="custom", provider_type="unknown", model_name="x"))
+
+
+def test_adapter_must_implement_stream():
+    class Incomplete(ProviderAdapter):
+        provider_type = "incomplete-stub"
+
+    with pytest.raises(TypeError):
+        Incomplete(None, None)
+
+
+@pytest.mark.asyncio
+async def test_default_stream_choices_fans_out_over_stream():
+    adapter = EchoAdapter()
+    assert not adapter.native_choices
+
+    events = [event async for event in adapter.stream_choices("m", [{"role": "user", "content": "a b"}], 10, 0.7, 3)]
+
+    assert adapter.calls == 3
+    for index in range(3):
+        chunks = [chunk for i, chunk in events if i == index]
+        # 候補ごとにチャンクを順に返し、最後にNoneで完了を知らせる
+        assert len(chunks) == 3 and chunks[-1] is None
+    assert {"".join(c for i, c in events if i == index and c) for index in range(3)} == {"a1b1", "a2b2", "a3b3"}
+
+
+@pytest.mark.asyncio
+async def test_registry_rebuilds_adapter_when_settings_change():
+    registry = AdapterRegistry()
+    provider = LLMProvider(id=1, name="local", provider_type="ollama", model_name="llama3", api_url="http://a")
+
+    adapter = registry.get(provider)
+    assert isinstance(adapter, OllamaAdapter)
+    # モデル名の変更ではクライアントを作り直さない
+    provider.model_name = "qwen2"
+    assert registry.get(provider) is adapter
+
+    provider.api_url = "http://b"
+    rebuilt = registry.get(provider)
+    assert rebuilt is not adapter
+    assert rebuilt.api_url == "http://b"
+
+    provider.provider_type = "openai"
+    assert isinstance(registry.get(provider), OpenAIAdapter)
+
+    await registry.aclose()
+
+
+@pytest.mark.asyncio
+async def test_registry_closes_retired_adapters(monkeypatch):
+    closed = []
+
+    async def record_close(self):
+        closed.append(self.api_url)
+
+    monkeypatch.setattr(OllamaAdapter, "aclose", record_close)
+    registry = AdapterRegistry()
+    provider = LLMProvider(id=1, name="local", provider_type="ollama", model_name="llama3", api_url="http://a")
+
+    # 待ち時間が過ぎれば古いアダプターを閉じる
+    monkeypatch.setattr(provider_adapters, "RETIRED_ADAPTER_CLOSE_DELAY", 0)
+    registry.get(provider)
+    provider.api_url = "http://b"
+    registry.get(provider)
+    await asyncio.sleep(0.01)
+    assert closed == ["http://a"]
+    assert not registry._retired and not registry._closing
+
+    # 待っている途中で終了した場合もまとめて閉じる
+    monkeypatch.setattr(provider_adapters, "RETIRED_ADAPTER_CLOSE_DELAY", 300)
+    provider.api_url = "http://c"
+    registry.get(provider)
+    await registry.aclose()
+    assert sorted(closed) == ["http://a", "http://b", "http://c"]
+    assert not registry._retired
+
+
+@pytest.mark.asyncio
+async def test_provider_type_is_inferred_and_validated(client):
+    res = await client.post("/api/providers/", json={"name": "anthropic-main", "model_name": "claude-3-haiku"})
+    assert res.status_code == 201
+    assert res.json()["provider_type"] == "anthropic"
+    provider_id = res.json()["id"]
+
+    res = await client.put(f"/api/providers/{provider_id}", json={"provider_type": "nope"})
+    assert res.status_code == 400
+
+    res = await client.put(f"/api/providers/{provider_id}", json={"provider_type": "openai"})
+    assert res.json()["provider_type"] == "openai"
+
+    await client.delete(f"/api/providers/{provider_id}")
@@ -0,0 +1,62 @@
+import pytest
+from sqlalchemy import event
+
+from backend.database import AsyncSessionLocal, engine
+from backend.provider_registry import provider_registry
+
+
+async def count_provider_queries(calls: int):
+    """get_activeをcalls回呼び、llm_providersへのクエリ数と最後の結果を返す"""
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(engine.sync_engine, "before_cursor_execute", listener)
+    try:
+        async with AsyncSessionLocal() as db:
+            for _ in range(calls):
+                provider = await provider_registry.get_active(db)
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", listener)
+    return len([s for s in statements if "llm_providers" in s]), provider
+
+
+@pytest.mark.asyncio
+async def test_active_provider_is_loaded_once_and_invalidated_by_api(client):
+    res = await client.post(
+        "/api/providers/",
+        json={"name": "registry-ollama", "provider_type": "ollama", "model_name": "llama3", "api_url": "http://localhost:11434"}
+    )
+    provider_id = res.json()["id"]
+    await client.post(f"/api/providers/{provider_id}/activate")
+
+    queries, provider = await count_provider_queries(3)
+    assert queries == 1
+    assert provider.id == provider_id
+
+    # 更新後は読み込み直す
+    await client.put(f"/api/providers/{provider_id}", json={"model_name": "qwen2"})
+    queries, provider = await count_provider_queries(2)
+    assert queries == 1
+    assert provider.model_name == "qwen2"
+
+    # 削除後はアクティブなプロバイダーがなくなり、その結果もキャッシュする
+    await client.delete(f"/api/providers/{provider_id}")
+    queries, provider = await count_provider_queries(2)
+    assert queries == 1
+    assert provider is None
+
+
+@pytest.mark.asyncio
+async def test_invalidation_during_load_is_not_overwritten(client):
+    provider_registry.invalidate()
+    async with AsyncSessionLocal() as db:
+        original_execute = db.execute
+
+        async def execute_then_invalidate(*args, **kwargs):
+            result = await original_execute(*args, **kwargs)
+            provider_registry.invalidate()
+            return result
+
+        db.execute = execute_then_invalidate
+        await provider_registry.get_active(db)
+
+    assert provider_registry.stats()["loaded"] is False
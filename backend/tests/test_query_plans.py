@@ -0,0 +1,76 @@
+import re
+
+import pytest
+from sqlalchemy import event
+
+from backend.database import AsyncSessionLocal, engine
+from backend.models import Message
+
+# インデックスなしの全件走査を許可しないテーブル
+CHECKED_TABLES = ("messages", "conversations")
+FULL_SCAN = re.compile(r"^SCAN (\w+)(?: AS \w+)?$")
+
+
+def full_scans(plan_rows):
+    """EXPLAIN QUERY PLANの結果からインデックスを使わない全件走査を抽出"""
+    scans = []
+    for row in plan_rows:
+        match = FULL_SCAN.match(row[-1])
+        if match and match.group(1) in CHECKED_TABLES:
+            scans.append(row[-1])
+    return scans
+
+
+@pytest.mark.asyncio
+async def test_hot_queries_use_indexes(client):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+            statements.append((statement, parameters))
+
+    # アプリが実際に発行するクエリを記録する
+    event.listen(engine.sync_engine, "before_cursor_execute", record)
+    try:
+        res = await client.post("/api/conversations/", json={"title": "Plans"})
+        conv_id = res.json()["id"]
+
+        async with AsyncSessionLocal() as db:
+            root = Message(conversation_id=conv_id, role="user", content="root")
+            db.add(root)
+            await db.flush()
+            reply = Message(conversation_id=conv_id, parent_id=root.id, role="assistant", content="reply")
+            db.add(reply)
+            await db.commit()
+            root_id, reply_id = root.id, reply.id
+
+        await client.get("/api/conversations/", params={"limit": 1})
+        res = await client.get("/api/conversations/", params={"limit": 1})
+        if "X-Next-Cursor" in res.headers:
+            await client.get("/api/conversations/", params={"limit": 1, "cursor": res.headers["X-Next-Cursor"]})
+        await client.get(f"/api/conversations/{conv_id}")
+        await client.get(f"/api/conversations/{conv_id}/tree")
+        await client.get(f"/api/conversations/{conv_id}/tree", params={"root_id": root_id, "max_depth": 0})
+        await client.get(f"/api/conversations/{conv_id}/skeleton", params={"max_depth": 0})
+        await client.get(f"/api/conversations/{conv_id}/changes", params={"since": 0})
+        await client.post(f"/api/conversations/{conv_id}/messages/batch", json={"ids": [root_id, reply_id]})
+        await client.get(f"/api/chat/history/{conv_id}")
+        await client.get(f"/api/chat/history/{conv_id}", params={"from_message_id": reply_id})
+        await client.put(f"/api/conversations/{conv_id}/title", json={"title": "Plans 2"})
+        await client.delete(f"/api/conversations/{conv_id}")
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", record)
+
+    assert statements
+
+    failures = []
+    async with engine.connect() as conn:
+        for statement, parameters in statements:
+            raw = await conn.get_raw_connection()
+            cursor = await raw.driver_connection.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+            plan = await cursor.fetchall()
+            scans = full_scans(plan)
+            if scans:
+                failures.append(f"{statement.strip()} -> {scans}")
+
+    assert failures == []
@@ -0,0 +1,136 @@
+import asyncio
+import time
+
+import pytest
+
+from backend.provider_adapters import TransientProviderError
+from backend.resilience import GenerationInfo, backoff_delay, is_transient
+
+from conftest import StubAdapter, history, service, stub_provider as provider
+
+HISTORY = history("hi")
+# モデル名ごとに用意した動作（例外か (待ち時間, 応答)）を呼び出し順に実行する
+scripts = {}
+
+
+async def scripted(model_name, messages):
+    step = scripts[model_name].pop(0)
+    if isinstance(step, Exception):
+        raise step
+    delay, text = step
+    await asyncio.sleep(delay)
+    yield text
+
+
+@pytest.fixture(autouse=True)
+def scripted_stub(stub_adapter):
+    scripts.clear()
+    stub_adapter.respond = scripted
+    return stub_adapter
+
+
+def test_transient_errors_and_jittered_backoff():
+    assert is_transient(TransientProviderError("busy"))
+    assert is_transient(asyncio.TimeoutError())
+    assert not is_transient(ValueError("Invalid API key"))
+
+    class RateLimitError(Exception):
+        pass
+
+    assert is_transient(RateLimitError())
+    assert backoff_delay(3, base_delay=0.5, max_delay=2, rng=lambda: 1.0) == 2
+    assert backoff_delay(1, base_delay=0.5, max_delay=2, rng=lambda: 0.5) == 0.5
+
+
+@pytest.mark.asyncio
+async def test_transient_errors_are_retried_on_the_same_provider():
+    scripts.update({"a": [TransientProviderError("503"), TransientProviderError("503"), (0, "ok")]})
+    info = GenerationInfo()
+
+    response = await service(retry_attempts=2).generate_response(provider(1, "a"), HISTORY, raise_errors=True, info=info)
+
+    assert response == "ok"
+    assert info.attempts == 3
+    assert info.provider.model_name == "a"
+
+
+@pytest.mark.asyncio
+async def test_failover_walks_the_fallback_chain():
+    primary, second, third = provider(1, "a"), provider(2, "b"), provider(3, "c")
+    scripts.update({
+        "a": [ValueError("Invalid API key")],                         # 一時的でないため再試行しない
+        "b": [TransientProviderError("503"), TransientProviderError("503")],
+        "c": [(0, "from c")],
+    })
+    llm = service(fallbacks={1: [second, third]}, retry_attempts=1)
+    info = GenerationInfo()
+
+    chunks = [chunk async for chunk in llm.generate_streaming_response(primary, HISTORY, info=info)]
+
+    assert chunks == ["from c"]
+    assert StubAdapter.calls == ["a", "b", "b", "c"]
+    assert info.provider is third
+    assert llm.resilience.failovers == 2
+
+    # 比較目的の呼び出しでは切り替えない
+    scripts.update({"a": [ValueError("Invalid API key")]})
+    info = GenerationInfo()
+    await llm.generate_response(primary, HISTORY, failover=False, info=info)
+    assert info.provider is None
+
+
+@pytest.mark.asyncio
+async def test_hedged_request_wins_and_cancels_the_slow_one():
+    slow = provider(1, "slow")
+    llm = service(hedging=True, hedge_min_samples=5)
+    for _ in range(5):
+        llm.resilience.latency.record(("generate", 1), 0.05)
+    scripts.update({"slow": [(2.0, "late"), (0, "hedged")]})
+    info = GenerationInfo()
+
+    start = time.perf_counter()
+    response = await llm.generate_response(slow, HISTORY, raise_errors=True, info=info)
+
+    assert response == "hedged"
+    assert time.perf_counter() - start < 1.0
+    assert info.hedged
+    assert StubAdapter.cancelled == ["slow"]
+    assert llm.resilience.hedge_wins == 1
+
+
+@pytest.mark.asyncio
+async def test_send_fails_over_to_configured_fallback(client):
+    res = await client.post("/api/providers/", json={"name": "backup", "provider_type": StubAdapter.provider_type, "model_name": "b"})
+    backup_id = res.json()["id"]
+    res = await client.post("/api/providers/", json={
+        "name": "primary", "provider_type": StubAdapter.provider_type, "model_name": "a", "fallback_provider_id": backup_id
+    })
+    assert res.status_code == 201
+    primary_id = res.json()["id"]
+
+    res = await client.put(f"/api/providers/{primary_id}", json={"fallback_provider_id": primary_id})
+    assert res.status_code == 400
+    res = await client.put(f"/api/providers/{primary_id}", json={"fallback_provider_id": 999999})
+    assert res.status_code == 400
+
+    # 接続テストは代替プロバイダーに切り替えず、失敗として返す
+    scripts.update({"a": [ValueError("Invalid API key")], "b": [(0, "from backup")]})
+    res = await client.post(f"/api/providers/test/{primary_id}", params={"bypass_cache": True})
+    assert res.json()["success"] is False
+    assert res.json()["error"] == "Invalid API key"
+    assert StubAdapter.calls == ["a"]
+
+    await client.post(f"/api/providers/{primary_id}/activate")
+    scripts.update({"a": [ValueError("Invalid API key")], "b": [(0, "from backup")]})
+    res = await client.post("/api/conversations/", json={"title": "Failover"})
+    res = await client.post("/api/chat/send", json={"conversation_id": res.json()["id"], "message": "hi"})
+
+    assistant = res.json()["assistant_message"]
+    assert assistant["content"] == "from backup"
+    assert assistant["provider_name"] == "backup"
+    assert assistant["model_name"] == "b"
+
+    # 代替先を削除すると参照も外れる
+    await client.delete(f"/api/providers/{backup_id}")
+    res = await client.get(f"/api/providers/{primary_id}")
+    assert res.json()["fallback_provider_id"] is None
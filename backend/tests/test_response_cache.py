@@ -0,0 +1,111 @@
+import pytest
+
+from backend.response_cache import ResponseCache
+
+from conftest import history, service, stub_provider
+
+PROVIDER = stub_provider(1, "stub-model")
+
+
+async def repeat(model_name, messages):
+    """入力に応じた応答を10個のチャンクで返す（モデル名"fail"なら失敗）"""
+    if model_name == "fail":
+        raise RuntimeError("down")
+    content = messages[-1]["content"]
+    for _ in range(10):
+        yield content * 10
+
+
+@pytest.fixture
+def stub_calls(stub_adapter):
+    stub_adapter.respond = repeat
+    return stub_adapter.calls
+
+
+@pytest.mark.asyncio
+async def test_memory_tier_ttl_and_caps():
+    cache = ResponseCache(enabled=True, max_entries=2)
+    await cache.set("a", "A")
+    await cache.set("b", "B")
+    await cache.set("c", "C")
+    assert await cache.get("a") is None
+    assert await cache.get("c") == "C"
+
+    expired = ResponseCache(enabled=True, ttl=-1)
+    await expired.set("a", "A")
+    assert await expired.get("a") is None
+
+
+@pytest.mark.asyncio
+async def test_persistent_tier_survives_restart(tmp_path):
+    path = str(tmp_path / "responses.db")
+    cache = ResponseCache(enabled=True, db_path=path)
+    await cache.set("key", "persisted")
+    cache.close()
+
+    restarted = ResponseCache(enabled=True, db_path=path)
+    assert await restarted.get("key") == "persisted"
+    assert restarted.disk_hits == 1
+    # 2回目はメモリからヒットする
+    assert await restarted.get("key") == "persisted"
+    assert restarted.disk_hits == 1
+    restarted.close()
+
+
+@pytest.mark.asyncio
+async def test_llm_service_reuses_and_streams_cached_responses(stub_calls):
+    llm = service(cache=ResponseCache(enabled=True))
+    expected = "x" * 100
+
+    assert await llm.generate_response(PROVIDER, history("x")) == expected
+    assert await llm.generate_response(PROVIDER, history("x")) == expected
+    assert len(stub_calls) == 1
+
+    # パラメータや入力が違えば別のエントリ
+    await llm.generate_response(PROVIDER, history("x"), max_tokens=10)
+    await llm.generate_response(PROVIDER, history("x"), use_cache=False)
+    assert len(stub_calls) == 3
+
+    # キャッシュ済みの応答はストリーミングでも返る
+    chunks = [chunk async for chunk in llm.generate_streaming_response(PROVIDER, history("x"))]
+    assert "".join(chunks) == expected
+    assert len(chunks) > 1
+    assert len(stub_calls) == 3
+
+    # ストリーミングで受信した応答もキャッシュされる
+    [chunk async for chunk in llm.generate_streaming_response(PROVIDER, history("y"))]
+    assert await llm.generate_response(PROVIDER, history("y")) == "y" * 100
+    assert len(stub_calls) == 4
+
+
+@pytest.mark.asyncio
+async def test_errors_are_not_cached(stub_calls):
+    llm = service(cache=ResponseCache(enabled=True))
+
+    await llm.generate_response(stub_provider(2, "fail"), history("x"))
+    assert llm.response_cache.stats()["entries"] == 0
+
+
+@pytest.mark.asyncio
+async def test_regenerate_skips_the_cache_by_default(client, monkeypatch, stub_calls):
+    from backend.llm_service import llm_service
+    from backend.routers import chat
+
+    async def active(db):
+        return PROVIDER
+
+    monkeypatch.setattr(chat.provider_registry, "get_active", active)
+    monkeypatch.setattr(llm_service, "response_cache", ResponseCache(enabled=True))
+
+    res = await client.post("/api/conversations/", json={"title": "Regenerate"})
+    res = await client.post("/api/chat/send", json={"conversation_id": res.json()["id"], "message": "hi"})
+    message_id = res.json()["assistant_message"]["id"]
+    assert len(stub_calls) == 1
+
+    # 元の応答と同じキーになるが、キャッシュから返さずに新しい応答を生成する
+    res = await client.post(f"/api/chat/regenerate/{message_id}")
+    assert res.status_code == 200
+    assert len(stub_calls) == 2
+
+    res = await client.post(f"/api/chat/regenerate/{message_id}", params={"bypass_cache": False})
+    assert len(stub_calls) == 2
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+from backend.scheduler import BATCH, INTERACTIVE, ProviderLimits, ProviderQueue, SchedulerTimeout, TokenBucket
+
+
+@pytest.mark.asyncio
+async def test_concurrency_limit_queues_excess_requests():
+    queue = ProviderQueue("stub", ProviderLimits(max_concurrency=2))
+    running = []
+    peak = 0
+
+    async def request():
+        nonlocal peak
+        await queue.acquire(10)
+        running.append(1)
+        peak = max(peak, len(running))
+        await asyncio.sleep(0.02)
+        running.pop()
+        queue.release()
+
+    await asyncio.gather(*(request() for _ in range(6)))
+
+    assert peak == 2
+    assert queue.stats()["queued"] == 4
+    assert queue.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_interactive_requests_overtake_queued_batch_work():
+    queue = ProviderQueue("stub", ProviderLimits(max_concurrency=1))
+    order = []
+    await queue.acquire(1)
+
+    async def request(label, priority):
+        await queue.acquire(1, priority)
+        order.append(label)
+        queue.release()
+
+    tasks = [asyncio.create_task(request("batch", BATCH))]
+    await asyncio.sleep(0)
+    tasks.append(asyncio.create_task(request("interactive", INTERACTIVE)))
+    await asyncio.sleep(0)
+
+    queue.release()
+    await asyncio.gather(*tasks)
+    assert order == ["interactive", "batch"]
+
+
+@pytest.mark.asyncio
+async def test_requests_per_minute_budget_delays_requests():
+    queue = ProviderQueue("stub", ProviderLimits(requests_per_minute=600))
+    # バケットを空にして、次の1リクエストが0.1秒後に実行できる状態にする
+    queue.requests.level = 0
+
+    waited = await queue.acquire(1)
+    queue.release()
+
+    assert 0.05 < waited < 0.5
+    assert queue.stats()["max_wait_ms"] > 50
+
+
+def test_token_bucket_caps_requests_larger_than_the_budget():
+    now = [0.0]
+    bucket = TokenBucket(60, clock=lambda: now[0])
+    bucket.take(60)
+
+    # 1分の上限を超える要求は満杯になるまで待てば実行できる
+    assert bucket.wait_time(1000) == pytest.approx(60)
+    now[0] = 30
+    assert bucket.wait_time(10) == 0
+
+
+@pytest.mark.asyncio
+async def test_queue_timeout_and_cancellation_free_the_slot():
+    queue = ProviderQueue("stub", ProviderLimits(max_concurrency=1))
+    await queue.acquire(1)
+
+    with pytest.raises(SchedulerTimeout):
+        await queue.acquire(1, timeout=0.01)
+
+    waiter = asyncio.create_task(queue.acquire(1))
+    await asyncio.sleep(0)
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+
+    assert queue.stats()["waiting"] == 0
+    queue.release()
+    assert await queue.acquire(1) == 0.0
@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+from backend.resilience import GenerationInfo
+
+from conftest import history, service, stub_provider
+
+PROVIDER = stub_provider(1, "m", name="counting")
+
+
+async def slow_chunks(model_name, messages):
+    """チャンクの間に待つ（モデル名"fail"なら失敗）"""
+    if model_name == "fail":
+        raise ValueError("upstream failed")
+    for i in range(3):
+        await asyncio.sleep(0.05)
+        yield f"{messages[-1]['content']}-{i} "
+
+
+async def collect(llm, content, provider=PROVIDER, **options):
+    return [chunk async for chunk in llm.generate_streaming_response(provider, history(content), **options)]
+
+
+@pytest.fixture(autouse=True)
+def stub(stub_adapter):
+    stub_adapter.respond = slow_chunks
+    return stub_adapter
+
+
+@pytest.mark.asyncio
+async def test_identical_streams_share_one_generation(stub):
+    llm = service()
+    first_info, late_info = GenerationInfo(), GenerationInfo()
+
+    async def late_joiner():
+        await asyncio.sleep(0.08)   # 最初のチャンクの後に参加してもそれまでのチャンクから受け取る
+        return await collect(llm, "hi", info=late_info)
+
+    first, late, other = await asyncio.gather(collect(llm, "hi", info=first_info), late_joiner(), collect(llm, "other"))
+
+    assert first == late == ["hi-0 ", "hi-1 ", "hi-2 "]
+    assert other[0] == "other-0 "
+    assert len(stub.calls) == 2
+    assert not first_info.coalesced
+    assert late_info.coalesced and late_info.provider is PROVIDER
+    assert llm.flights.stats()["joined"] == 1
+    assert llm.flights.in_flight() == 0
+
+    # 新しい応答を求めるリクエスト（use_cache=False）は共有しない
+    await asyncio.gather(collect(llm, "hi", use_cache=False), collect(llm, "hi", use_cache=False))
+    assert len(stub.calls) == 4
+
+
+@pytest.mark.asyncio
+async def test_generate_response_shares_result_and_errors(stub):
+    llm = service()
+    responses = await asyncio.gather(*(llm.generate_response(PROVIDER, history("hi")) for _ in range(3)))
+    assert responses == ["hi-0 hi-1 hi-2 "] * 3
+    assert len(stub.calls) == 1
+
+    failing = stub_provider(2, "fail", name="failing")
+    results = await asyncio.gather(
+        *(llm.generate_response(failing, history("hi"), raise_errors=True) for _ in range(2)),
+        return_exceptions=True
+    )
+    assert all(isinstance(result, ValueError) for result in results)
+    assert len(stub.calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_upstream_cancelled_only_when_all_subscribers_leave(stub):
+    llm = service()
+    first = llm.generate_streaming_response(PROVIDER, history("hi"))
+    second = llm.generate_streaming_response(PROVIDER, history("hi"))
+    assert await first.__anext__() == "hi-0 "
+    assert await second.__anext__() == "hi-0 "
+
+    await first.aclose()
+    assert [chunk async for chunk in second] == ["hi-1 ", "hi-2 "]
+    assert len(stub.cancelled) == 0
+
+    third = llm.generate_streaming_response(PROVIDER, history("bye"))
+    assert await third.__anext__() == "bye-0 "
+    await third.aclose()
+    await asyncio.sleep(0)
+    assert len(stub.cancelled) == 1
+    assert llm.flights.stats()["cancelled"] == 1
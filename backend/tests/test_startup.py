@@ -0,0 +1,20 @@
+import json
+import subprocess
+import sys
+
+# 起動時には読み込まず、使用時に初めてimportするモジュール
+LAZY_MODULES = ("openai", "anthropic", "google.generativeai", "google.ai.generativelanguage", "tiktoken", "alembic")
+
+
+def test_importing_app_does_not_load_provider_sdks():
+    # 他のテストが読み込んだモジュールの影響を受けないよう、新しいプロセスで確認する
+    script = (
+        "import json, sys\n"
+        "import backend.main, backend.database\n"
+        "print(json.dumps({'modules': sorted(sys.modules), 'sync_engine': backend.database._sync_engine is not None}))\n"
+    )
+    result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+    loaded = json.loads(result.stdout.strip().splitlines()[-1])
+
+    assert [name for name in loaded["modules"] if name.split(".")[0] in LAZY_MODULES or name in LAZY_MODULES] == []
+    assert loaded["sync_engine"] is False
@@ -0,0 +1,93 @@
+import pytest
+
+from backend.database import AsyncSessionLocal
+from backend.history import get_conversation_history
+from backend.llm_service import llm_service
+from backend.models import LLMProvider, Message
+from backend.tokenizer import DEFAULT_TOKENIZER, HeuristicTokenizer, get_context_window, get_tokenizer, register_tokenizer
+from tests.test_history import create_chain
+
+
+def test_heuristic_counts_cjk_per_character():
+    english = "The quick brown fox jumps over the lazy dog"
+    japanese = "吾輩は猫である。名前はまだ無い。"
+
+    assert DEFAULT_TOKENIZER.count(english) == 11
+    # 日本語は文字数をそのままトークン数として見積もる（len/4 では大きく過小評価になる）
+    assert DEFAULT_TOKENIZER.count(japanese) == len(japanese)
+
+
+def test_context_window_by_model():
+    assert get_context_window("openai", "gpt-4o-mini") == 128000
+    assert get_context_window("openai", "gpt-4") == 8192
+    assert get_context_window("anthropic", "claude-3-5-sonnet-latest") == 200000
+    assert get_context_window("ollama", "llama3") == 4096
+
+
+def test_tokenizer_registry():
+    custom = HeuristicTokenizer("custom", ascii_chars_per_token=1.0)
+    register_tokenizer("custom-provider", lambda model_name: custom)
+
+    assert get_tokenizer("custom-provider", "any") is custom
+    assert get_tokenizer("unknown", "any") is DEFAULT_TOKENIZER
+
+
+@pytest.mark.asyncio
+async def test_token_counts_are_stored_as_prefix_sums(client):
+    async with AsyncSessionLocal() as db:
+        conversation, ids = await create_chain(db, 5)
+        history = await get_conversation_history(conversation.id, ids[-1], db)
+
+        running = 0
+        for message in history:
+            assert message.token_count == DEFAULT_TOKENIZER.count_message(message.content)
+            running += message.token_count
+            assert message.context_tokens == running
+
+        # 本文を変更すると子孫の累積値もずれる
+        root = await db.get(Message, ids[0])
+        root.content = "これは再生成された長い応答です。" * 10
+        await db.commit()
+
+        updated = await get_conversation_history(conversation.id, ids[-1], db)
+        delta = updated[0].token_count - history[0].token_count
+        assert delta > 0
+        assert updated[-1].context_tokens == history[-1].context_tokens + delta
+
+        await db.delete(conversation)
+        await db.commit()
+
+
+@pytest.mark.asyncio
+async def test_truncate_keeps_newest_messages_within_budget(client):
+    async with AsyncSessionLocal() as db:
+        conversation, ids = await create_chain(db, 20)
+        history = await get_conversation_history(conversation.id, ids[-1], db)
+
+        per_message = history[-1].token_count
+        truncated = llm_service.truncate_messages_for_context(history, max_tokens=per_message * 3)
+        assert [m.id for m in truncated] == ids[-3:]
+
+        # 保存値がない場合も同じ結果になる
+        recounted = [m.model_copy(update={"context_tokens": None}) for m in history]
+        truncated = llm_service.truncate_messages_for_context(recounted, max_tokens=per_message * 3)
+        assert [m.id for m in truncated] == ids[-3:]
+
+        # 最新のメッセージは上限を超えていても残す
+        assert [m.id for m in llm_service.truncate_messages_for_context(history, max_tokens=1)] == ids[-1:]
+
+        provider = LLMProvider(name="ollama-local", model_name="llama3", api_url="http://localhost:11434")
+        assert llm_service.get_context_budget(provider) == 4096 - 2000
+        assert llm_service.truncate_messages_for_context(history, provider=provider) == history
+
+        await db.delete(conversation)
+        await db.commit()
+
+
+def test_context_budget_is_capped_by_default(monkeypatch):
+    provider = LLMProvider(name="claude", provider_type="anthropic", model_name="claude-3-5-sonnet-20241022")
+    assert llm_service.get_context_budget(provider) == 4000
+
+    # 0を指定した場合だけコンテキストウィンドウ全体を使う
+    monkeypatch.setattr("backend.llm_service.MAX_CONTEXT_TOKENS", 0)
+    assert llm_service.get_context_budget(provider) == 200000 - 2000
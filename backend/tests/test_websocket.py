@@ -0,0 +1,128 @@
+import asyncio
+import json
+from contextlib import asynccontextmanager
+
+import pytest
+from fastapi import WebSocketDisconnect
+
+from backend.routers import websocket_chat
+
+from conftest import stub_provider
+
+# 並行した生成がDBの接続を取り合うため、エンジンと同じセッションのイベントループで実行する
+pytestmark = pytest.mark.asyncio(loop_scope="session")
+
+
+async def slow_stream(model_name, messages):
+    """チャンクを少しずつ返す"""
+    for i in range(20):
+        await asyncio.sleep(0.02)
+        yield f"{messages[-1]['content']}{i} "
+
+
+@pytest.fixture(autouse=True)
+def stub(stub_adapter):
+    stub_adapter.respond = slow_stream
+    return stub_adapter
+
+
+class FakeWebSocket:
+    """受信するメッセージをキューから渡し、送信したメッセージを記録する"""
+
+    def __init__(self):
+        self.incoming = asyncio.Queue()
+        self.sent = []
+
+    async def accept(self):
+        pass
+
+    async def receive_text(self):
+        data = await self.incoming.get()
+        if data is None:
+            raise WebSocketDisconnect()
+        return json.dumps(data)
+
+    async def send_json(self, data):
+        self.sent.append(data)
+
+    async def wait_for(self, predicate, timeout=3.0):
+        async def poll():
+            while not any(predicate(data) for data in self.sent):
+                await asyncio.sleep(0.01)
+        await asyncio.wait_for(poll(), timeout)
+
+
+@asynccontextmanager
+async def connect(client, monkeypatch):
+    """アクティブなプロバイダーを差し替えて接続（終了時に切断）"""
+    provider = stub_provider(-10, "m", name="slow-stream")
+
+    async def active(db):
+        return provider
+
+    monkeypatch.setattr(websocket_chat.provider_registry, "get_active", active)
+
+    res = await client.post("/api/conversations/", json={"title": "WS"})
+    websocket = FakeWebSocket()
+    endpoint = asyncio.create_task(websocket_chat.websocket_endpoint(websocket, "ws-test"))
+    try:
+        yield websocket, res.json()["id"], endpoint
+    finally:
+        if not endpoint.done():
+            await websocket.incoming.put(None)
+            await asyncio.wait_for(endpoint, 3.0)
+
+
+def of(request_id, event_type):
+    return lambda data: data.get("request_id") == request_id and data["type"] == event_type
+
+
+async def test_concurrent_generations_can_be_cancelled(client, monkeypatch, stub):
+    async with connect(client, monkeypatch) as (websocket, conv_id, _):
+        for request_id, message in (("a", "x"), ("b", "y")):
+            await websocket.incoming.put({
+                "type": "chat_message", "request_id": request_id, "conversation_id": conv_id, "message": message
+            })
+
+        # 生成中もpingに応答する
+        await websocket.wait_for(of("a", "assistant_message_chunk"))
+        await websocket.incoming.put({"type": "ping"})
+        await websocket.wait_for(lambda data: data["type"] == "pong")
+        assert not any(data["type"] == "assistant_message_complete" for data in websocket.sent)
+
+        await websocket.incoming.put({"type": "cancel", "request_id": "a"})
+        await websocket.wait_for(of("a", "generation_cancelled"))
+        assert len(stub.cancelled) == 1
+
+        partial = next(data for data in websocket.sent if of("a", "assistant_message_complete")(data))
+        assert partial["cancelled"] is True
+        assert partial["message"]["content"].startswith("x0 ")
+        assert partial["message"]["provider_name"] == "slow-stream"
+
+        await websocket.wait_for(of("b", "assistant_message_complete"))
+        b_chunks = "".join(data["chunk"] for data in websocket.sent if of("b", "assistant_message_chunk")(data))
+        assert b_chunks == "".join(f"y{i} " for i in range(20))
+        assert all(data["chunk"].startswith("x") for data in websocket.sent if of("a", "assistant_message_chunk")(data))
+
+
+async def test_generation_limits_and_disconnect(client, monkeypatch, stub):
+    async with connect(client, monkeypatch) as (websocket, conv_id, endpoint):
+        message = {"type": "chat_message", "conversation_id": conv_id, "message": "z"}
+
+        await websocket.incoming.put({**message, "request_id": "dup"})
+        await websocket.incoming.put({**message, "request_id": "dup"})
+        await websocket.wait_for(of("dup", "error"))
+
+        await websocket.incoming.put({"type": "cancel", "request_id": "missing"})
+        await websocket.wait_for(of("missing", "error"))
+
+        # request_idを省略した場合は割り当てたIDをイベントに付ける
+        await websocket.incoming.put(message)
+        await websocket.wait_for(lambda data: data["type"] == "user_message" and data["request_id"] != "dup")
+
+        # 切断すると実行中の生成を止める（同じ履歴の2つの生成は1つの送信を共有している）
+        await websocket.wait_for(lambda data: data["type"] == "assistant_message_chunk")
+        await websocket.incoming.put(None)
+        await asyncio.wait_for(endpoint, 3.0)
+        assert len(stub.cancelled) == 1
+        assert not any(data["type"] == "assistant_message_complete" for data in websocket.sent)
@@ -23,14 +23,40 @@ export interface MessageTreeNode {
   content: string;
   created_at: string;
   children: MessageTreeNode[];
+  child_count?: number;
 }
 
 export interface ConversationTree {
   conversation_id: string;
   title: string;
+  version?: number;
   root_messages: MessageTreeNode[];
 }
 
+export interface MessageSkeleton {
+  id: string;
+  parent_id: string | null;
+  role: 'user' | 'assistant' | 'system';
+  created_at: string;
+  preview: string;
+  child_count: number;
+}
+
+export interface ConversationSkeleton {
+  conversation_id: string;
+  title: string;
+  messages: MessageSkeleton[];
+}
+
+export interface ConversationChanges {
+  conversation_id: string;
+  title: string;
+  since: number;
+  version: number;
+  full_snapshot: boolean;
+  messages: Message[];
+}
+
 export interface SendMessageRequest {
   conversation_id: string;
   parent_id: string | null;
@@ -156,6 +182,55 @@ class ApiClient {
     };
   }
 
+  async getConversationSkeleton(id: string, rootId?: string, maxDepth?: number): Promise<ConversationSkeleton> {
+    const params = new URLSearchParams();
+    if (rootId) {
+      params.append('root_id', rootId);
+    }
+    if (maxDepth !== undefined) {
+      params.append('max_depth', maxDepth.toString());
+    }
+
+    const endpoint = `/api/conversations/${id}/skeleton${params.toString() ? `?${params.toString()}` : ''}`;
+    const skeleton = await this.request<any>(endpoint);
+
+    return {
+      ...skeleton,
+      conversation_id: skeleton.conversation_id.toString(),
+      messages: skeleton.messages.map((node: any) => ({
+        ...node,
+        id: node.id.toString(),
+        parent_id: node.parent_id !== null ? node.parent_id.toString() : null
+      }))
+    };
+  }
+
+  async getConversationChanges(id: string, since: number): Promise<ConversationChanges> {
+    const changes = await this.request<any>(`/api/conversations/${id}/changes?since=${since}`);
+
+    return {
+      ...changes,
+      conversation_id: changes.conversation_id.toString(),
+      messages: changes.messages.map((msg: any) => ({
+        ...msg,
+        id: msg.id.toString(),
+        parent_id: msg.parent_id !== null ? msg.parent_id.toString() : null
+      }))
+    };
+  }
+
+  async getMessageBodies(conversationId: string, messageIds: string[]): Promise<Message[]> {
+    const response = await this.request<{ messages: any[] }>(`/api/conversations/${conversationId}/messages/batch`, {
+      method: 'POST',
+      body: JSON.stringify({ ids: messageIds.map(id => Number(id)) }),
+    });
+    return response.messages.map(msg => ({
+      ...msg,
+      id: msg.id.toString(),
+      parent_id: msg.parent_id !== null ? msg.parent_id.toString() : null
+    }));
+  }
+
   // Chat functionality
   async sendMessage(request: SendMessageRequest): Promise<SendMessageResponse> {
     return this.request<SendMessageResponse>('/api/chat/send', {